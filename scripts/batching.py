@@ -0,0 +1,49 @@
+import re
+from itertools import islice
+
+BATCH_MARKER = '<<<IMAGE {number}>>>'
+_MARKER_PATTERN = re.compile(r'^[ \t#*_`]*<<<\s*IMAGE\s+(\d+)\s*>>>[ \t*_`]*$', re.IGNORECASE | re.MULTILINE)
+
+
+def chunked(iterable, size):
+    """Yield lists of up to `size` consecutive items."""
+    iterator = iter(iterable)
+    size = max(1, int(size or 1))
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def build_batch_prompt(prompt, count):
+    """Wrap a single-image prompt so one request answers `count` images in a splittable format."""
+    return (
+        f'You are given {count} images, numbered 1 to {count} in the order they appear. '
+        'Follow the instructions below for each image separately, without referring to the other images. '
+        f'Start the answer for image N with a line containing only {BATCH_MARKER.format(number="N")}, '
+        f'answer every image from 1 to {count} in order, and write nothing before the first marker.\n\n'
+        f'Instructions:\n{prompt}'
+    )
+
+
+def image_label(number):
+    return f'Image {number}:'
+
+
+def split_batch_output(text, count):
+    """Split a batched response into `count` outputs, or return None when it does not follow the format."""
+    matches = list(_MARKER_PATTERN.finditer(text or ''))
+    if [int(match.group(1)) for match in matches] != list(range(1, count + 1)):
+        return None
+    if text[:matches[0].start()].strip():
+        return None
+
+    outputs = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        output = text[match.end():end].strip()
+        if not output:
+            return None
+        outputs.append(output)
+    return outputs
@@ -0,0 +1,679 @@
+"""Throughput benchmark for the captioning pipeline against local mock servers.
+
+Starts a stand-in server speaking the llama.cpp, LM Studio or Ollama
+protocol with a fixed prefill latency and token rate, generates a
+synthetic image dataset and drives the real process_images_loop_*
+function over it. No GPU or model is needed, so runs are comparable
+across changes to encoding, the loops and the transport.
+
+    python scripts/benchmark.py --backend all --images 64 --size 2048x1536
+"""
+import argparse
+import base64
+import configparser
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+
+from PIL import Image
+
+import utils
+from batching import BATCH_MARKER
+from dataset import list_image_files
+from request_body import IMAGE_PLACEHOLDER, build_json_body
+
+BACKENDS = ('llama', 'lm_studio', 'ollama')
+BENCH_MODEL = 'bench-vision-model'
+BENCH_PROMPT = 'Describe this image in at most {max_words} words.'
+PROMPT_TOKENS = 300
+_WORDS = (
+    'a quiet street lined with old brick houses and bare trees under a pale winter sky '
+    'while two people in dark coats walk past a parked bicycle near the corner shop whose '
+    'window displays fresh bread colorful jars of jam and a small handwritten sign'
+).split()
+
+
+def _token_text(i):
+    return _WORDS[i % len(_WORDS)] + ' '
+
+
+def _count_images(request):
+    if isinstance(request.get('images'), list):
+        return len(request['images'])
+    parts = request.get('input') if isinstance(request.get('input'), list) else [
+        part for message in request.get('messages', []) if isinstance(message.get('content'), list) for part in message['content']
+    ]
+    return sum(1 for part in parts if isinstance(part, dict) and part.get('type') in ('image', 'image_url'))
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def _generate(self, on_token):
+        """Hold a server slot, wait out the prefill latency and produce tokens at the configured rate.
+
+        Requests carrying several images get one marked answer per image, in
+        the format batching.split_batch_output expects.
+        """
+        server = self.server
+        tokens = []
+        for number in range(1, self.image_count + 1):
+            if self.image_count > 1:
+                tokens.append(BATCH_MARKER.format(number=number) + '\n')
+            tokens.extend(_token_text(i) for i in range(server.output_tokens))
+            if self.image_count > 1:
+                tokens.append('\n')
+        self.output_token_count = len(tokens)
+        with server.slots:
+            time.sleep(server.latency)
+            started = time.monotonic()
+            parts = []
+            for i, token in enumerate(tokens):
+                parts.append(token)
+                if on_token is not None:
+                    on_token(token)
+                if server.token_rate > 0:
+                    delay = started + (i + 1) / server.token_rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        self.generation_seconds = max(1e-6, time.monotonic() - started)
+        return ''.join(parts).strip()
+
+    @property
+    def _tokens_per_second(self):
+        return self.output_token_count / self.generation_seconds
+
+    def do_GET(self):
+        if self.path in ('/health', '/v1/models'):
+            self._send_json({'status': 'ok'})
+        elif self.path == '/api/v1/models':
+            self._send_json({'models': [{
+                'key': BENCH_MODEL,
+                'type': 'llm',
+                'loaded_instances': [{'id': BENCH_MODEL}],
+                'capabilities': {'vision': True},
+            }]})
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json({'error': 'invalid JSON'}, status=400)
+            return
+        self.server.request_bytes += length
+        self.image_count = max(1, _count_images(request))
+        stream = bool(request.get('stream'))
+
+        if self.path == '/v1/chat/completions':
+            self.cached_tokens = self._cached_prefix_tokens(request)
+            self._chat_completions(stream)
+        elif self.path == '/api/v1/chat':
+            self._lm_studio_chat(stream)
+        elif self.path == '/api/show':
+            self._send_json({'capabilities': ['completion', 'vision']})
+        elif self.path == '/api/generate':
+            self._ollama_generate(stream)
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def _cached_prefix_tokens(self, request):
+        """Tokens of the leading instruction text the requested slot still holds from its previous request."""
+        slot = request.get('id_slot')
+        if not request.get('cache_prompt') or slot is None:
+            return 0
+        content = (request.get('messages') or [{}])[0].get('content') or [{}]
+        prefix = content[0].get('text', '') if isinstance(content[0], dict) else ''
+        with self.server.lock:
+            cached = self.server.slot_prefixes.get(slot) == prefix
+            self.server.slot_prefixes[slot] = prefix
+        return min(PROMPT_TOKENS - 1, len(prefix) // 4) if cached else 0
+
+    def _chat_completions(self, stream):
+        if not stream:
+            text = self._generate(None)
+            self._send_json({'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}}], 'timings': self._timings()})
+            return
+        self._start_chunked('text/event-stream')
+        self._generate(lambda token: self._write_chunk(
+            'data: ' + json.dumps({'choices': [{'index': 0, 'delta': {'content': token}}]}) + '\n\n'
+        ))
+        self._write_chunk('data: ' + json.dumps({'choices': [{'index': 0, 'delta': {}}], 'timings': self._timings()}) + '\n\n')
+        self._write_chunk('data: [DONE]\n\n')
+        self._end_chunked()
+
+    def _timings(self):
+        return {
+            'prompt_n': PROMPT_TOKENS - self.cached_tokens,
+            'cache_n': self.cached_tokens,
+            'predicted_n': self.output_token_count,
+            'predicted_per_second': self._tokens_per_second,
+        }
+
+    def _lm_studio_stats(self):
+        return {
+            'input_tokens': PROMPT_TOKENS,
+            'total_output_tokens': self.output_token_count,
+            'tokens_per_second': self._tokens_per_second,
+        }
+
+    def _ollama_stats(self):
+        return {
+            'prompt_eval_count': PROMPT_TOKENS,
+            'eval_count': self.output_token_count,
+            'eval_duration': int(self.generation_seconds * 1e9),
+        }
+
+    def _lm_studio_chat(self, stream):
+        if not stream:
+            text = self._generate(None)
+            self._send_json({'output': [{'type': 'message', 'content': text}], 'stats': self._lm_studio_stats()})
+            return
+        self._start_chunked('text/event-stream')
+        text = self._generate(lambda token: self._write_chunk(
+            'event: message.delta\ndata: ' + json.dumps({'type': 'message.delta', 'content': token}) + '\n\n'
+        ))
+        result = {'output': [{'type': 'message', 'content': text}], 'stats': self._lm_studio_stats()}
+        self._write_chunk('event: chat.end\ndata: ' + json.dumps({'type': 'chat.end', 'result': result}) + '\n\n')
+        self._end_chunked()
+
+    def _ollama_generate(self, stream):
+        if not stream:
+            text = self._generate(None)
+            self._send_json({'model': BENCH_MODEL, 'response': text, 'done': True, **self._ollama_stats()})
+            return
+        self._start_chunked('application/x-ndjson')
+        self._generate(lambda token: self._write_chunk(json.dumps({'response': token, 'done': False}) + '\n'))
+        self._write_chunk(json.dumps({'response': '', 'done': True, **self._ollama_stats()}) + '\n')
+        self._end_chunked()
+
+
+class MockInferenceServer(ThreadingHTTPServer):
+    """Local stand-in for llama-server, LM Studio and Ollama on one ephemeral port."""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.2, token_rate=50.0, output_tokens=40, slots=1):
+        super().__init__(('127.0.0.1', 0), _MockHandler)
+        self.latency = max(0.0, float(latency))
+        self.token_rate = max(0.0, float(token_rate))
+        self.output_tokens = max(1, int(output_tokens))
+        self.slots = threading.BoundedSemaphore(max(1, int(slots)))
+        self.request_bytes = 0
+        self.lock = threading.Lock()
+        self.slot_prefixes = {}
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients drop pooled or cancelled connections; that is not a benchmark failure.
+        if not isinstance(sys.exc_info()[1], (ConnectionError, OSError)):
+            super().handle_error(request, client_address)
+
+
+def generate_dataset(dataset_dir, count, width, height, formats=('jpg',), seed=0):
+    """Write `count` reproducible photo-like images and return their file names.
+
+    Images are upscaled low-resolution noise, which compresses and decodes
+    closer to real photos than flat colors or full-resolution noise.
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    rng = random.Random(seed)
+    file_names = []
+    for i in range(count):
+        extension = formats[i % len(formats)]
+        file_name = f'{i + 1}.{extension}'
+        path = os.path.join(dataset_dir, file_name)
+        file_names.append(file_name)
+        if os.path.exists(path):
+            continue
+        small = (max(1, width // 32), max(1, height // 32))
+        img = Image.frombytes('RGB', small, rng.randbytes(small[0] * small[1] * 3))
+        img = img.resize((width, height), Image.Resampling.BICUBIC)
+        if extension == 'png':
+            img.save(path, format='PNG')
+        else:
+            img.save(path, format='JPEG', quality=90)
+    return file_names
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None where it cannot be read."""
+    if sys.platform == 'win32':
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [
+                    ('cb', wintypes.DWORD),
+                    ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t),
+                    ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t),
+                    ('PeakPagefileUsage', ctypes.c_size_t),
+                ]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+                return int(counters.PeakWorkingSetSize)
+        except Exception:
+            pass
+        return None
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return int(peak if sys.platform == 'darwin' else peak * 1024)
+
+
+class _EventRecorder:
+    """Stand-in for stdout that timestamps the JSON messages the loops emit."""
+
+    def __init__(self):
+        self.events = []
+        self._buffer = ''
+
+    def write(self, text):
+        now = time.perf_counter()
+        self._buffer += text
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            try:
+                self.events.append((now, json.loads(line)))
+            except ValueError:
+                continue
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _EncodeTimer:
+    """Wraps utils.load_image_payload to total the time spent preparing image payloads."""
+
+    def __init__(self, encode):
+        self._encode = encode
+        self._lock = threading.Lock()
+        self.seconds = 0.0
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._encode(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.seconds += elapsed
+                self.count += 1
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(percent / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def _image_latencies(events):
+    """Per-image seconds from the request being issued to the output being written."""
+    started = {}
+    latencies = []
+    for timestamp, event in events:
+        if event.get('type') == 'status' and str(event.get('message', '')).startswith('Processing image '):
+            try:
+                started[int(event['message'].split()[2])] = timestamp
+            except (IndexError, ValueError):
+                continue
+        elif event.get('type') == 'image-complete':
+            for index in _completed_indexes(event):
+                if index in started:
+                    latencies.append(timestamp - started.pop(index))
+    return latencies
+
+
+def _completed_indexes(event):
+    data = event.get('data') or {}
+    index = data.get('index')
+    if not isinstance(index, int):
+        return []
+    return range(index, data.get('end', index) + 1)
+
+
+def _run_loop(backend, server_url, input_dir, output_dir, args):
+    loop_kwargs = {
+        'input_dir': input_dir,
+        'output_dir': output_dir,
+        'gen_type': 'captions',
+        'prompt_templates': {'captions': BENCH_PROMPT},
+        'max_words': 30,
+        'single_paragraph': True,
+        'resize_max': args.resize_max,
+        'image_format': args.image_format,
+        'request_pause_seconds': 0.0,
+        'preprocess_workers': args.preprocess_workers,
+        'prefetch_images': args.prefetch_images,
+        'decode_memory_mb': args.decode_memory_mb,
+        'images_per_request': args.images_per_request,
+    }
+
+    if backend == 'llama':
+        import llama_cpp_backend
+
+        llama_cpp_backend.LLAMA_CHAT_ENDPOINT = f'{server_url}/v1/chat/completions'
+        llama_cpp_backend.process_images_loop_llama(
+            {'timeout': 600, 'stream_output': args.stream},
+            parallel_slots=args.concurrency,
+            **loop_kwargs,
+        )
+    elif backend == 'lm_studio':
+        import lm_studio_backend
+
+        lm_studio_backend.process_images_loop_lm(
+            {'timeout': 600},
+            model_key=BENCH_MODEL,
+            stream_output=args.stream,
+            max_concurrency=args.concurrency,
+            adaptive_concurrency=args.adaptive,
+            base_urls=[server_url],
+            **loop_kwargs,
+        )
+    else:
+        import ollama_backend
+
+        config = configparser.ConfigParser(interpolation=None)
+        config.add_section('generation_params')
+        config.set('generation_params', 'timeout', '600')
+        ollama_backend.process_images_loop_ollama(
+            config,
+            model_key=BENCH_MODEL,
+            stream_output=args.stream,
+            max_concurrency=args.concurrency,
+            adaptive_concurrency=args.adaptive,
+            base_urls=[server_url],
+            **loop_kwargs,
+        )
+
+
+def run_benchmark(backend, dataset_dir, args):
+    """Run one backend loop over the dataset and return its measurements."""
+    server = MockInferenceServer(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        output_tokens=args.output_tokens,
+        slots=args.server_slots,
+    ).start()
+    output_dir = tempfile.mkdtemp(prefix='caption_bench_out_')
+    recorder = _EventRecorder()
+    encode_timer = _EncodeTimer(utils.load_image_payload)
+    original_stdout = sys.stdout
+    utils.load_image_payload = encode_timer
+    sys.stdout = recorder
+    try:
+        started = time.perf_counter()
+        _run_loop(backend, server.url, dataset_dir, output_dir, args)
+        wall_seconds = time.perf_counter() - started
+    finally:
+        sys.stdout = original_stdout
+        utils.load_image_payload = encode_timer._encode
+        server.stop()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    completed = sum(len(_completed_indexes(event)) for _timestamp, event in recorder.events if event.get('type') == 'image-complete')
+    latencies = _image_latencies(recorder.events)
+    return {
+        'backend': backend,
+        'images': completed,
+        'wall_seconds': wall_seconds,
+        'images_per_second': completed / wall_seconds if wall_seconds > 0 else 0.0,
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p95': _percentile(latencies, 95),
+        'latency_p99': _percentile(latencies, 99),
+        'preprocess_seconds': encode_timer.seconds,
+        'preprocess_per_image': encode_timer.seconds / encode_timer.count if encode_timer.count else None,
+        'request_megabytes': server.request_bytes / (1024 * 1024),
+        'peak_rss_megabytes': (peak_rss_bytes() or 0) / (1024 * 1024) or None,
+    }
+
+
+def _replace_placeholder(value, replacement):
+    if value == IMAGE_PLACEHOLDER:
+        return replacement
+    if isinstance(value, dict):
+        return {key: _replace_placeholder(item, replacement) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_replace_placeholder(item, replacement) for item in value]
+    return value
+
+
+def _legacy_request_body(payload, image_bytes, mime_type):
+    """The body as it was built before request_body: base64 string, data URL, then json=payload."""
+    image_bytes = bytes(image_bytes)
+    base64_image = base64.b64encode(image_bytes).decode('utf-8')
+    data_url = f'data:{mime_type};base64,{base64_image}'
+    return json.dumps(_replace_placeholder(payload, data_url), allow_nan=False).encode('utf-8')
+
+
+def _measure(build):
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        body = build()
+        seconds = time.perf_counter() - started
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return len(body), seconds, peak
+
+
+def run_request_body_benchmark(dataset_dir, args):
+    """Compare peak memory and time of building one request body, legacy path against build_json_body."""
+    payload = {
+        'model': BENCH_MODEL,
+        'messages': [{'role': 'user', 'content': [
+            {'type': 'text', 'text': BENCH_PROMPT},
+            {'type': 'image_url', 'image_url': {'url': IMAGE_PLACEHOLDER}},
+        ]}],
+        'stream': False,
+    }
+    totals = {'legacy': [0, 0.0, 0], 'builder': [0, 0.0, 0]}
+    images = list_image_files(dataset_dir)
+    for image_file in images:
+        image_bytes, mime_type = utils.load_image_payload(
+            os.path.join(dataset_dir, image_file), args.resize_max, args.image_format,
+        )
+        prefix = f'data:{mime_type};base64,'
+        for name, build in (
+            ('legacy', lambda: _legacy_request_body(payload, image_bytes, mime_type)),
+            ('builder', lambda: build_json_body(payload, image_bytes, prefix=prefix)),
+        ):
+            size, seconds, peak = _measure(build)
+            totals[name][0] += size
+            totals[name][1] += seconds
+            totals[name][2] += peak
+
+    count = max(1, len(images))
+    return [
+        {
+            'path': name,
+            'images': len(images),
+            'body_megabytes': size / count / (1024 * 1024),
+            'build_seconds': seconds / count,
+            'peak_megabytes': peak / count / (1024 * 1024),
+        }
+        for name, (size, seconds, peak) in totals.items()
+    ]
+
+
+def print_request_body_report(results):
+    print(f"{'path':<10} {'body MB':>8} {'peak MB':>8} {'build':>8}")
+    for result in results:
+        print(
+            f"{result['path']:<10} {result['body_megabytes']:>8.2f} {result['peak_megabytes']:>8.2f} "
+            f"{_format_seconds(result['build_seconds']):>8}"
+        )
+
+
+def _format_seconds(value):
+    return '-' if value is None else f'{value * 1000:.0f} ms'
+
+
+def print_report(results, args):
+    print(
+        f'{args.images} images at {args.size}, latency {args.latency}s, '
+        f'{args.output_tokens} tokens at {args.token_rate}/s, concurrency {args.concurrency}, '
+        f'server slots {args.server_slots}, stream {args.stream}'
+    )
+    header = f"{'backend':<10} {'img/s':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'prep/img':>9} {'sent MB':>8} {'peak RSS':>9}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        rss = result.get('peak_rss_megabytes')
+        print(
+            f"{result['backend']:<10} {result['images_per_second']:>7.2f} "
+            f"{_format_seconds(result['latency_p50']):>8} {_format_seconds(result['latency_p95']):>8} "
+            f"{_format_seconds(result['latency_p99']):>8} {_format_seconds(result['preprocess_per_image']):>9} "
+            f"{result['request_megabytes']:>8.1f} {('-' if rss is None else f'{rss:.0f} MB'):>9}"
+        )
+
+
+def _parse_size(value):
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('size must look like 2048x1536')
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError('size must be positive')
+    return width, height
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the captioning loops against local mock inference servers.')
+    parser.add_argument('--backend', choices=BACKENDS + ('all',), default='all')
+    parser.add_argument('--images', type=int, default=32, help='number of synthetic images')
+    parser.add_argument('--size', default='2048x1536', help='synthetic image resolution, WIDTHxHEIGHT')
+    parser.add_argument('--formats', default='jpg', help='comma-separated dataset formats, e.g. jpg,png')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dataset-dir', default='', help='keep and reuse the dataset in this folder')
+    parser.add_argument('--latency', type=float, default=0.2, help='mock prefill latency in seconds')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='mock output tokens per second (0 = instant)')
+    parser.add_argument('--output-tokens', type=int, default=40, help='mock output tokens per image')
+    parser.add_argument('--server-slots', type=int, default=1, help='requests the mock server runs at once')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel_slots / max_concurrency for the loop')
+    parser.add_argument('--no-adaptive', dest='adaptive', action='store_false', help='disable adaptive concurrency')
+    parser.add_argument('--stream', action='store_true', help='use streaming generation')
+    parser.add_argument('--resize-max', type=int, default=1280)
+    parser.add_argument('--image-format', default='auto')
+    parser.add_argument('--preprocess-workers', type=int, default=2)
+    parser.add_argument('--prefetch-images', type=int, default=4)
+    parser.add_argument('--images-per-request', type=int, default=1, help='images sent in one multi-image request')
+    parser.add_argument('--decode-memory-mb', type=float, default=0, help='per-image decode budget (0 = no cap)')
+    parser.add_argument('--request-body', action='store_true', help='only compare request body construction per image')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    width, height = _parse_size(args.size)
+    formats = tuple(part.strip().lower() for part in args.formats.split(',') if part.strip()) or ('jpg',)
+
+    dataset_dir = args.dataset_dir or tempfile.mkdtemp(prefix='caption_bench_data_')
+    try:
+        generate_dataset(dataset_dir, args.images, width, height, formats=formats, seed=args.seed)
+
+        if args.request_body:
+            results = run_request_body_benchmark(dataset_dir, args)
+        elif args.backend == 'all':
+            # One process per backend so peak RSS is not shared between runs.
+            results = []
+            child_args = [arg for arg in (argv if argv is not None else sys.argv[1:]) if arg != '--json']
+            for backend in BACKENDS:
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), *child_args,
+                     '--backend', backend, '--dataset-dir', dataset_dir, '--json'],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                results.extend(json.loads(output))
+        else:
+            results = [run_benchmark(args.backend, dataset_dir, args)]
+    finally:
+        if not args.dataset_dir:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    elif args.request_body:
+        print_request_body_report(results)
+    else:
+        print_report(results, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,32 @@
 import os
 import sys
 import configparser
+import importlib
+import io
+import json
 import traceback
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 if SCRIPT_DIR not in sys.path:
     sys.path.insert(0, SCRIPT_DIR)
 
-from utils import send_json_message
-from lm_studio_backend import run_lm_studio_generation
-from llama_cpp_backend import run_llama_cpp_generation
-from ollama_backend import run_ollama_generation
+from dataset import (
+    MANIFEST_STDIN,
+    OUTPUT_LOCATIONS,
+    OUTPUT_MODES,
+    image_manifest_from_paths,
+    is_image_manifest,
+    read_image_manifest,
+)
+from events import configure_events, flush_events, message_context, send_json_message
+
+WORKER_FLAG = "--worker"
+# Backend modules are imported only when a job selects them.
+BACKEND_MODULES = {
+    "llama_cpp": ("llama_cpp_backend", "run_llama_cpp_generation"),
+    "lm_studio": ("lm_studio_backend", "run_lm_studio_generation"),
+    "ollama": ("ollama_backend", "run_ollama_generation"),
+}
 
 def get_backend_config_section(desired_model_key):
     if desired_model_key == "Custom (LM Studio)":
@@ -20,7 +36,13 @@ def get_backend_config_section(desired_model_key):
     return "llama_cpp"
 
 
-def build_runtime_config(config, backend_section):
+def load_backend(section):
+    """Import the backend for a config section on first use and return its run function."""
+    module_name, function_name = BACKEND_MODULES[section]
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def build_runtime_config(config, backend_section, config_dir=''):
     runtime_config = configparser.RawConfigParser()
 
     if config.has_section('prompts'):
@@ -28,6 +50,19 @@ def build_runtime_config(config, backend_section):
         for key, value in config.items('prompts'):
             runtime_config.set('prompts', key, value)
 
+    if config.has_section('cache'):
+        runtime_config.add_section('cache')
+        for key, value in config.items('cache'):
+            runtime_config.set('cache', key, value)
+        cache_dir = runtime_config.get('cache', 'cache_dir', fallback='').strip()
+        if cache_dir and not os.path.isabs(cache_dir):
+            runtime_config.set('cache', 'cache_dir', os.path.join(config_dir, cache_dir))
+
+    if config.has_section('dataset'):
+        runtime_config.add_section('dataset')
+        for key, value in config.items('dataset'):
+            runtime_config.set('dataset', key, value)
+
     runtime_config.add_section('generation_params')
     source_section = backend_section if config.has_section(backend_section) else 'generation_params'
     if config.has_section(source_section):
@@ -37,76 +72,203 @@ def build_runtime_config(config, backend_section):
     return runtime_config
 
 
-def main():
-    try:
-        if len(sys.argv) < 14:
-            raise ValueError("Insufficient arguments.")
-        
-        input_dir, output_dir, config_path, llama_server_exe, models_dir, desired_model_key, \
-        low_vram_str, gen_type, trigger_words, single_paragraph_str, max_words_str, \
-        prompt_enrichment, _mode = sys.argv[1:14]
-        lm_studio_model_key = sys.argv[14] if len(sys.argv) > 14 else ""
-        ollama_model_key = sys.argv[15] if len(sys.argv) > 15 else ""
-        custom_prompt = sys.argv[16] if len(sys.argv) > 16 else ""
-        disable_thinking = sys.argv[17].lower() == 'true' if len(sys.argv) > 17 else False
-
-        shared_params = {
-            "input_dir": input_dir, 
-            "output_dir": output_dir, 
-            "gen_type": gen_type, 
-            "max_words": int(max_words_str), 
-            "trigger_words": trigger_words, 
-            "single_paragraph": single_paragraph_str.lower() == 'true', 
-            "prompt_enrichment": prompt_enrichment
-        }
-        
-        config = configparser.RawConfigParser()
-        if not os.path.exists(config_path):
-            raise FileNotFoundError(f"Config file not found: {config_path}")
-        config.read(config_path)
-        config = build_runtime_config(config, get_backend_config_section(desired_model_key))
-        
-        prompt_templates = {
-            'captions': config.get('prompts', 'captions', fallback=""),
-            'tags': config.get('prompts', 'tags', fallback=""),
-            'json': config.get('prompts', 'json', fallback=""),
-            'yaml': config.get('prompts', 'yaml', fallback=""),
-            'illustrious': config.get('prompts', 'illustrious', fallback=""),
-            'custom': config.get('prompts', 'custom', fallback=""),
-        }
+JOB_FIELDS = (
+    "input_dir",
+    "output_dir",
+    "config_path",
+    "llama_server_exe",
+    "models_dir",
+    "desired_model_key",
+    "low_vram",
+    "gen_type",
+    "trigger_words",
+    "single_paragraph",
+    "max_words",
+    "prompt_enrichment",
+    "mode",
+    "lm_studio_model_key",
+    "ollama_model_key",
+    "custom_prompt",
+    "disable_thinking",
+    "retry_failed_from",
+)
+REQUIRED_JOB_FIELDS = 13
+
+
+def _as_bool(value):
+    return value if isinstance(value, bool) else str(value).strip().lower() == 'true'
+
+
+def parse_job_args(args):
+    """Map the positional command line arguments to a job description."""
+    if len(args) < REQUIRED_JOB_FIELDS:
+        raise ValueError("Insufficient arguments.")
+    return dict(zip(JOB_FIELDS, args))
+
+
+def run_job(job, keep_server=False):
+    """Run one captioning job described by the JOB_FIELDS keys of `job`.
+
+    An "image_files" list of absolute image paths, when given, replaces
+    input_dir as the source of images.
+    """
+    missing = [field for field in JOB_FIELDS[:REQUIRED_JOB_FIELDS] if field not in job]
+    if missing:
+        raise ValueError(f"Job is missing: {', '.join(missing)}")
+
+    input_dir = job["input_dir"]
+    output_dir = job["output_dir"]
+    config_path = job["config_path"]
+    desired_model_key = job["desired_model_key"]
+    backend_section = get_backend_config_section(desired_model_key)
+    gen_type = job["gen_type"]
+    custom_prompt = job.get("custom_prompt") or ""
+
+    image_files = None
+    if job.get("image_files") is not None:
+        input_dir, image_files, skipped = image_manifest_from_paths(job["image_files"])
+        if skipped:
+            send_json_message("status", f"Skipping {skipped} listed files that are not image files.")
+    elif is_image_manifest(input_dir):
+        input_dir, image_files, skipped = read_image_manifest(input_dir)
+        if skipped:
+            send_json_message("status", f"Skipping {skipped} manifest entries that are not image files.")
+
+    shared_params = {
+        "input_dir": input_dir, 
+        "output_dir": output_dir, 
+        "gen_type": gen_type, 
+        "max_words": int(job["max_words"]), 
+        "trigger_words": job["trigger_words"], 
+        "single_paragraph": _as_bool(job["single_paragraph"]), 
+        "prompt_enrichment": job["prompt_enrichment"],
+        "image_files": image_files,
+    }
+    
+    config = configparser.RawConfigParser()
+    if not os.path.exists(config_path):
+        raise FileNotFoundError(f"Config file not found: {config_path}")
+    config.read(config_path)
+    config = build_runtime_config(
+        config,
+        backend_section,
+        config_dir=os.path.dirname(os.path.abspath(config_path)),
+    )
+    configure_events(config.getfloat('generation_params', 'event_interval', fallback=0.25))
+    
+    prompt_templates = {
+        'captions': config.get('prompts', 'captions', fallback=""),
+        'tags': config.get('prompts', 'tags', fallback=""),
+        'json': config.get('prompts', 'json', fallback=""),
+        'yaml': config.get('prompts', 'yaml', fallback=""),
+        'illustrious': config.get('prompts', 'illustrious', fallback=""),
+        'custom': config.get('prompts', 'custom', fallback=""),
+    }
+    if gen_type == 'custom':
+        prompt_templates['custom'] = custom_prompt.strip() or prompt_templates['custom'].strip()
+    if gen_type not in prompt_templates:
+        raise ValueError(f"Unknown generation type: {gen_type}")
+    if not prompt_templates[gen_type]:
         if gen_type == 'custom':
-            prompt_templates['custom'] = custom_prompt.strip() or prompt_templates['custom'].strip()
-        if gen_type not in prompt_templates:
-            raise ValueError(f"Unknown generation type: {gen_type}")
-        if not prompt_templates[gen_type]:
-            if gen_type == 'custom':
-                raise ValueError("Missing Custom prompt. Enter a Custom Prompt before starting generation.")
-            raise ValueError(f"Missing prompt for generation type: {gen_type}")
-
-        # Prompt text now comes only from the selected backend config.
-
-        shared_params.update({
-            'prompt_templates': prompt_templates
-        })
-        
-        # Routing to specialized backends
-        if desired_model_key == "Custom (LM Studio)":
-            run_lm_studio_generation(config, selected_model_key=lm_studio_model_key, **shared_params)
-        elif desired_model_key == "Custom (Ollama)":
-            run_ollama_generation(config, selected_model_key=ollama_model_key, **shared_params)
-        else:
-            run_llama_cpp_generation(
-                config,
-                llama_server_exe,
-                models_dir,
-                desired_model_key,
-                low_vram_str.lower() == 'true',
-                disable_thinking=disable_thinking,
-                **shared_params
-            )
-        
-        send_json_message("status", "Task complete!")
+            raise ValueError("Missing Custom prompt. Enter a Custom Prompt before starting generation.")
+        raise ValueError(f"Missing prompt for generation type: {gen_type}")
+
+    # Prompt text now comes only from the selected backend config.
+
+    shared_params.update({
+        'prompt_templates': prompt_templates,
+        'recursive': config.getboolean('dataset', 'recursive', fallback=False),
+        'file_order': config.get('dataset', 'file_order', fallback='natural').strip().lower(),
+        'dedupe': config.getboolean('dataset', 'dedupe', fallback=False),
+        'dedupe_distance': config.getint('dataset', 'dedupe_distance', fallback=3),
+        'output_mode': config.get('dataset', 'output_mode', fallback='files').strip().lower(),
+    })
+    if shared_params['output_mode'] not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output_mode '{shared_params['output_mode']}'. Use one of: {', '.join(OUTPUT_MODES)}.")
+
+    output_location = config.get('dataset', 'output_location', fallback='output_dir').strip().lower()
+    if output_location not in OUTPUT_LOCATIONS:
+        raise ValueError(f"Unknown output_location '{output_location}'. Use one of: {', '.join(OUTPUT_LOCATIONS)}.")
+    if output_location == 'beside_source':
+        shared_params['output_dir'] = input_dir
+
+    retry_failed_from = job.get("retry_failed_from") or ""
+    if retry_failed_from:
+        from dead_letters import read_failed_images
+        if not os.path.exists(retry_failed_from):
+            raise FileNotFoundError(f"Failed image list not found: {retry_failed_from}")
+        image_files = read_failed_images(retry_failed_from, input_dir, image_files)
+        if not image_files:
+            raise ValueError(f"No failed images for this input were found in {retry_failed_from}.")
+        send_json_message("status", f"Reprocessing {len(image_files)} images that failed in an earlier run.")
+        shared_params['image_files'] = image_files
+    
+    # Routing to specialized backends
+    run_generation = load_backend(backend_section)
+    if backend_section != "llama_cpp":
+        run_generation(config, selected_model_key=job.get(f"{backend_section}_model_key") or "", **shared_params)
+    else:
+        run_generation(
+            config,
+            job["llama_server_exe"],
+            job["models_dir"],
+            desired_model_key,
+            _as_bool(job["low_vram"]),
+            disable_thinking=_as_bool(job.get("disable_thinking", False)),
+            keep_server=keep_server,
+            **shared_params
+        )
+    
+    send_json_message("status", "Task complete!")
+    flush_events()
+
+
+def run_worker(stream):
+    """Run jobs read as JSON lines from `stream` until it closes.
 
+    Each line is an object with a "job_id" and either the JOB_FIELDS keys or
+    "args", the positional command line arguments, plus an optional
+    "image_files" list. stdin carries the jobs, so a job cannot read its
+    image manifest from it with input_dir "-". Every message of a job
+    carries its job_id; a job ends with a "Task complete!" status or an error,
+    and a failed job does not stop the worker. Imported modules and a running
+    llama-server stay warm between jobs.
+    """
+    send_json_message("status", "Worker ready.")
+    try:
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("A job must be a JSON object.")
+            except ValueError as e:
+                send_json_message("error", f"Invalid job: {e}")
+                continue
+
+            with message_context(job_id=job.get("job_id")):
+                try:
+                    if "args" in job:
+                        job = {**parse_job_args(job["args"]), **{key: value for key, value in job.items() if key != "args"}}
+                    if job.get("input_dir") == MANIFEST_STDIN and job.get("image_files") is None:
+                        raise ValueError("A worker job cannot read its image manifest from stdin. Pass an '@' manifest file or an image_files list.")
+                    run_job(job, keep_server=True)
+                except Exception as e:
+                    send_json_message("error", f"{str(e)}\n{traceback.format_exc()}")
+    finally:
+        llama_server = sys.modules.get("llama_server")
+        if llama_server is not None:
+            llama_server.release_held_server()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == WORKER_FLAG:
+        run_worker(io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig'))
+        return
+
+    try:
+        run_job(parse_job_args(sys.argv[1:]))
     except Exception as e:
         send_json_message("error", f"{str(e)}\n{traceback.format_exc()}")
         sys.exit(1)
@@ -0,0 +1,124 @@
+import time
+from collections import deque
+
+from dataset import ImageFileWalk
+from dead_letters import DeadLetterList
+from events import send_json_message
+from output_writer import OutputWriter
+from result_cache import iter_pending_images
+from telemetry import RunSummary
+from utils import ThroughputEstimate, build_progress_payload, build_user_prompt, format_generation_output
+
+
+class CaptionRun:
+    """The per-run bookkeeping every backend loop shares.
+
+    Walks (and optionally dedupes) the input images, builds the prompt, and
+    turns each image's outcome into its written output, dead-letter entry,
+    progress events and run summary line. Outcomes must be reported in input
+    order; cache hits found while the encoder reads ahead are held back until
+    every earlier image has been reported. close() writes the summary and the
+    dead-letter list and publishes the outputs.
+    """
+
+    def __init__(self, backend, model, settings, retry_policy, result_index=None, preprocess_workers=2, decode_memory_mb=0, **kwargs):
+        self.input_dir = kwargs['input_dir']
+        self.output_dir = kwargs['output_dir']
+        self.gen_type = kwargs['gen_type']
+        self.result_index = result_index
+        self._format_args = (kwargs['max_words'], kwargs['single_paragraph'], kwargs.get('trigger_words', ''))
+
+        self.image_walk = ImageFileWalk(
+            self.input_dir, recursive=kwargs.get('recursive', False), order=kwargs.get('file_order', 'natural'),
+            image_files=kwargs.get('image_files'),
+        )
+        self.duplicates = {}
+        if kwargs.get('dedupe'):
+            from dedupe import deduplicate_walk
+            self.image_walk, self.duplicates = deduplicate_walk(
+                self.input_dir, self.image_walk, kwargs.get('dedupe_distance', 3), workers=preprocess_workers,
+                decode_memory_mb=decode_memory_mb,
+            )
+        self.prompt = build_user_prompt(
+            self.gen_type,
+            kwargs['prompt_templates'][self.gen_type],
+            kwargs['max_words'],
+            kwargs.get('trigger_words', ''),
+            kwargs.get('prompt_enrichment', ''),
+        )
+
+        self.start_time = time.time()
+        self.throughput = ThroughputEstimate(self.start_time)
+        self.completed = 0
+        self.reused = 0
+        self._cached = deque()
+        self.summary = RunSummary(backend, model, self.image_walk.total, settings)
+        self.writer = OutputWriter(self.output_dir, self.input_dir, self.gen_type, mode=kwargs.get('output_mode', 'files'))
+        self.dead_letters = DeadLetterList(self.output_dir, self.input_dir, retry_policy.max_consecutive_failures)
+
+    @property
+    def total(self):
+        return self.image_walk.total
+
+    def pending_images(self, model_identity, request_params):
+        """(index, image_file, result_key) for every image that still needs a request."""
+        return iter_pending_images(
+            self.result_index, self.input_dir, self.image_walk, model_identity, self.prompt, request_params,
+            lambda index, image_file, raw_output: self._cached.append((index, image_file, raw_output)),
+        )
+
+    def complete_cached(self, before=None):
+        """Report the held-back cache hits, or only those ahead of image number `before`."""
+        while self._cached and (before is None or self._cached[0][0] < before):
+            if not self.reused:
+                send_json_message('status', 'Reusing unchanged results from the cache...')
+            self.reused += 1
+            self._complete(*self._cached.popleft())
+
+    def _complete(self, index, image_file, raw_output, telemetry=None):
+        self.completed += 1
+        final_output = format_generation_output(self.gen_type, raw_output, *self._format_args)
+        duplicates = self.duplicates.get(image_file, ())
+        self.writer.write(image_file, final_output, duplicates, telemetry)
+        self.dead_letters.succeeded(image_file, duplicates)
+        self.summary.add(index, image_file, telemetry, cached=telemetry is None)
+        send_json_message('progress', build_progress_payload(self.completed, self.total, self.start_time, telemetry, self.throughput))
+        send_json_message('image-complete', {'index': index})
+
+    def finish(self, index, image_file, raw_output, result_key=None, telemetry=None):
+        """Report one image's output, or its error when raw_output is an exception."""
+        if isinstance(raw_output, Exception):
+            self.fail(index, image_file, raw_output)
+            return
+        self.complete_cached(index)
+        if self.result_index is not None and result_key is not None:
+            self.result_index.store(result_key, raw_output)
+        self._complete(index, image_file, raw_output, telemetry)
+
+    def fail(self, index, image_file, error):
+        self.complete_cached(index)
+        self.completed += 1
+        self.dead_letters.add(index, image_file, error, self.duplicates.get(image_file, ()))
+        send_json_message('progress', build_progress_payload(self.completed, self.total, self.start_time, None, self.throughput))
+        send_json_message('image-complete', {'index': index})
+
+    def on_result(self, group, raw_outputs):
+        """run_adaptive callback for a group of ((index, image_file, result_key), encoded image) items."""
+        for ((index, image_file, result_key), (_image_file, _image_bytes, _mime_type, telemetry)), raw_output in zip(group, raw_outputs):
+            self.finish(index, image_file, raw_output, result_key, telemetry)
+
+    def on_failure(self, group, error):
+        """run_adaptive callback for a group that failed for good; images that failed to load keep their own error."""
+        for (index, image_file, _result_key), (_image_file, image_bytes, _mime_type, _telemetry) in group:
+            self.fail(index, image_file, image_bytes if isinstance(image_bytes, Exception) else error)
+
+    def close(self, finished):
+        """Write the summary and the dead-letter list, and publish the outputs if the run finished."""
+        self.summary.total_images = self.total
+        self.summary.duplicate_images = sum(len(files) for files in self.duplicates.values())
+        self.summary.failed_images = self.dead_letters.failed
+        try:
+            self.writer.close(publish=finished)
+        finally:
+            self.summary.write(self.output_dir)
+            self.dead_letters.write()
@@ -0,0 +1,180 @@
+import os
+import re
+import sys
+import threading
+from itertools import chain
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+FILE_ORDERS = ('natural', 'sharded', 'none')
+OUTPUT_LOCATIONS = ('output_dir', 'beside_source')
+OUTPUT_MODES = ('files', 'metadata', 'both')
+# An input argument of '-' reads the manifest from stdin, '@path' from a file.
+MANIFEST_STDIN = '-'
+MANIFEST_FILE_PREFIX = '@'
+
+
+def natural_file_name_key(file_name):
+    return [
+        int(part) if part.isdigit() else part.lower()
+        for part in re.split(r'(\d+)', file_name)
+    ]
+
+
+def image_path_sort_key(image_file):
+    # Files of a folder sort before its subfolders, so a global sort matches the sharded walk.
+    folder, file_name = os.path.split(image_file)
+    folders = [natural_file_name_key(part) for part in folder.split(os.sep)] if folder else []
+    return folders, natural_file_name_key(file_name)
+
+
+def _walk_image_files(input_dir, recursive=False, sort=False):
+    folders = ['']
+    while folders:
+        folder = folders.pop()
+        subfolders = []
+        image_files = []
+        try:
+            with os.scandir(os.path.join(input_dir, folder)) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                        image_file = os.path.join(folder, entry.name) if folder else entry.name
+                        if sort:
+                            image_files.append(image_file)
+                        else:
+                            yield image_file
+                    elif recursive and entry.is_dir(follow_symlinks=False):
+                        subfolders.append(os.path.join(folder, entry.name) if folder else entry.name)
+        except OSError:
+            if not folder:
+                raise
+            continue
+
+        if sort:
+            image_files.sort(key=natural_file_name_key)
+            yield from image_files
+            subfolders.sort(key=image_path_sort_key, reverse=True)
+        folders.extend(subfolders)
+
+
+def iter_image_files(input_dir, recursive=False, order='natural'):
+    """Yield image paths relative to input_dir.
+
+    'natural' lists every image and sorts them before yielding the first one.
+    'sharded' yields the same order lazily, sorting one folder at a time, and
+    'none' yields images in the order the file system lists them.
+    """
+    if order not in FILE_ORDERS:
+        raise ValueError(f'Unknown file_order {order!r}. Use one of: {", ".join(FILE_ORDERS)}.')
+    if order == 'natural':
+        yield from sorted(_walk_image_files(input_dir, recursive), key=image_path_sort_key)
+    else:
+        yield from _walk_image_files(input_dir, recursive, sort=order == 'sharded')
+
+
+def list_image_files(input_dir, recursive=False):
+    return list(iter_image_files(input_dir, recursive=recursive))
+
+
+def is_image_manifest(input_arg):
+    return input_arg == MANIFEST_STDIN or input_arg.startswith(MANIFEST_FILE_PREFIX)
+
+
+def _read_manifest_lines(input_arg):
+    if input_arg == MANIFEST_STDIN:
+        return sys.stdin.buffer.read().decode('utf-8-sig').splitlines()
+    with open(input_arg[len(MANIFEST_FILE_PREFIX):], 'r', encoding='utf-8-sig') as f:
+        return f.read().splitlines()
+
+
+def read_image_manifest(input_arg):
+    """Read absolute image paths, one per line, from a manifest file ('@path') or stdin ('-').
+
+    Returns what image_manifest_from_paths returns for those lines.
+    """
+    return image_manifest_from_paths(_read_manifest_lines(input_arg))
+
+
+def image_manifest_from_paths(entries):
+    """Resolve a list of absolute image paths to (root, image_files, skipped).
+
+    root is the deepest folder that contains every image, image_files are
+    the image paths relative to it in list order, and skipped counts the
+    entries that were not existing image files. Blank entries and entries
+    starting with '#' are ignored.
+    """
+    paths = []
+    skipped = 0
+    seen = set()
+    for entry in entries:
+        path = str(entry).strip()
+        if not path or path.startswith('#'):
+            continue
+        if not os.path.isabs(path):
+            raise ValueError(f'Image manifest entries must be absolute paths: {path}')
+        path = os.path.normpath(path)
+        if path in seen:
+            continue
+        if not path.lower().endswith(IMAGE_EXTENSIONS) or not os.path.isfile(path):
+            skipped += 1
+            continue
+        seen.add(path)
+        paths.append(path)
+
+    if not paths:
+        raise ValueError('No images found in the image manifest.')
+    try:
+        root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    except ValueError:
+        raise ValueError('Image manifest paths must all be on the same drive.')
+    return root, [os.path.relpath(path, root) for path in paths], skipped
+
+
+class ImageFileWalk:
+    """The images of one run, iterated once.
+
+    Lazy orders start yielding immediately and count the images in a
+    background thread, so `total` grows until the count finishes. A given
+    list of image_files is used as is, in its own order.
+    """
+
+    def __init__(self, input_dir, recursive=False, order='natural', image_files=None):
+        if image_files is not None:
+            order = 'natural'
+            files = iter(image_files)
+        else:
+            files = iter_image_files(input_dir, recursive=recursive, order=order)
+        first = next(files, None)
+        if first is None:
+            raise ValueError('No images found in the input folder.')
+        self._files = chain([first], files)
+        self._yielded = 0
+
+        if order == 'natural':
+            # The sorted listing is already in memory; count it without walking again.
+            self._files = list(self._files)
+            self._count = len(self._files)
+            self.counting = False
+            return
+
+        self._count = 0
+        self.counting = True
+        thread = threading.Thread(target=self._count_images, args=(input_dir, recursive), daemon=True)
+        thread.start()
+
+    def _count_images(self, input_dir, recursive):
+        try:
+            for _image_file in _walk_image_files(input_dir, recursive):
+                self._count += 1
+        except OSError:
+            pass
+        finally:
+            self.counting = False
+
+    @property
+    def total(self):
+        return max(self._count, self._yielded)
+
+    def __iter__(self):
+        for image_file in self._files:
+            self._yielded += 1
+            yield image_file
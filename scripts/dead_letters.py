@@ -0,0 +1,147 @@
+import json
+import os
+import uuid
+
+from dispatch import RetriesExhausted, is_retryable_error
+from events import send_json_message
+
+FAILED_IMAGES_FILE = '.caption_creator_failed_images.jsonl'
+
+
+def failed_images_path(output_dir):
+    return os.path.join(output_dir, FAILED_IMAGES_FILE)
+
+
+def _read_entries(path):
+    entries = {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(entry, dict) and entry.get('path'):
+                    entries[os.path.normpath(entry['path'])] = entry
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+class DeadLetterList:
+    """Images whose latest attempt failed, kept in the output folder so a batch can go on without them.
+
+    The list starts from the one an earlier run left behind: an image that
+    succeeds is taken off it and an image that fails is put on it, so after
+    any run, finished or not, it names exactly the images that still need
+    another try. add() raises once max_consecutive images in a row have
+    failed (0 = never).
+    """
+
+    def __init__(self, output_dir, input_dir, max_consecutive=0):
+        self.output_dir = output_dir
+        self.input_dir = input_dir
+        self.max_consecutive = max(0, int(max_consecutive or 0))
+        self.path = failed_images_path(output_dir)
+        self.entries = _read_entries(self.path)
+        self.failed = 0
+        self.consecutive = 0
+        self._changed = False
+
+    def _image_path(self, image_file):
+        return os.path.normpath(os.path.abspath(os.path.join(self.input_dir, image_file)))
+
+    def succeeded(self, image_file, duplicates=()):
+        self.consecutive = 0
+        if not self.entries:
+            return
+        for target_file in (image_file, *duplicates):
+            if self.entries.pop(self._image_path(target_file), None) is not None:
+                self._changed = True
+
+    def add(self, index, image_file, error, duplicates=()):
+        attempts = 1
+        if isinstance(error, RetriesExhausted):
+            attempts = error.attempts
+            error = error.error
+        entry = {
+            'index': index,
+            'error': str(error),
+            'error_type': type(error).__name__,
+            'retryable': is_retryable_error(error),
+            'attempts': attempts,
+        }
+        for target_file in (image_file, *duplicates):
+            path = self._image_path(target_file)
+            self.entries[path] = {'path': path, 'file': target_file, **entry}
+        self._changed = True
+        self.failed += 1
+        self.consecutive += 1
+        tries = f' after {attempts} attempts' if attempts > 1 else ''
+        send_json_message('status', f'Skipping image {index} ({image_file}){tries}: {error}')
+        if self.max_consecutive and self.consecutive >= self.max_consecutive:
+            raise RuntimeError(f'Stopping after {self.consecutive} images in a row failed. Last error: {error}')
+
+    def write(self):
+        """Save the list, or remove it when nothing is left to retry, and report this run's failures.
+
+        Returns the list's path, or None when there is no list.
+        """
+        path = self._save()
+        if self.failed:
+            where = f'listed in {path}' if path else 'could not be listed'
+            send_json_message(
+                'status',
+                f'{self.failed} images failed and were skipped; they are {where}. '
+                'Use Retry Failed in the queue, or pass that list as the retry_failed_from job field, to run only those again.',
+            )
+        return path
+
+    def _save(self):
+        if not self._changed:
+            return self.path if self.entries else None
+        if not self.entries:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            return None
+
+        temp_path = f'{self.path}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            os.replace(temp_path, self.path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+        return self.path
+
+
+def read_failed_images(source, input_dir, image_files=None):
+    """Images under input_dir that a dead-letter list names, relative to input_dir.
+
+    source is the list file or the output folder it was written to. Entries
+    whose image is gone from where it was listed, like a run's staged copies,
+    are matched by their path relative to the folder they were listed under.
+    With image_files, only those images are considered and they keep that
+    order; otherwise the list order is kept. Entries for images outside
+    input_dir or no longer on disk are left out.
+    """
+    root = os.path.normpath(os.path.abspath(input_dir))
+    failed = {}
+    for path, entry in _read_entries(failed_images_path(source) if os.path.isdir(source) else source).items():
+        relative = os.path.relpath(path, root) if os.path.splitdrive(path)[0] == os.path.splitdrive(root)[0] else None
+        if relative is None or relative.split(os.sep)[0] == os.pardir or not os.path.isfile(path):
+            relative = os.path.normpath(entry.get('file') or os.pardir)
+            if relative.split(os.sep)[0] == os.pardir or os.path.isabs(relative) or not os.path.isfile(os.path.join(root, relative)):
+                continue
+        failed[relative] = None
+    if image_files is None:
+        return list(failed)
+    return [image_file for image_file in image_files if os.path.normpath(image_file) in failed]
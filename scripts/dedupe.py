@@ -0,0 +1,119 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from dataset import ImageFileWalk
+from events import send_json_message
+from utils import _open_reduced
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+DEFAULT_MAX_DISTANCE = 3
+
+
+def _grayscale_thumbnail(image_path, max_decode_bytes=0):
+    """(HASH_SIZE + 1) x HASH_SIZE grayscale pixels of an image, or None when it cannot be read or is over the decode budget."""
+    try:
+        with open(image_path, 'rb') as f:
+            img = _open_reduced(f.read(), HASH_SIZE * 4, max_decode_bytes)
+        img = ImageOps.exif_transpose(img).convert('L')
+        return img.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX).tobytes()
+    except (OSError, ValueError, RuntimeError, Image.DecompressionBombError):
+        return None
+
+
+def difference_hashes(thumbnails):
+    """64-bit difference hashes of equally sized grayscale thumbnails: bit set where a pixel is brighter than its left neighbour."""
+    if np is not None:
+        pixels = np.frombuffer(b''.join(thumbnails), dtype=np.uint8).reshape(len(thumbnails), HASH_SIZE, HASH_SIZE + 1)
+        bits = (pixels[:, :, 1:] > pixels[:, :, :-1]).reshape(len(thumbnails), HASH_BITS)
+        return np.packbits(bits, axis=1).view('>u8').ravel().tolist()
+
+    hashes = []
+    for thumbnail in thumbnails:
+        value = 0
+        for row in range(HASH_SIZE):
+            line = thumbnail[row * (HASH_SIZE + 1):(row + 1) * (HASH_SIZE + 1)]
+            for left, right in zip(line, line[1:]):
+                value = (value << 1) | (right > left)
+        hashes.append(value)
+    return hashes
+
+
+def _band_masks(max_distance):
+    # Two hashes within max_distance bits agree exactly on at least one of max_distance + 1 bands.
+    bands = max_distance + 1
+    bounds = [HASH_BITS * i // bands for i in range(bands + 1)]
+    return [((1 << (bounds[i + 1] - bounds[i])) - 1) << bounds[i] for i in range(bands)]
+
+
+def group_duplicates(hashes, max_distance=DEFAULT_MAX_DISTANCE):
+    """Assign every hash to the closest earlier group leader within max_distance bits.
+
+    Returns one leader position per hash; a hash that leads its own group maps
+    to itself. Matching against leaders only keeps chains of small
+    differences from merging images that are far apart.
+    """
+    max_distance = max(0, min(int(max_distance), HASH_BITS - 1))
+    masks = _band_masks(max_distance)
+    index = [{} for _mask in masks]
+    leaders = []
+
+    for position, value in enumerate(hashes):
+        if value is None:
+            leaders.append(position)
+            continue
+        best, best_distance = None, max_distance + 1
+        for mask, buckets in zip(masks, index):
+            for leader in buckets.get(value & mask, ()):
+                distance = (value ^ hashes[leader]).bit_count()
+                if distance < best_distance or (best is not None and distance == best_distance and leader < best):
+                    best, best_distance = leader, distance
+        if best is None:
+            leaders.append(position)
+            for mask, buckets in zip(masks, index):
+                buckets.setdefault(value & mask, []).append(position)
+        else:
+            leaders.append(best)
+    return leaders
+
+
+def deduplicate_walk(input_dir, image_walk, max_distance=DEFAULT_MAX_DISTANCE, workers=4, decode_memory_mb=0):
+    """Hash every image and keep the first of each group of exact or near duplicates.
+
+    Returns an ImageFileWalk over the kept images and a dict mapping each kept
+    image to the duplicates that should receive its output. Images are decoded
+    under the same decode_memory_mb budget as for encoding; those over it are
+    never treated as duplicates.
+    """
+    image_files = list(image_walk)
+    max_decode_bytes = max(0, int(float(decode_memory_mb or 0) * 1024 * 1024))
+    send_json_message('status', f'Hashing {len(image_files)} images to find duplicates...')
+    with ThreadPoolExecutor(max_workers=max(1, int(workers or 1))) as executor:
+        thumbnails = list(executor.map(lambda image_file: _grayscale_thumbnail(os.path.join(input_dir, image_file), max_decode_bytes), image_files))
+
+    readable = [thumbnail for thumbnail in thumbnails if thumbnail is not None]
+    readable_hashes = iter(difference_hashes(readable) if readable else [])
+    hashes = [next(readable_hashes) if thumbnail is not None else None for thumbnail in thumbnails]
+
+    kept = []
+    duplicates = {}
+    for position, leader in enumerate(group_duplicates(hashes, max_distance)):
+        if leader == position:
+            kept.append(image_files[position])
+        else:
+            duplicates.setdefault(image_files[leader], []).append(image_files[position])
+
+    skipped = len(image_files) - len(kept)
+    if skipped:
+        send_json_message(
+            'status',
+            f'Found {skipped} duplicate images in {len(duplicates)} groups; each group is captioned once, saving {skipped} inferences.',
+        )
+    return ImageFileWalk(input_dir, image_files=kept), duplicates
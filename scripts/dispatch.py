@@ -0,0 +1,394 @@
+import asyncio
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+OVERLOAD_STATUS_CODES = (429, 503)
+SESSION_POOL_SIZE = 64
+_DONE = object()
+
+
+class OverloadError(RuntimeError):
+    """The server rejected or timed out a request because it is saturated."""
+
+
+class ServerError(RuntimeError):
+    """The server accepted a request but failed to answer it: a 5xx status, invalid JSON or no text."""
+
+
+class RetriesExhausted(RuntimeError):
+    """A retryable error that kept happening until the retry policy gave up."""
+
+    def __init__(self, error, attempts):
+        super().__init__(f'{error} (gave up after {attempts} attempts)')
+        self.error = error
+        self.attempts = attempts
+
+
+def is_overload_error(error):
+    return isinstance(error, (OverloadError, requests.exceptions.Timeout))
+
+
+def api_error_class(status_code):
+    if status_code in OVERLOAD_STATUS_CODES:
+        return OverloadError
+    return ServerError if status_code >= 500 else RuntimeError
+
+
+def is_retryable_error(error):
+    """Whether trying the same request again may succeed.
+
+    Overloads, timeouts, dropped connections and server-side failures are
+    transient. Anything else, such as an image that cannot be decoded or a
+    request the server rejects with a 4xx status, fails the same way every time.
+    """
+    return isinstance(error, (
+        OverloadError,
+        ServerError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    ))
+
+
+class RetryPolicy:
+    """How often a failed request is retried and how long to wait in between.
+
+    The wait doubles with every attempt from base_delay up to max_delay; half
+    of it is fixed and half random, so requests that failed together do not
+    come back in lockstep. A run stops once max_consecutive_failures images
+    in a row have failed for good (0 = never), since that usually means the
+    server is gone rather than the images are bad.
+    """
+
+    def __init__(self, max_retries=3, base_delay=2.0, max_delay=60.0, max_consecutive_failures=20):
+        self.max_retries = max(0, int(max_retries))
+        self.base_delay = max(0.0, float(base_delay))
+        self.max_delay = max(self.base_delay, float(max_delay))
+        self.max_consecutive_failures = max(0, int(max_consecutive_failures))
+
+    def delay(self, attempt):
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def call(self, operation, on_retry=None, retryable=is_retryable_error):
+        """Return operation(), retrying errors for which retryable(error) holds; on_retry(error, retry_number, delay) runs before each wait."""
+        attempt = 0
+        while True:
+            try:
+                return operation()
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                if attempt >= self.max_retries:
+                    raise RetriesExhausted(e, attempt + 1) from e
+                delay = self.delay(attempt)
+                if on_retry:
+                    on_retry(e, attempt + 1, delay)
+                time.sleep(delay)
+                attempt += 1
+
+
+def call_or_error(retry_policy, operation):
+    """operation() with server errors retried, for one image of a batch that is being retried one image at a time.
+
+    Overloads and connection errors are raised so the dispatcher can back off
+    and retry the whole group; any other failure is returned instead of raised.
+    """
+    try:
+        return retry_policy.call(operation, retryable=lambda error: isinstance(error, ServerError))
+    except Exception as e:
+        if is_retryable_error(e):
+            raise
+        return e
+
+
+def retry_policy_from_config(config):
+    return RetryPolicy(
+        max_retries=config.getint('generation_params', 'max_retries', fallback=3),
+        base_delay=config.getfloat('generation_params', 'retry_base_delay', fallback=2.0),
+        max_delay=config.getfloat('generation_params', 'retry_max_delay', fallback=60.0),
+        max_consecutive_failures=config.getint('generation_params', 'max_consecutive_failures', fallback=20),
+    )
+
+
+def create_session(pool_size=SESSION_POOL_SIZE):
+    """Session whose connection pool is large enough for every request the dispatcher keeps in flight."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class AimdLimiter:
+    """Additive-increase / multiplicative-decrease limit on requests in flight.
+
+    Each fast success grows the limit by about one request per window, a
+    success well above the best observed latency shrinks it slightly, and an
+    overload response halves it.
+    """
+
+    def __init__(self, maximum, initial=1, adaptive=True, latency_tolerance=2.0):
+        self.maximum = max(1, int(maximum))
+        self.adaptive = adaptive
+        self.latency_tolerance = float(latency_tolerance)
+        self.limit = float(min(max(1, int(initial)), self.maximum)) if adaptive else float(self.maximum)
+        self.baseline_latency = None
+
+    @property
+    def current(self):
+        return max(1, int(self.limit))
+
+    def on_success(self, latency):
+        if not self.adaptive:
+            return
+        if self.baseline_latency is None or latency < self.baseline_latency:
+            self.baseline_latency = latency
+        else:
+            # Drift upwards slowly so the baseline follows longer outputs.
+            self.baseline_latency += (latency - self.baseline_latency) * 0.01
+
+        if latency > self.baseline_latency * self.latency_tolerance:
+            self.limit = max(1.0, self.limit * 0.9)
+        else:
+            self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+
+    def on_overload(self):
+        if self.adaptive:
+            self.limit = max(1.0, self.limit * 0.5)
+
+
+class Endpoint:
+    """One server a batch is dispatched to, with its own in-flight limit and health."""
+
+    def __init__(self, url, max_concurrency=1, adaptive=True):
+        self.url = url
+        self.limiter = AimdLimiter(max_concurrency, adaptive=adaptive)
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.unhealthy_since = 0.0
+        self.last_error = None
+        self.probing = False
+        self.completed = 0
+
+    @property
+    def spare_capacity(self):
+        return self.limiter.current - self.in_flight if self.healthy else 0
+
+
+def _is_connection_error(error):
+    return isinstance(error, requests.exceptions.ConnectionError) and not is_overload_error(error)
+
+
+async def _run_adaptive(items, worker, on_result, endpoints, pause_seconds, retry_policy, unhealthy_after, probe_interval, health_check, on_status, on_failure):
+    loop = asyncio.get_running_loop()
+    max_workers = sum(endpoint.limiter.maximum for endpoint in endpoints) + len(endpoints) + 1
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dispatch')
+    iterator = iter(items)
+    results = {}
+    retry_queue = deque()
+    in_flight = set()
+    probes = set()
+    next_seq = 0
+    next_emit = 0
+    exhausted = False
+    # Bound finished-but-unemitted results when the oldest request is slow.
+    max_outstanding = max(4, max_workers * 4)
+
+    def status(message):
+        if on_status:
+            on_status(message)
+
+    def fail(seq, item, error):
+        if on_failure is None:
+            raise error
+        results[seq] = (item, None, error)
+
+    async def next_item():
+        nonlocal next_seq, exhausted
+        item = await loop.run_in_executor(executor, next, iterator, _DONE)
+        if item is _DONE:
+            exhausted = True
+            return None
+        next_seq += 1
+        return next_seq - 1, item
+
+    async def emit_ready():
+        nonlocal next_emit
+        while next_emit in results:
+            item, result, error = results.pop(next_emit)
+            if error is None:
+                on_result(item, result)
+            else:
+                on_failure(item, error)
+            next_emit += 1
+            if pause_seconds > 0:
+                await asyncio.sleep(pause_seconds)
+
+    async def outage_round():
+        # Every endpoint failed its probe: each waiting image uses up a retry, and
+        # when none is waiting the next one is failed, so an outage still ends
+        # in the dead-letter list and max_consecutive_failures can stop the run.
+        error = next(endpoint.last_error for endpoint in endpoints if endpoint.last_error is not None)
+        waiting = list(retry_queue)
+        retry_queue.clear()
+        if not waiting and not exhausted:
+            pending = await next_item()
+            if pending is not None:
+                fail(pending[0], pending[1], error)
+        for seq, item, attempt in waiting:
+            if attempt >= retry_policy.max_retries:
+                fail(seq, item, RetriesExhausted(error, attempt + 1))
+            else:
+                retry_queue.append((seq, item, attempt + 1))
+        await emit_ready()
+
+    def pick_endpoint():
+        candidates = [endpoint for endpoint in endpoints if endpoint.spare_capacity > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda endpoint: endpoint.spare_capacity)
+
+    def mark_unhealthy(endpoint, error):
+        if not endpoint.healthy:
+            return
+        endpoint.healthy = False
+        endpoint.unhealthy_since = time.monotonic()
+        endpoint.last_error = error
+        status(f'Draining unreachable endpoint {endpoint.url}: {error}')
+
+    async def probe(endpoint):
+        try:
+            ok = await loop.run_in_executor(executor, health_check, endpoint)
+        except Exception:
+            ok = False
+        endpoint.probing = False
+        if ok:
+            endpoint.healthy = True
+            endpoint.consecutive_failures = 0
+            endpoint.limiter.limit = 1.0
+            status(f'Endpoint {endpoint.url} is reachable again.')
+        else:
+            endpoint.unhealthy_since = time.monotonic()
+
+    async def run_one(seq, item, attempt, endpoint):
+        started = time.monotonic()
+        try:
+            result = await loop.run_in_executor(executor, worker, item, endpoint)
+        except Exception as e:
+            retryable = is_retryable_error(e)
+            if not retryable or attempt >= retry_policy.max_retries:
+                if on_failure is None:
+                    raise
+                fail(seq, item, RetriesExhausted(e, attempt + 1) if retryable else e)
+                return
+            if is_overload_error(e):
+                endpoint.limiter.on_overload()
+                status(f'{endpoint.url} overloaded, reducing concurrency to {endpoint.limiter.current}: {e}')
+                await asyncio.sleep(retry_policy.delay(attempt))
+            elif _is_connection_error(e):
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= unhealthy_after:
+                    mark_unhealthy(endpoint, e)
+                await asyncio.sleep(retry_policy.delay(attempt))
+            else:
+                delay = retry_policy.delay(attempt)
+                status(f'Retry {attempt + 1}/{retry_policy.max_retries} in {delay:.1f}s due to: {e}')
+                await asyncio.sleep(delay)
+            retry_queue.append((seq, item, attempt + 1))
+            return
+        finally:
+            endpoint.in_flight -= 1
+        endpoint.consecutive_failures = 0
+        endpoint.completed += 1
+        endpoint.limiter.on_success(time.monotonic() - started)
+        results[seq] = (item, result, None)
+
+    try:
+        while True:
+            if health_check is not None:
+                now = time.monotonic()
+                for endpoint in endpoints:
+                    if not endpoint.healthy and not endpoint.probing and now - endpoint.unhealthy_since >= probe_interval:
+                        endpoint.probing = True
+                        probes.add(asyncio.ensure_future(probe(endpoint)))
+
+            while True:
+                endpoint = pick_endpoint()
+                if endpoint is None:
+                    break
+                if retry_queue:
+                    seq, item, attempt = retry_queue.popleft()
+                elif not exhausted and next_seq - next_emit < max_outstanding:
+                    pending = await next_item()
+                    if pending is None:
+                        continue
+                    (seq, item), attempt = pending, 0
+                else:
+                    break
+                # Counted before the task starts so the next pick sees it.
+                endpoint.in_flight += 1
+                in_flight.add(asyncio.ensure_future(run_one(seq, item, attempt, endpoint)))
+
+            if not in_flight:
+                if exhausted and not retry_queue:
+                    break
+                if not any(endpoint.healthy for endpoint in endpoints):
+                    if health_check is None:
+                        raise RuntimeError('All endpoints are unreachable: ' + ', '.join(e.url for e in endpoints))
+                    if not probes:
+                        due = min(endpoint.unhealthy_since for endpoint in endpoints) + probe_interval - time.monotonic()
+                        if due > 0:
+                            status(f'No endpoint is reachable; checking again in {due:.0f}s.')
+                            await asyncio.sleep(due)
+                        continue
+                    await asyncio.wait(probes)
+                    probes = {task for task in probes if not task.done()}
+                    if not any(endpoint.healthy for endpoint in endpoints):
+                        await outage_round()
+                continue
+
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+            probes = {task for task in probes if not task.done()}
+            await emit_ready()
+    finally:
+        for task in in_flight | probes:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_adaptive(items, worker, on_result, endpoints, pause_seconds=0.0, retry_policy=None, unhealthy_after=3, probe_interval=30.0, health_check=None, on_status=None, on_failure=None):
+    """Call worker(item, endpoint) for every item across endpoints with adaptive concurrency.
+
+    Workers run on a thread pool and pull from one shared queue, so faster
+    endpoints take more of the batch. on_result(item, result) is called on the
+    calling thread in input order. Retryable errors requeue the item up to
+    retry_policy.max_retries times: overload errors also shrink the endpoint's
+    in-flight limit, and repeated connection errors drain the endpoint until
+    health_check(endpoint) succeeds again. While every endpoint is drained
+    the run waits for the next probe, and each failed probe counts as a
+    retry of the waiting items. An item that still fails is passed to
+    on_failure(item, error) in its place, or stops the run and is re-raised
+    when there is no on_failure.
+    """
+    asyncio.run(_run_adaptive(
+        items,
+        worker,
+        on_result,
+        list(endpoints),
+        float(pause_seconds or 0.0),
+        retry_policy or RetryPolicy(),
+        max(1, int(unhealthy_after)),
+        float(probe_interval),
+        health_check,
+        on_status,
+        on_failure,
+    ))
+    return endpoints
@@ -5,13 +5,28 @@ import urllib.request
 import json
 import traceback
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 if SCRIPT_DIR not in sys.path:
     sys.path.insert(0, SCRIPT_DIR)
 
+from image_cache import file_sha256
 from model_catalog import get_model_bundle
 
+USER_AGENT = "Python Downloader"
+DOWNLOAD_CONNECTIONS = 4
+MIN_SEGMENT_BYTES = 16 * 1024 * 1024
+READ_CHUNK_BYTES = 1024 * 1024
+MAX_RETRIES = 5
+RETRY_DELAY_S = 5
+PROGRESS_INTERVAL_S = 0.5
+STATE_SAVE_INTERVAL_S = 2.0
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".json"
+DIGEST_SUFFIX = ".sha256"
+
 def send_json_message(msg_type, data):
     """Sends a structured JSON message to stdout."""
     payload = {"type": msg_type, "data": data}
@@ -23,120 +38,383 @@ def send_status_message(message, model=None):
         data['model_name'] = model.name
     send_json_message('status', data)
 
+def read_verified_hash(file_path):
+    """Returns the digest recorded for `file_path` if its size and mtime still match, else None."""
+    try:
+        stat = os.stat(file_path)
+        with open(file_path + DIGEST_SUFFIX, "r", encoding="utf-8") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(record, dict) or record.get("size") != stat.st_size or record.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+    return record.get("sha256")
+
+def record_verified_hash(file_path, digest):
+    """Stores a verified digest beside the file, keyed by its size and mtime."""
+    try:
+        stat = os.stat(file_path)
+        temp_path = file_path + DIGEST_SUFFIX + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}, f)
+        os.replace(temp_path, file_path + DIGEST_SUFFIX)
+    except OSError:
+        pass
+
+def check_hash(file_path, expected_hash, actual_hash, model=None):
+    if actual_hash == expected_hash:
+        record_verified_hash(file_path, actual_hash)
+        send_status_message('Integrity verification successful.', model)
+        return True
+    send_status_message(f'Integrity check failed! Expected {expected_hash}, got {actual_hash}', model)
+    return False
+
 def verify_hash(file_path, expected_hash, model=None):
-    """Verifies the SHA-256 hash of a file."""
+    """Verifies the SHA-256 hash of a file, trusting a recorded digest while the file is unchanged."""
     if not expected_hash:
         return True
-    
+    if read_verified_hash(file_path) == expected_hash:
+        return True
+
     send_status_message('Verifying file integrity...', model)
-    sha256_hash = hashlib.sha256()
     try:
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        
-        actual_hash = sha256_hash.hexdigest()
-        if actual_hash == expected_hash:
-            send_status_message('Integrity verification successful.', model)
-            return True
-        else:
-            send_status_message(f'Integrity check failed! Expected {expected_hash}, got {actual_hash}', model)
-            return False
+        return check_hash(file_path, expected_hash, file_sha256(file_path), model)
     except Exception as e:
         send_status_message(f'Error during verification: {str(e)}', model)
         return False
 
-def download_file(model, models_dir):
-    """Downloads a file with detailed progress reporting via JSON, featuring retries and size validation."""
+def probe_download(url):
+    """Returns (total size or None, whether the server honours Range requests)."""
+    req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT, "Range": "bytes=0-0"}, method="GET")
+    with urllib.request.urlopen(req, timeout=30) as response:
+        if response.status == 206:
+            content_range = response.getheader("Content-Range", "")
+            total = content_range.rpartition("/")[2]
+            if total.isdigit():
+                return int(total), True
+            raise ValueError(f"Unexpected Content-Range header: {content_range!r}")
+        if response.status == 200:
+            content_length = response.getheader("Content-Length")
+            return (int(content_length) if content_length else None), False
+        raise RuntimeError(f"Unexpected server response: {response.status}")
+
+
+def plan_segments(start, end, connections):
+    """Splits bytes [start, end) into up to `connections` segments of [start, offset, end]."""
+    remaining = end - start
+    count = max(1, min(connections, remaining // MIN_SEGMENT_BYTES))
+    bounds = [start + remaining * i // count for i in range(count + 1)]
+    return [[bounds[i], bounds[i], bounds[i + 1]] for i in range(count)]
+
+
+class DownloadProgress:
+    """Byte counts of every file in flight, reported as one combined progress stream."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.downloaded = {}
+        self.session_bytes = 0
+        self.started = time.time()
+
+    def start_file(self, key, total_size, downloaded):
+        with self.lock:
+            self.totals[key] = total_size or 0
+            self.downloaded[key] = downloaded
+
+    def add(self, key, byte_count):
+        with self.lock:
+            self.downloaded[key] += byte_count
+            self.session_bytes += byte_count
+
+    def report(self):
+        with self.lock:
+            total_size = sum(self.totals.values())
+            downloaded = sum(self.downloaded.values())
+            session_bytes = self.session_bytes
+        elapsed = time.time() - self.started
+        speed_mbps = (session_bytes / (1024*1024) / elapsed) if elapsed > 0 else 0
+        eta_s = ((total_size - downloaded) / (speed_mbps * 1024 * 1024)) if speed_mbps > 0 and total_size else None
+        send_json_message('progress', {
+            'percentage': (downloaded / total_size) * 100 if total_size > 0 else 0,
+            'speed_mbps': speed_mbps,
+            'downloaded_mb': downloaded / (1024*1024),
+            'total_mb': total_size / (1024*1024),
+            'eta_s': eta_s,
+            'model_name': self.model_name
+        })
+
+
+class PartialDownload:
+    """A .part file filled by Range segments, with each segment's offset saved beside it for resuming."""
+
+    def __init__(self, model, dest_path, total_size, ranged, segments):
+        self.model = model
+        self.dest_path = dest_path
+        self.part_path = dest_path + PART_SUFFIX
+        self.state_path = self.part_path + STATE_SUFFIX
+        self.total_size = total_size
+        self.ranged = ranged
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.hash_lock = threading.Lock()
+        self.sha256 = hashlib.sha256() if model.sha256 else None
+        self.hashed_bytes = 0
+
+    def remaining(self):
+        with self.lock:
+            return sum(end - offset for _start, offset, end in self.segments)
+
+    def contiguous_bytes(self):
+        """End of the prefix that is fully on disk."""
+        with self.lock:
+            for _start, offset, end in sorted(self.segments):
+                if end is None or offset < end:
+                    return offset
+        return self.total_size
+
+    def hash_chunk(self, position, chunk):
+        """Feeds a freshly written chunk to the digest when it continues the hashed prefix."""
+        if self.sha256 is None:
+            return
+        # Never wait on a catch-up read; hash_prefix picks up whatever is skipped here.
+        if not self.hash_lock.acquire(blocking=False):
+            return
+        try:
+            if position == self.hashed_bytes:
+                self.sha256.update(chunk)
+                self.hashed_bytes += len(chunk)
+        finally:
+            self.hash_lock.release()
+
+    def hash_prefix(self):
+        """Catches the digest up to the contiguous prefix by reading back what other segments wrote."""
+        if self.sha256 is None:
+            return
+        with self.hash_lock:
+            frontier = self.contiguous_bytes()
+            if frontier <= self.hashed_bytes:
+                return
+            with open(self.part_path, "rb") as f:
+                f.seek(self.hashed_bytes)
+                while self.hashed_bytes < frontier:
+                    block = f.read(min(READ_CHUNK_BYTES, frontier - self.hashed_bytes))
+                    if not block:
+                        break
+                    self.sha256.update(block)
+                    self.hashed_bytes += len(block)
+
+    def restart_hash(self):
+        if self.sha256 is not None:
+            with self.hash_lock:
+                self.sha256 = hashlib.sha256()
+                self.hashed_bytes = 0
+
+    def save_state(self):
+        if not self.ranged:
+            return
+        with self.lock:
+            state = {"url": self.model.url, "total_size": self.total_size, "segments": [list(s) for s in self.segments]}
+        temp_path = self.state_path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.state_path)
+        except OSError:
+            pass
+
+
+def _load_segments(state_path, url, total_size):
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("url") != url or state.get("total_size") != total_size:
+            return None
+        segments = [[int(start), int(offset), int(end)] for start, offset, end in state["segments"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if any(not start <= offset <= end <= total_size for start, offset, end in segments):
+        return None
+    return segments
+
+
+def prepare_download(model, models_dir, progress, connections=DOWNLOAD_CONNECTIONS):
+    """Works out what is left to fetch for `model`, or returns None when it is already on disk."""
     dest_path = os.path.join(models_dir, model.file)
-    url = model.url
-    max_retries = 5
-    retry_delay = 5
     expected_min_size = model.estimated_mb * 1024 * 1024 * 0.9
 
-    if os.path.exists(dest_path) and os.path.getsize(dest_path) >= expected_min_size:
-        if verify_hash(dest_path, model.sha256, model):
-            send_status_message(f'{model.file} already exists. Skipping download.', model)
-            return True
-        os.remove(dest_path)
+    if os.path.exists(dest_path):
+        if os.path.getsize(dest_path) >= expected_min_size:
+            if verify_hash(dest_path, model.sha256, model):
+                send_status_message(f'{model.file} already exists. Skipping download.', model)
+                return None
+            os.remove(dest_path)
+        elif not os.path.exists(dest_path + PART_SUFFIX):
+            # Partial file left by the single-stream downloader; continue it as the first segment.
+            os.replace(dest_path, dest_path + PART_SUFFIX)
+
+    total_size, ranged = probe_download(model.url)
+    part_path = dest_path + PART_SUFFIX
+    state_path = part_path + STATE_SUFFIX
+    segments = None
+
+    if ranged:
+        segments = _load_segments(state_path, model.url, total_size) if os.path.exists(part_path) else None
+        if segments is None:
+            on_disk = os.path.getsize(part_path) if os.path.exists(part_path) and not os.path.exists(state_path) else 0
+            on_disk = on_disk if on_disk < total_size else 0
+            segments = ([[0, on_disk, on_disk]] if on_disk else []) + plan_segments(on_disk, total_size, connections)
+        with open(part_path, "r+b" if os.path.exists(part_path) else "wb") as f:
+            f.truncate(total_size)
+    else:
+        segments = [[0, 0, total_size]]
 
-    for attempt in range(max_retries):
+    partial = PartialDownload(model, dest_path, total_size, ranged, segments)
+    partial.save_state()
+    downloaded = (total_size - partial.remaining()) if ranged else 0
+    progress.start_file(dest_path, total_size, downloaded)
+
+    pending = sum(1 for _start, offset, end in segments if end is None or offset < end)
+    if downloaded:
+        send_status_message(f'Resuming download at {downloaded / total_size * 100:.0f}% over {pending} connection(s)...', model)
+    else:
+        send_status_message(f'Starting download over {pending} connection(s)...', model)
+    return partial
+
+
+def fetch_segment(partial, segment, progress, stop):
+    """Downloads one segment into the .part file, retrying from where it left off."""
+    model = partial.model
+    for attempt in range(MAX_RETRIES):
         try:
-            downloaded = os.path.getsize(dest_path) if os.path.exists(dest_path) else 0
-            headers = {'User-Agent': 'Python Downloader', 'Range': f'bytes={downloaded}-'}
-            req = urllib.request.Request(url, headers=headers, method='GET')
-            
+            headers = {"User-Agent": USER_AGENT}
+            if partial.ranged:
+                headers["Range"] = f"bytes={segment[1]}-{segment[2] - 1}"
+            elif segment[1]:
+                # Without Range support a retry has to start the file over.
+                progress.add(partial.dest_path, -segment[1])
+                segment[1] = 0
+                partial.restart_hash()
+            req = urllib.request.Request(model.url, headers=headers, method="GET")
+
             with urllib.request.urlopen(req, timeout=30) as response:
-                if response.status == 206:
-                    content_length = int(response.getheader('Content-Length', 0))
-                    total_size = downloaded + content_length
-                    send_status_message(f'Resuming download (Attempt {attempt+1}/{max_retries})...', model)
-                elif response.status == 200:
-                    total_size = int(response.getheader('Content-Length', 0))
-                    if downloaded > 0:
-                        downloaded = 0
-                        open(dest_path, 'wb').close() 
-                    send_status_message(f'Starting download (Attempt {attempt+1}/{max_retries})...', model)
-                else:
-                    raise RuntimeError(f"Unexpected server response: {response.status}")
-
-                with open(dest_path, 'ab') as f:
-                    start_time = time.time()
-                    bytes_at_start_of_chunk = downloaded
-                    last_update_time = start_time
-
-                    while downloaded < total_size:
-                        chunk = response.read(65536)
+                if partial.ranged and response.status != 206:
+                    raise ValueError(f"Server ignored the Range request (status {response.status}).")
+                # Unbuffered, so bytes counted in a segment offset are readable by hash_prefix.
+                with open(partial.part_path, "r+b" if partial.ranged else "wb", buffering=0) as f:
+                    f.seek(segment[1])
+                    while segment[2] is None or segment[1] < segment[2]:
+                        if stop.is_set():
+                            return False
+                        chunk = response.read(READ_CHUNK_BYTES if segment[2] is None else min(READ_CHUNK_BYTES, segment[2] - segment[1]))
                         if not chunk:
-                            if downloaded < total_size:
-                                raise ConnectionError(f"Incomplete read: expected {total_size} bytes, got {downloaded}")
-                            break
-                        
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        current_time = time.time()
-                        if current_time - last_update_time >= 0.5:
-                            last_update_time = current_time
-                            percentage = (downloaded / total_size) * 100 if total_size > 0 else 0
-                            elapsed_since_start = current_time - start_time
-                            bytes_this_session = downloaded - bytes_at_start_of_chunk
-                            speed_mbps = (bytes_this_session / (1024*1024) / elapsed_since_start) if elapsed_since_start > 0 else 0
-                            eta_s = ((total_size - downloaded) / (speed_mbps * 1024 * 1024)) if speed_mbps > 0 else None
-                            
-                            send_json_message('progress', {
-                                'percentage': percentage,
-                                'speed_mbps': speed_mbps,
-                                'downloaded_mb': downloaded / (1024*1024),
-                                'total_mb': total_size / (1024*1024),
-                                'eta_s': eta_s,
-                                'model_name': model.name
-                            })
-
-            # Double check final size
-            final_size = os.path.getsize(dest_path)
-            if final_size < total_size:
-                raise ValueError(f"Final file size mismatch: {final_size} < {total_size}")
-
-            send_status_message(f'Successfully downloaded {model.file}.', model)
-            
-            if model.sha256:
-                if not verify_hash(dest_path, model.sha256, model):
-                    os.remove(dest_path)
-                    raise ValueError(f"Integrity check failed for {model.file}. File has been removed.")
-            
+                            if segment[2] is None:
+                                break
+                            raise ConnectionError(f"Incomplete read: segment stopped at byte {segment[1]} of {segment[2]}")
+                        position = segment[1]
+                        view = memoryview(chunk)
+                        while view:
+                            view = view[f.write(view):]
+                        with partial.lock:
+                            segment[1] += len(chunk)
+                        partial.hash_chunk(position, chunk)
+                        progress.add(partial.dest_path, len(chunk))
+            partial.hash_prefix()
             return True
 
         except (urllib.error.URLError, ConnectionError, TimeoutError, ValueError) as e:
-            send_status_message(f'Download issue on attempt {attempt+1}: {str(e)}. Retrying in {retry_delay}s...', model)
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-                continue
-            else:
+            if stop.is_set():
+                return False
+            if attempt == MAX_RETRIES - 1:
                 raise
-
+            send_status_message(f'Download issue on attempt {attempt+1}: {str(e)}. Retrying in {RETRY_DELAY_S}s...', model)
+            partial.save_state()
+            if stop.wait(RETRY_DELAY_S):
+                return False
     return False
 
+
+def finish_download(partial):
+    model = partial.model
+    final_size = os.path.getsize(partial.part_path)
+    if partial.total_size is not None and final_size != partial.total_size:
+        raise ValueError(f"Final file size mismatch: {final_size} != {partial.total_size}")
+
+    partial.hash_prefix()
+    os.replace(partial.part_path, partial.dest_path)
+    if os.path.exists(partial.state_path):
+        os.remove(partial.state_path)
+    send_status_message(f'Successfully downloaded {model.file}.', model)
+
+    if model.sha256:
+        if not check_hash(partial.dest_path, model.sha256, partial.sha256.hexdigest(), model):
+            os.remove(partial.dest_path)
+            raise ValueError(f"Integrity check failed for {model.file}. File has been removed.")
+
+
+def download_files(models, models_dir, connections=DOWNLOAD_CONNECTIONS):
+    """Downloads `models` at the same time, each over several Range connections, with one combined progress stream."""
+    progress = DownloadProgress(models[0].name)
+    partials = [partial for partial in (prepare_download(model, models_dir, progress, connections) for model in models) if partial]
+    if not partials:
+        return True
+
+    stop = threading.Event()
+
+    def report_progress():
+        last_saved = time.time()
+        while not stop.wait(PROGRESS_INTERVAL_S):
+            progress.report()
+            if time.time() - last_saved >= STATE_SAVE_INTERVAL_S:
+                last_saved = time.time()
+                for partial in partials:
+                    partial.save_state()
+
+    reporter = threading.Thread(target=report_progress, daemon=True)
+    reporter.start()
+
+    jobs = [(partial, segment) for partial in partials for segment in partial.segments if segment[2] is None or segment[1] < segment[2]]
+    pending = {partial: 0 for partial in partials}
+    for partial, _segment in jobs:
+        pending[partial] += 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(jobs) + len(partials)) as executor:
+            futures = {executor.submit(fetch_segment, partial, segment, progress, stop): partial for partial, segment in jobs}
+            for partial in partials:
+                if pending[partial] and partial.ranged:
+                    # One-time catch-up over what earlier runs left on disk.
+                    executor.submit(partial.hash_prefix)
+            for partial in partials:
+                if not pending[partial]:
+                    finish_download(partial)
+            try:
+                for future in as_completed(futures):
+                    partial = futures[future]
+                    if not future.result():
+                        continue
+                    pending[partial] -= 1
+                    if not pending[partial]:
+                        finish_download(partial)
+            except BaseException:
+                stop.set()
+                raise
+    finally:
+        stop.set()
+        reporter.join()
+        for partial in partials:
+            if os.path.exists(partial.part_path):
+                partial.save_state()
+
+    progress.report()
+    return True
+
+
+def download_file(model, models_dir):
+    """Downloads a single file; see download_files."""
+    return download_files([model], models_dir)
+
 def main():
     try:
         if len(sys.argv) != 3:
@@ -151,8 +429,7 @@ def main():
 
         os.makedirs(models_dir, exist_ok=True)
 
-        if download_file(model_bundle.model, models_dir):
-            download_file(model_bundle.vision, models_dir)
+        download_files([model_bundle.model, model_bundle.vision], models_dir)
 
     except Exception as e:
         send_json_message("error", {"message": f"{str(e)}\n{traceback.format_exc()}"})
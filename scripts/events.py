@@ -0,0 +1,134 @@
+import atexit
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+_STDOUT_LOCK = threading.Lock()
+_MESSAGE_FIELDS = {}
+
+
+@contextmanager
+def message_context(**fields):
+    """Add `fields` to every message sent inside the block."""
+    previous = dict(_MESSAGE_FIELDS)
+    _MESSAGE_FIELDS.update(fields)
+    try:
+        yield
+    finally:
+        _MESSAGE_FIELDS.clear()
+        _MESSAGE_FIELDS.update(previous)
+
+
+def _write_lines(payloads):
+    if not payloads:
+        return
+    text = ''.join(json.dumps(payload) + '\n' for payload in payloads)
+    with _STDOUT_LOCK:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+class EventChannel:
+    """Writes JSON-line messages to stdout in batches at most every `interval` seconds.
+
+    Pending progress and partial messages, and statuses sent with
+    coalesce=True, are replaced by the next one of their kind; image-complete
+    messages for consecutive indexes merge into one {'index', 'end'} range.
+    Errors are written at once, after everything pending. An interval of 0
+    writes every message as it is sent.
+    """
+
+    def __init__(self):
+        self.interval = 0.0
+        self._pending = []
+        self._lock = threading.Lock()
+        # Held from taking a batch until it is written, so batches reach stdout in order.
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def configure(self, interval):
+        self.flush()
+        self.interval = max(0.0, float(interval or 0))
+        if self.interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='event-channel', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval or 0.25)
+            self.flush()
+
+    def _merge_completion(self, payload):
+        index = payload['data'].get('index')
+        for pending, _coalesce in reversed(self._pending):
+            if pending['type'] != 'image-complete' or not _same_context(pending, payload):
+                continue
+            data = pending['data']
+            if isinstance(index, int) and data.get('end', data.get('index')) == index - 1:
+                pending['data'] = {**data, 'end': index}
+                return True
+        return False
+
+    def send(self, payload, coalesce=False):
+        if not self.interval:
+            _write_lines([payload])
+            return
+        with self._lock:
+            if payload['type'] == 'image-complete' and isinstance(payload.get('data'), dict):
+                if self._merge_completion(payload):
+                    return
+            elif coalesce:
+                # Only messages that were themselves sent to be coalesced are replaced.
+                key = _coalesce_key(payload)
+                self._pending = [item for item in self._pending if not (item[1] and _coalesce_key(item[0]) == key)]
+            self._pending.append((payload, coalesce))
+            if payload['type'] != 'error':
+                return
+        self.flush()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            _write_lines([payload for payload, _coalesce in pending])
+
+
+def _context(payload):
+    return {key: value for key, value in payload.items() if key not in ('type', 'message', 'data')}
+
+
+def _same_context(first, second):
+    return _context(first) == _context(second)
+
+
+def _coalesce_key(payload):
+    data = payload.get('data')
+    index = data.get('index') if payload['type'] == 'partial' and isinstance(data, dict) else None
+    return payload['type'], index, json.dumps(_context(payload), sort_keys=True)
+
+
+_EVENTS = EventChannel()
+
+
+def configure_events(interval):
+    """Batch messages sent from now on into writes at most every `interval` seconds (0 = unbatched)."""
+    _EVENTS.configure(interval)
+
+
+def flush_events():
+    _EVENTS.flush()
+
+
+def send_json_message(msg_type, message_or_data, coalesce=None):
+    """Send one message; coalesce lets a newer message of the same kind replace it while it is pending."""
+    payload = {'type': msg_type, **_MESSAGE_FIELDS}
+    if msg_type in ['status', 'error']:
+        payload['message'] = message_or_data
+    else:
+        payload['data'] = message_or_data
+    if coalesce is None:
+        coalesce = msg_type in ('progress', 'partial')
+    _EVENTS.send(payload, coalesce)
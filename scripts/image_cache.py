@@ -0,0 +1,191 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import uuid
+
+# Bump when encode_image output for the same inputs changes.
+CACHE_FORMAT_VERSION = 4
+
+_MIME_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+}
+_EXTENSION_MIMES = {ext: mime for mime, ext in _MIME_EXTENSIONS.items()}
+
+
+def file_sha256(file_path, block_size=1024 * 1024):
+    sha256_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+FILE_HASHES_TABLE = (
+    'CREATE TABLE IF NOT EXISTS file_hashes ('
+    'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL)'
+)
+
+
+def memoized_file_hash(conn, lock, file_path):
+    """file_sha256 memoized in conn's file_hashes table by (path, size, mtime_ns)."""
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+    with lock:
+        row = conn.execute(
+            'SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?',
+            (path, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+    if row:
+        return row[0]
+
+    sha256 = file_sha256(path)
+    with lock:
+        conn.execute(
+            'INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)',
+            (path, stat.st_size, stat.st_mtime_ns, sha256),
+        )
+        conn.commit()
+    return sha256
+
+
+class FileHashIndex:
+    """SQLite memo of file hashes, so unchanged files are recognized with a stat call."""
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(FILE_HASHES_TABLE)
+        self._conn.commit()
+
+    def file_hash(self, file_path):
+        return memoized_file_hash(self._conn, self._lock, file_path)
+
+
+class ImageCache:
+    """Content-addressed store of encoded image payloads with LRU eviction.
+
+    Entries are keyed by the source file hash plus the encode settings and
+    live as `<key>.jpg` / `<key>.png` files, so the MIME type is recovered
+    from the extension. Hits refresh the file mtime, which is the LRU clock.
+    The total size is only scanned for once the first entry is written, so
+    runs that are served from the cache never walk it.
+    """
+
+    def __init__(self, cache_dir, max_bytes, file_hasher=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max(0, int(max_bytes))
+        self.file_hasher = file_hasher or file_sha256
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._total_bytes = None
+
+    def _iter_entries(self):
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if os.path.splitext(entry.name)[1] not in _EXTENSION_MIMES:
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _entry_path(self, key, extension):
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def make_key(self, image_path, resize_max, image_format, variant=''):
+        file_hash = self.file_hasher(image_path)
+        settings = f'{CACHE_FORMAT_VERSION}|{file_hash}|{int(resize_max)}|{(image_format or "").strip().lower()}'
+        if variant:
+            settings += f'|{variant}'
+        return hashlib.sha256(settings.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        for extension, mime_type in _EXTENSION_MIMES.items():
+            path = self._entry_path(key, extension)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            except OSError:
+                return None
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return data, mime_type
+        return None
+
+    def put(self, key, data, mime_type):
+        extension = _MIME_EXTENSIONS.get(mime_type)
+        if not extension or len(data) > self.max_bytes:
+            return
+        path = self._entry_path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _path, size, _mtime in self._iter_entries())
+            else:
+                self._total_bytes += len(data) - replaced
+            over_limit = self._total_bytes > self.max_bytes
+        if over_limit:
+            self.prune()
+
+    def prune(self):
+        with self._lock:
+            entries = sorted(self._iter_entries(), key=lambda entry: entry[2])
+            total = sum(size for _path, size, _mtime in entries)
+            # Evict down to 90% so a full cache does not prune on every write.
+            target = self.max_bytes * 0.9 if total > self.max_bytes else total
+            for path, size, _mtime in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._total_bytes = total
+
+
+def open_image_cache(config, file_hasher=None):
+    """Return the shared ImageCache described by the [cache] section, or None when disabled.
+
+    Without a file_hasher, source hashes are memoized in the cache folder.
+    """
+    if not config.has_section('cache'):
+        return None
+    max_mb = config.getfloat('cache', 'image_cache_mb', fallback=0)
+    cache_dir = config.get('cache', 'cache_dir', fallback='').strip()
+    if max_mb <= 0 or not cache_dir:
+        return None
+    try:
+        if file_hasher is None:
+            file_hasher = FileHashIndex(os.path.join(cache_dir, 'file_hashes.sqlite3')).file_hash
+        return ImageCache(os.path.join(cache_dir, 'images'), max_mb * 1024 * 1024, file_hasher=file_hasher)
+    except (OSError, sqlite3.Error):
+        return None
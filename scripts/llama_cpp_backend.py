@@ -1,8 +1,12 @@
 import os
+import itertools
 import json
-import subprocess
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 
 import requests
 
@@ -10,21 +14,23 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 if SCRIPT_DIR not in sys.path:
     sys.path.insert(0, SCRIPT_DIR)
 
-from utils import (
-    build_progress_payload,
-    build_user_prompt,
-    encode_image,
-    format_generation_output,
-    list_image_files,
-    parse_generation_params,
-    send_json_message,
-    write_generation_output,
-)
+from batching import build_batch_prompt, chunked, image_label, split_batch_output
+from caption_run import CaptionRun
+from dispatch import RetryPolicy, ServerError, api_error_class, retry_policy_from_config
+from events import send_json_message
+from image_cache import open_image_cache
+from llama_server import acquire_server, hold_server
+from utils import iter_encoded_images, parse_generation_params
 from model_catalog import get_model_bundle
+from request_body import IMAGE_PLACEHOLDER, build_json_body, build_multi_image_body, image_placeholder
+from result_cache import model_file_identity, open_result_index
+from streaming import StreamCollector, iter_sse_events
+from telemetry import ImageTelemetry, share_telemetry, stage_timer, token_stats
 
 LLAMA_HOST = "http://127.0.0.1:5001"
 LLAMA_CHAT_ENDPOINT = f"{LLAMA_HOST}/v1/chat/completions"
 LOCAL_MODEL_ALIAS = "local-model"
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 def _text_from_value(value):
@@ -82,26 +88,30 @@ def _response_error_text(response):
     return message or f"HTTP {response.status_code}"
 
 
-def _server_endpoint_ready(endpoint):
-    try:
-        response = requests.get(f"{LLAMA_HOST}{endpoint}", timeout=1)
-        return response.status_code == 200
-    except Exception:
-        return False
-
-
-def _wait_for_server(proc, timeout_seconds):
-    deadline = time.time() + timeout_seconds
-    while time.time() < deadline:
-        if proc.poll() is not None:
-            raise RuntimeError(f"llama.cpp server exited early with code {proc.returncode}.")
-
-        if _server_endpoint_ready("/health") or _server_endpoint_ready("/v1/models"):
-            return
-
-        time.sleep(1)
-
-    raise RuntimeError("llama.cpp server failed to start within the timeout period.")
+def _token_stats(payload):
+    if not isinstance(payload, dict):
+        return {}
+    timings = payload.get("timings")
+    if isinstance(timings, dict):
+        # prompt_n only counts the tokens evaluated for this request; cache_n were reused.
+        cached = timings.get("cache_n")
+        prompt_n = timings.get("prompt_n")
+        return token_stats(
+            prompt_tokens=prompt_n + (cached or 0) if prompt_n is not None else None,
+            completion_tokens=timings.get("predicted_n"),
+            tokens_per_second=timings.get("predicted_per_second"),
+            prompt_tokens_per_second=timings.get("prompt_per_second"),
+            cached_prompt_tokens=cached,
+        )
+    usage = payload.get("usage")
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details")
+        return token_stats(
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            cached_prompt_tokens=details.get("cached_tokens") if isinstance(details, dict) else None,
+        )
+    return {}
 
 
 def _build_stop_sequences(gen_type):
@@ -111,12 +121,14 @@ def _build_stop_sequences(gen_type):
     return stop_sequences
 
 
-def _build_chat_payload(prompt, data_url, gen_params, gen_type, disable_thinking=False):
+def _build_chat_payload(prompt, data_url, gen_params, gen_type, disable_thinking=False, slot=None):
     max_tokens = int(gen_params.get(
         "max_tokens",
         gen_params.get("max_completion_tokens", gen_params.get("max_length", 4096)),
     ))
 
+    # The instruction text comes before the image and is identical for every
+    # image, so llama-server can reuse its KV cache for that prefix.
     payload = {
         "model": LOCAL_MODEL_ALIAS,
         "messages": [
@@ -137,105 +149,287 @@ def _build_chat_payload(prompt, data_url, gen_params, gen_type, disable_thinking
         "max_completion_tokens": max_tokens,
         "stop": _build_stop_sequences(gen_type),
         "stream": False,
+        "cache_prompt": True,
     }
 
+    if slot is not None:
+        payload["id_slot"] = slot
+
     if disable_thinking:
         payload["chat_template_kwargs"] = {"enable_thinking": False}
 
     return payload
 
 
-def _generate_once(session, payload, timeout):
-    response = session.post(LLAMA_CHAT_ENDPOINT, json=payload, timeout=timeout)
+def _api_error(response):
+    return api_error_class(response.status_code)(f"llama.cpp API error {response.status_code}: {_response_error_text(response)}")
+
+
+def _generate_once(session, body, timeout, telemetry=None):
+    with stage_timer(telemetry, "request"):
+        response = session.post(LLAMA_CHAT_ENDPOINT, data=body, headers=JSON_HEADERS, timeout=timeout)
     if response.status_code != 200:
-        raise RuntimeError(f"llama.cpp API error {response.status_code}: {_response_error_text(response)}")
+        raise _api_error(response)
 
-    try:
-        response_payload = response.json()
-    except Exception as e:
-        raise RuntimeError(f"llama.cpp returned invalid JSON: {e}")
+    with stage_timer(telemetry, "parse"):
+        try:
+            response_payload = response.json()
+        except Exception as e:
+            raise ServerError(f"llama.cpp returned invalid JSON: {e}")
+        text = _extract_chat_text(response_payload)
 
-    text = _extract_chat_text(response_payload)
+    if telemetry is not None:
+        telemetry.tokens = _token_stats(response_payload)
     if not text:
         keys = list(response_payload.keys()) if isinstance(response_payload, dict) else type(response_payload).__name__
-        raise RuntimeError(f"llama.cpp returned no text content. Response keys={keys}")
+        raise ServerError(f"llama.cpp returned no text content. Response keys={keys}")
     return text
 
 
-def process_images_loop_llama(gen_params, resize_max=1280, image_format="auto", request_pause_seconds=0.0, disable_thinking=False, **kwargs):
-    image_files = list_image_files(kwargs["input_dir"])
+def _generate_stream(session, body, timeout, collector, telemetry=None):
+    with stage_timer(telemetry, "request"), session.post(LLAMA_CHAT_ENDPOINT, data=body, headers=JSON_HEADERS, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            raise _api_error(response)
 
-    if not image_files:
-        raise ValueError("No images found in the input folder.")
+        # Leaving the block early closes the connection, which cancels the slot's task.
+        for _event, data in iter_sse_events(response):
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            if isinstance(chunk, dict) and chunk.get("error"):
+                error = chunk["error"]
+                message = error.get("message") if isinstance(error, dict) else error
+                raise ServerError(f"llama.cpp API error: {message}")
+            if telemetry is not None and isinstance(chunk, dict) and ("timings" in chunk or chunk.get("usage")):
+                telemetry.tokens = _token_stats(chunk)
+            choices = chunk.get("choices") if isinstance(chunk, dict) else None
+            if not choices or not isinstance(choices[0], dict):
+                continue
+            delta = choices[0].get("delta") or {}
+            content = delta.get("content") if isinstance(delta, dict) else None
+            if isinstance(content, str) and not collector.add(content):
+                break
 
-    total_images = len(image_files)
-    start_time = time.time()
-    timeout = int(gen_params.get("timeout", 600))
-    request_pause_seconds = float(request_pause_seconds or 0.0)
+    text = collector.finish().strip()
+    if not text:
+        raise ServerError("llama.cpp returned no text content.")
+    return text
 
-    session = requests.Session()
 
-    for index, image_file in enumerate(image_files, start=1):
-        input_image_path = os.path.join(kwargs["input_dir"], image_file)
-        send_json_message("status", f"Processing image {index} of {total_images}...")
+def _pin_slot(local, slot_ids):
+    """Executor initializer: pin each worker thread to its own server slot."""
+    local.slot = next(slot_ids)
 
-        gen_type = kwargs["gen_type"]
-        prompt_template = kwargs["prompt_templates"][gen_type]
-        prompt = build_user_prompt(
-            gen_type,
-            prompt_template,
-            kwargs["max_words"],
-            kwargs.get("trigger_words", ""),
-            kwargs.get("prompt_enrichment", ""),
-        )
 
-        base64_image, mime_type = encode_image(
-            input_image_path,
-            resize_max=resize_max,
-            image_format=image_format,
-            return_mime=True,
-        )
-        data_url = f"data:{mime_type};base64,{base64_image}"
-        payload = _build_chat_payload(prompt, data_url, gen_params, gen_type, disable_thinking=disable_thinking)
+def _thread_slot(local):
+    return getattr(local, "slot", None)
 
-        raw_output = ""
-        max_retries = 3
-        retry_delay = 3
 
-        for attempt in range(max_retries):
-            try:
-                raw_output = _generate_once(session, payload, timeout)
-                break
-            except Exception as e:
-                if attempt >= max_retries - 1:
-                    raise RuntimeError(f"Failed to generate for {image_file} after {max_retries} retries: {e}")
-                send_json_message("status", f"Retry {attempt + 1}/{max_retries} due to: {e}")
-                time.sleep(retry_delay)
-                retry_delay *= 2
-
-        final_output = format_generation_output(
-            gen_type,
-            raw_output,
-            kwargs["max_words"],
-            kwargs["single_paragraph"],
-            kwargs.get("trigger_words", ""),
+def _thread_session(local):
+    session = getattr(local, "session", None)
+    if session is None:
+        session = requests.Session()
+        local.session = session
+    return session
+
+
+def _generate_image(local, index, image_file, image_bytes, mime_type, prompt, gen_params, gen_type, timeout, disable_thinking, retry_policy, telemetry=None):
+    stream_output = bool(gen_params.get("stream_output", False))
+    payload = _build_chat_payload(
+        prompt, IMAGE_PLACEHOLDER, gen_params, gen_type, disable_thinking=disable_thinking, slot=_thread_slot(local),
+    )
+    payload["stream"] = stream_output
+    body = build_json_body(payload, image_bytes, prefix=f"data:{mime_type};base64,", telemetry=telemetry)
+    session = _thread_session(local)
+
+    def attempt():
+        if stream_output:
+            collector = StreamCollector(
+                index,
+                image_file,
+                max_chars=gen_params.get("stream_max_chars", 0),
+                stop_on_repetition=gen_params.get("stop_on_repetition", True),
+            )
+            return _generate_stream(session, body, timeout, collector, telemetry)
+        return _generate_once(session, body, timeout, telemetry)
+
+    def on_retry(error, retry, delay):
+        send_json_message("status", f"Retry {retry}/{retry_policy.max_retries} for image {index} in {delay:.1f}s due to: {error}")
+
+    return retry_policy.call(attempt, on_retry)
+
+
+def _generate_or_error(local, index, image_file, image_bytes, mime_type, prompt, gen_params, gen_type, timeout, disable_thinking, retry_policy, telemetry=None):
+    try:
+        return _generate_image(local, index, image_file, image_bytes, mime_type, prompt, gen_params, gen_type, timeout, disable_thinking, retry_policy, telemetry)
+    except Exception as e:
+        return e
+
+
+def _generate_batch(local, images, prompt, gen_params, gen_type, timeout, disable_thinking, retry_policy):
+    """Caption several images with one request; falls back to one request per image if the answer cannot be split.
+
+    `images` holds (index, image_file, image_bytes, mime_type, telemetry) and
+    the outputs are returned in the same order, with the exception in place
+    of the output for an image that failed on its own.
+    """
+    payload = _build_chat_payload(
+        build_batch_prompt(prompt, len(images)), IMAGE_PLACEHOLDER, gen_params, gen_type,
+        disable_thinking=disable_thinking, slot=_thread_slot(local),
+    )
+    content = [payload["messages"][0]["content"][0]]
+    for number in range(1, len(images) + 1):
+        content.append({"type": "text", "text": image_label(number)})
+        content.append({"type": "image_url", "image_url": {"url": image_placeholder(number - 1)}})
+    payload["messages"][0]["content"] = content
+
+    batch_telemetry = ImageTelemetry()
+    body = build_multi_image_body(
+        payload,
+        [(image_bytes, f"data:{mime_type};base64,") for _index, _file, image_bytes, mime_type, _telemetry in images],
+        telemetry=batch_telemetry,
+    )
+    try:
+        outputs = split_batch_output(_generate_once(_thread_session(local), body, timeout, batch_telemetry), len(images))
+        reason = "the answer did not follow the batch format"
+    except Exception as e:
+        outputs = None
+        reason = str(e)
+
+    if outputs is None:
+        send_json_message(
+            "status",
+            f"Batch of images {images[0][0]}-{images[-1][0]} failed ({reason}). Retrying them one at a time...",
         )
+        return [
+            _generate_or_error(local, index, image_file, image_bytes, mime_type, prompt, gen_params, gen_type, timeout, disable_thinking, retry_policy, telemetry)
+            for index, image_file, image_bytes, mime_type, telemetry in images
+        ]
+
+    share_telemetry(batch_telemetry, [telemetry for *_rest, telemetry in images])
+    return outputs
 
-        write_generation_output(kwargs["output_dir"], image_file, gen_type, final_output)
-        send_json_message("progress", build_progress_payload(index, total_images, start_time))
-        send_json_message("image-complete", {"index": index})
 
-        if request_pause_seconds > 0 and index < total_images:
+def _generate_group(local, images, prompt, gen_params, gen_type, timeout, disable_thinking, retry_policy):
+    """Outputs for a group of images in order; an image that failed to load or to generate gets its exception instead."""
+    loaded = [image for image in images if not isinstance(image[2], Exception)]
+    if len(loaded) == 1:
+        outputs = [_generate_or_error(local, *loaded[0][:4], prompt, gen_params, gen_type, timeout, disable_thinking, retry_policy, loaded[0][4])]
+    elif loaded:
+        outputs = _generate_batch(local, loaded, prompt, gen_params, gen_type, timeout, disable_thinking, retry_policy)
+    else:
+        outputs = []
+    outputs = iter(outputs)
+    return [image_bytes if isinstance(image_bytes, Exception) else next(outputs) for _index, _file, image_bytes, *_rest in images]
+
+
+def process_images_loop_llama(gen_params, resize_max=1280, image_format="auto", request_pause_seconds=0.0, disable_thinking=False, parallel_slots=1, preprocess_workers=2, prefetch_images=4, image_cache=None, result_index=None, model_identity="", decode_memory_mb=0, images_per_request=1, vision_grid=None, retry_policy=None, **kwargs):
+    timeout = int(gen_params.get("timeout", 600))
+    request_pause_seconds = float(request_pause_seconds or 0.0)
+    parallel_slots = max(1, int(parallel_slots or 1))
+    images_per_request = max(1, int(images_per_request or 1))
+    retry_policy = retry_policy or RetryPolicy()
+
+    run = CaptionRun("llama_cpp", model_identity, {
+        "resize_max": resize_max,
+        "image_format": image_format,
+        "parallel_slots": parallel_slots,
+        "images_per_request": images_per_request,
+        "image_token_budget": vision_grid.token_budget if vision_grid is not None else None,
+        "stream_output": bool(gen_params.get("stream_output", False)),
+    }, retry_policy, result_index=result_index, preprocess_workers=preprocess_workers, decode_memory_mb=decode_memory_mb, **kwargs)
+    gen_type = run.gen_type
+    prompt = run.prompt
+
+    request_params = _build_chat_payload(prompt, "", gen_params, gen_type, disable_thinking=disable_thinking)
+    request_params.pop("messages")
+    request_params.update({"resize_max": resize_max, "image_format": image_format})
+    if images_per_request > 1:
+        request_params["images_per_request"] = images_per_request
+    if vision_grid is not None:
+        request_params["vision_grid"] = vision_grid.cache_tag()
+
+    pending_files, pending = itertools.tee(run.pending_images(model_identity, request_params))
+
+    local = threading.local()
+    in_flight = deque()
+
+    def finish_next():
+        group, future = in_flight.popleft()
+        for (index, image_file, result_key, telemetry), raw_output in zip(group, future.result()):
+            run.finish(index, image_file, raw_output, result_key, telemetry)
+
+        if request_pause_seconds > 0 and run.completed < run.total:
             time.sleep(request_pause_seconds)
 
+    # Outputs and progress events, cache hits and failures included, are emitted
+    # in input order, while up to parallel_slots requests are kept in flight on the server.
+    # The executor never starts more threads than there are slots, so slot ids stay in range.
+    finished = False
+    executor = ThreadPoolExecutor(max_workers=parallel_slots, initializer=_pin_slot, initargs=(local, itertools.count()))
+    try:
+        encoded_images = iter_encoded_images(
+            run.input_dir,
+            (image_file for _index, image_file, _key in pending_files),
+            resize_max=resize_max,
+            image_format=image_format,
+            workers=preprocess_workers,
+            prefetch=max(int(prefetch_images or 0), parallel_slots * images_per_request),
+            cache=image_cache,
+            decode_memory_mb=decode_memory_mb,
+            vision_grid=vision_grid,
+            return_errors=True,
+        )
+        for chunk in chunked(zip(pending, encoded_images), images_per_request):
+            group = []
+            images = []
+            for (index, image_file, result_key), (_image_file, image_bytes, mime_type, telemetry) in chunk:
+                send_json_message("status", f"Processing image {index} of {run.total}...", coalesce=True)
+                group.append((index, image_file, result_key, telemetry))
+                images.append((index, image_file, image_bytes, mime_type, telemetry))
+            if not in_flight:
+                run.complete_cached(group[0][0])
+            future = executor.submit(
+                _generate_group,
+                local,
+                images,
+                prompt,
+                gen_params,
+                gen_type,
+                timeout,
+                disable_thinking,
+                retry_policy,
+            )
+            in_flight.append((group, future))
+
+            if len(in_flight) >= parallel_slots:
+                finish_next()
+
+        while in_flight:
+            finish_next()
+        run.complete_cached()
+        finished = True
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        run.close(finished)
+
 
-def _server_creation_flags():
-    if sys.platform == "win32":
-        return 0x08000000
-    return 0
+def _resolve_vision_grid(model_bundle, token_budget):
+    """The bundle's patch grid with the configured image token budget, or None to size images by resize_max alone."""
+    grid = model_bundle.vision_grid
+    if grid is None or str(token_budget).strip().lower() == "auto":
+        return grid
+    try:
+        token_budget = int(token_budget)
+    except ValueError:
+        raise ValueError(f"image_token_budget must be 'auto' or a number, not {token_budget!r}.")
+    return replace(grid, token_budget=token_budget) if token_budget > 0 else None
 
 
-def run_llama_cpp_generation(config, llama_server_exe, models_dir, desired_model_key, low_vram, disable_thinking=False, **kwargs):
+def run_llama_cpp_generation(config, llama_server_exe, models_dir, desired_model_key, low_vram, disable_thinking=False, keep_server=False, **kwargs):
     model_bundle = get_model_bundle(desired_model_key)
     if not model_bundle:
         raise RuntimeError(f"Unknown model key: {desired_model_key}")
@@ -259,6 +453,18 @@ def run_llama_cpp_generation(config, llama_server_exe, models_dir, desired_model
     image_format = str(gen_params.get("image_format", "auto"))
     request_pause_seconds = float(gen_params.get("request_pause_seconds", 0.25))
     startup_timeout = int(gen_params.get("startup_timeout", 180))
+    server_idle_timeout = float(gen_params.get("server_idle_timeout", 0))
+    parallel_slots = max(1, int(gen_params.get("parallel_slots", 1)))
+    preprocess_workers = int(gen_params.get("preprocess_workers", 2))
+    prefetch_images = int(gen_params.get("prefetch_images", 4))
+    decode_memory_mb = float(gen_params.get("decode_memory_mb", 0))
+    images_per_request = max(1, int(gen_params.get("images_per_request", 1)))
+    vision_grid = _resolve_vision_grid(model_bundle, gen_params.get("image_token_budget", "auto"))
+    if vision_grid is not None:
+        send_json_message(
+            "status",
+            f"Sizing images to {vision_grid.tile} px tiles within {vision_grid.token_budget} image tokens each.",
+        )
 
     llama_command = [
         llama_server_exe,
@@ -272,8 +478,13 @@ def run_llama_cpp_generation(config, llama_server_exe, models_dir, desired_model
         "--no-ui",
         "--gpu-layers", gpu_layers,
         "--flash-attn", flash_attn,
+        "--parallel", str(parallel_slots),
     ]
 
+    if parallel_slots > 1:
+        # Let every slot use the full context instead of ctx-size / parallel.
+        llama_command.append("--kv-unified")
+
     if low_vram:
         llama_command.append("--no-mmproj-offload")
 
@@ -284,29 +495,41 @@ def run_llama_cpp_generation(config, llama_server_exe, models_dir, desired_model
             "--chat-template-kwargs", json.dumps({"enable_thinking": False}, separators=(",", ":")),
         ])
 
-    send_json_message("status", "Starting AI Engine...")
-    proc = subprocess.Popen(
+    result_index = open_result_index(config)
+    image_cache = open_image_cache(config, file_hasher=result_index.file_hash if result_index else None)
+    model_identity = f"{model_file_identity(model_path, model_bundle.model.sha256)}:{model_file_identity(mmproj_file, model_bundle.vision.sha256)}"
+
+    # keep_server leaves the server running for the next job of a worker process.
+    server = (hold_server if keep_server else acquire_server)(
         llama_command,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-        creationflags=_server_creation_flags(),
-        cwd=os.path.dirname(llama_server_exe),
+        os.path.dirname(llama_server_exe),
+        LLAMA_HOST,
+        startup_timeout,
+        idle_timeout=server_idle_timeout,
+        on_status=lambda message: send_json_message("status", message),
     )
 
     try:
-        _wait_for_server(proc, startup_timeout)
         process_images_loop_llama(
             gen_params,
             resize_max=resize_max,
             image_format=image_format,
             request_pause_seconds=request_pause_seconds,
             disable_thinking=disable_thinking,
+            parallel_slots=parallel_slots,
+            preprocess_workers=preprocess_workers,
+            prefetch_images=prefetch_images,
+            image_cache=image_cache,
+            result_index=result_index,
+            model_identity=model_identity,
+            decode_memory_mb=decode_memory_mb,
+            images_per_request=images_per_request,
+            vision_grid=vision_grid,
+            retry_policy=retry_policy_from_config(config),
             **kwargs,
         )
     finally:
-        if proc.poll() is None:
-            proc.terminate()
-            try:
-                proc.wait(timeout=10)
-            except subprocess.TimeoutExpired:
-                proc.kill()
+        if result_index is not None:
+            result_index.close()
+        if not keep_server:
+            server.release()
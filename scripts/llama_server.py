@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+STATE_FILE_NAME = "caption_creator_llama_server.json"
+WATCH_POLL_SECONDS = 5
+
+_held_server = None
+
+
+def _state_path():
+    return os.path.join(tempfile.gettempdir(), STATE_FILE_NAME)
+
+
+def _read_state(state_path):
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else None
+    except Exception:
+        return None
+
+
+def _write_state(state_path, state):
+    temp_path = f"{state_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
+
+
+def _remove_state(state_path, server_id):
+    state = _read_state(state_path)
+    if state and state.get("server_id") == server_id:
+        try:
+            os.remove(state_path)
+        except OSError:
+            pass
+
+
+def _touch_state(state_path, server_id):
+    state = _read_state(state_path)
+    if state and state.get("server_id") == server_id:
+        state["last_used"] = time.time()
+        _write_state(state_path, state)
+
+
+def server_fingerprint(command):
+    return hashlib.sha256(json.dumps(command, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def server_endpoint_ready(host, endpoint):
+    try:
+        response = requests.get(f"{host}{endpoint}", timeout=1)
+        return response.status_code == 200
+    except Exception:
+        return False
+
+
+def _server_healthy(host):
+    return server_endpoint_ready(host, "/health") or server_endpoint_ready(host, "/v1/models")
+
+
+def wait_for_server(proc, host, timeout_seconds):
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"llama.cpp server exited early with code {proc.returncode}.")
+
+        if _server_healthy(host):
+            return
+
+        time.sleep(1)
+
+    raise RuntimeError("llama.cpp server failed to start within the timeout period.")
+
+
+def _creation_flags(detached):
+    if sys.platform != "win32":
+        return 0
+    flags = 0x08000000  # CREATE_NO_WINDOW
+    if detached:
+        flags |= 0x00000200  # CREATE_NEW_PROCESS_GROUP
+    return flags
+
+
+def _terminate_pid(pid):
+    try:
+        os.kill(int(pid), signal.SIGTERM)
+    except (OSError, ValueError, TypeError):
+        pass
+
+
+def _spawn_server(command, cwd, detached):
+    return subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        creationflags=_creation_flags(detached),
+        start_new_session=detached and sys.platform != "win32",
+        cwd=cwd,
+    )
+
+
+def _spawn_watchdog(state_path, server_id):
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--watch", state_path, server_id],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        creationflags=_creation_flags(True),
+        start_new_session=sys.platform != "win32",
+        close_fds=True,
+    )
+
+
+class ServerLease:
+    """A running llama-server used by one job.
+
+    Owned servers (idle_timeout <= 0) are terminated on release. Shared
+    servers are left running; while leased, a heartbeat keeps the watchdog
+    from treating them as idle.
+    """
+
+    def __init__(self, proc=None, state_path=None, server_id=None, idle_timeout=0):
+        self.proc = proc
+        self.state_path = state_path
+        self.server_id = server_id
+        self.idle_timeout = idle_timeout
+        self._stop = threading.Event()
+        self._heartbeat = None
+        if self.server_id:
+            interval = max(1.0, min(30.0, idle_timeout / 3.0))
+            self._heartbeat = threading.Thread(target=self._beat, args=(interval,), daemon=True)
+            self._heartbeat.start()
+
+    def _beat(self, interval):
+        while not self._stop.wait(interval):
+            _touch_state(self.state_path, self.server_id)
+
+    def release(self):
+        if self.server_id:
+            self._stop.set()
+            _touch_state(self.state_path, self.server_id)
+            return
+
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+def acquire_server(command, cwd, host, startup_timeout, idle_timeout=0, on_status=None):
+    """Return a ServerLease for a llama-server running `command`.
+
+    With idle_timeout > 0 a server started with the same command by an
+    earlier job is reused; a server with a different command is replaced.
+    New shared servers are detached and shut down by a watchdog process after
+    idle_timeout seconds without a lease.
+    """
+    idle_timeout = float(idle_timeout or 0)
+    if idle_timeout <= 0:
+        if on_status:
+            on_status("Starting AI Engine...")
+        proc = _spawn_server(command, cwd, detached=False)
+        lease = ServerLease(proc=proc)
+        try:
+            wait_for_server(proc, host, startup_timeout)
+        except Exception:
+            lease.release()
+            raise
+        return lease
+
+    state_path = _state_path()
+    fingerprint = server_fingerprint(command)
+    state = _read_state(state_path)
+
+    if state and _server_healthy(host):
+        if state.get("fingerprint") == fingerprint:
+            state["last_used"] = time.time()
+            state["idle_timeout"] = idle_timeout
+            _write_state(state_path, state)
+            if on_status:
+                on_status("Reusing running AI Engine...")
+            return ServerLease(state_path=state_path, server_id=state.get("server_id"), idle_timeout=idle_timeout)
+
+        if on_status:
+            on_status("AI Engine settings changed. Restarting...")
+        _terminate_pid(state.get("pid"))
+        deadline = time.time() + 15
+        while time.time() < deadline and _server_healthy(host):
+            time.sleep(0.5)
+
+    if on_status:
+        on_status("Starting AI Engine...")
+    proc = _spawn_server(command, cwd, detached=True)
+    try:
+        wait_for_server(proc, host, startup_timeout)
+    except Exception:
+        if proc.poll() is None:
+            proc.kill()
+        raise
+
+    server_id = uuid.uuid4().hex
+    _write_state(state_path, {
+        "server_id": server_id,
+        "pid": proc.pid,
+        "fingerprint": fingerprint,
+        "host": host,
+        "idle_timeout": idle_timeout,
+        "last_used": time.time(),
+    })
+    _spawn_watchdog(state_path, server_id)
+    return ServerLease(state_path=state_path, server_id=server_id, idle_timeout=idle_timeout)
+
+
+def hold_server(command, cwd, host, startup_timeout, idle_timeout=0, on_status=None):
+    """Like acquire_server, but keep the lease for later jobs of this process.
+
+    A held server started with the same command is reused while it is still
+    running; otherwise it is released and a new one is acquired. The lease
+    ends with release_held_server().
+    """
+    global _held_server
+    fingerprint = server_fingerprint(command)
+    if _held_server is not None:
+        held_fingerprint, lease = _held_server
+        if lease.server_id:
+            running = (_read_state(lease.state_path) or {}).get("server_id") == lease.server_id
+        else:
+            running = lease.proc is not None and lease.proc.poll() is None
+        if held_fingerprint == fingerprint and running and _server_healthy(host):
+            if on_status:
+                on_status("Reusing running AI Engine...")
+            return lease
+        release_held_server()
+
+    lease = acquire_server(command, cwd, host, startup_timeout, idle_timeout=idle_timeout, on_status=on_status)
+    _held_server = (fingerprint, lease)
+    return lease
+
+
+def release_held_server():
+    global _held_server
+    if _held_server is not None:
+        _held_server[1].release()
+        _held_server = None
+
+
+def watch_server(state_path, server_id):
+    failed_checks = 0
+    while True:
+        time.sleep(WATCH_POLL_SECONDS)
+        state = _read_state(state_path)
+        if not state or state.get("server_id") != server_id:
+            return
+
+        if not _server_healthy(state.get("host", "")):
+            failed_checks += 1
+            if failed_checks >= 3:
+                _terminate_pid(state.get("pid"))
+                _remove_state(state_path, server_id)
+                return
+            continue
+        failed_checks = 0
+
+        if time.time() - float(state.get("last_used", 0)) >= float(state.get("idle_timeout", 0)):
+            _terminate_pid(state.get("pid"))
+            _remove_state(state_path, server_id)
+            return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--watch":
+        watch_server(sys.argv[2], sys.argv[3])
@@ -1,24 +1,47 @@
+import json
 import os
 import sys
-import time
-
-import requests
+from functools import partial
+from itertools import tee
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 if SCRIPT_DIR not in sys.path:
     sys.path.insert(0, SCRIPT_DIR)
 
-from utils import (
-    build_user_prompt,
-    build_progress_payload,
-    encode_image,
-    format_generation_output,
-    list_image_files,
-    send_json_message,
-    write_generation_output,
+from batching import build_batch_prompt, chunked, image_label, split_batch_output
+from caption_run import CaptionRun
+from dispatch import (
+    Endpoint,
+    RetryPolicy,
+    ServerError,
+    api_error_class,
+    call_or_error,
+    create_session,
+    is_retryable_error,
+    retry_policy_from_config,
+    run_adaptive,
 )
+from events import send_json_message
+from image_cache import open_image_cache
+from request_body import IMAGE_PLACEHOLDER, build_json_body, build_multi_image_body, image_placeholder
+from result_cache import open_result_index
+from streaming import StreamCollector, iter_sse_events
+from telemetry import ImageTelemetry, share_telemetry, stage_timer, token_stats
+from utils import iter_encoded_images
 
 LM_HOST = 'http://127.0.0.1:1234'
+# Shared so connections stay open between images and, in worker mode, between jobs.
+_SESSION = create_session()
+
+
+def _base_urls(config):
+    value = config.get('generation_params', 'base_url', fallback=LM_HOST)
+    urls = []
+    for url in value.split(','):
+        url = url.strip().rstrip('/')
+        if url and url not in urls:
+            urls.append(url)
+    return urls or [LM_HOST]
 
 
 def _headers():
@@ -29,23 +52,31 @@ def _headers():
     return headers
 
 
-def _request_json(method, endpoint, **kwargs):
-    url = f'{LM_HOST}{endpoint}'
-    response = requests.request(method, url, headers=_headers(), **kwargs)
+def _response_error_text(response):
+    message = response.text.strip()
+    try:
+        payload = response.json()
+        error = payload.get('error')
+        if isinstance(error, dict):
+            message = error.get('message') or message
+        elif isinstance(error, str):
+            message = error
+        elif payload.get('message'):
+            message = payload.get('message')
+    except Exception:
+        pass
+    return message
+
+
+def _api_error(response):
+    return api_error_class(response.status_code)(f'LM Studio API error {response.status_code}: {_response_error_text(response)}')
+
+
+def _request_json(method, endpoint, base_url=LM_HOST, **kwargs):
+    url = f'{base_url}{endpoint}'
+    response = _SESSION.request(method, url, headers=_headers(), **kwargs)
     if response.status_code != 200:
-        message = response.text.strip()
-        try:
-            payload = response.json()
-            error = payload.get('error')
-            if isinstance(error, dict):
-                message = error.get('message') or message
-            elif isinstance(error, str):
-                message = error
-            elif payload.get('message'):
-                message = payload.get('message')
-        except Exception:
-            pass
-        raise RuntimeError(f'LM Studio API error {response.status_code}: {message}')
+        raise _api_error(response)
     try:
         return response.json()
     except Exception as e:
@@ -72,8 +103,8 @@ def _select_model_key(models):
     return None
 
 
-def _resolve_model_key(timeout=10, selected_model_key=''):
-    payload = _request_json('GET', '/api/v1/models', timeout=timeout)
+def _resolve_model_key(timeout=10, selected_model_key='', base_url=LM_HOST):
+    payload = _request_json('GET', '/api/v1/models', base_url=base_url, timeout=timeout)
     models = payload.get('models') or []
 
     if selected_model_key:
@@ -92,6 +123,30 @@ def _resolve_model_key(timeout=10, selected_model_key=''):
     return model_key
 
 
+def _resolve_endpoints(base_urls, timeout=10, selected_model_key=''):
+    """Resolve the model on every endpoint; returns (model_key, reachable_urls).
+
+    Without a selected model the first reachable endpoint picks one and the
+    others must serve the same key. Endpoints that fail are skipped.
+    """
+    model_key = selected_model_key
+    urls = []
+    first_error = None
+    for base_url in base_urls:
+        try:
+            model_key = _resolve_model_key(timeout=timeout, selected_model_key=model_key, base_url=base_url)
+        except Exception as e:
+            if len(base_urls) == 1:
+                raise
+            first_error = first_error or e
+            send_json_message('status', f'Skipping LM Studio endpoint {base_url}: {e}')
+            continue
+        urls.append(base_url)
+    if not urls:
+        raise RuntimeError(f'No LM Studio endpoint is usable. {first_error}')
+    return model_key, urls
+
+
 def _build_chat_payload(model_key, prompt, data_url, context_length=0):
     payload = {
         'model': model_key,
@@ -171,63 +226,226 @@ def _summarize_response_shape(payload):
     return f"top-level keys={list(payload.keys())}"
 
 
-def _generate_once(model_key, prompt, data_url, timeout, context_length=0):
-    request_payload = _build_chat_payload(model_key, prompt, data_url, context_length=context_length)
-    response_payload = _request_json('POST', '/api/v1/chat', json=request_payload, timeout=timeout)
-    text = _extract_message_text(response_payload)
+def _token_stats(payload):
+    stats = payload.get('stats') if isinstance(payload, dict) else None
+    if not isinstance(stats, dict):
+        return {}
+    return token_stats(
+        prompt_tokens=stats.get('input_tokens'),
+        completion_tokens=stats.get('total_output_tokens'),
+        tokens_per_second=stats.get('tokens_per_second'),
+    )
+
+
+def _build_chat_body(model_key, prompt, image_bytes, mime_type, context_length=0, stream=False, telemetry=None):
+    request_payload = _build_chat_payload(model_key, prompt, IMAGE_PLACEHOLDER, context_length=context_length)
+    request_payload['stream'] = stream
+    return build_json_body(request_payload, image_bytes, prefix=f'data:{mime_type};base64,', telemetry=telemetry)
+
+
+def _build_batch_body(model_key, prompt, images, context_length=0, telemetry=None):
+    request_payload = _build_chat_payload(model_key, build_batch_prompt(prompt, len(images)), IMAGE_PLACEHOLDER, context_length=context_length)
+    request_input = []
+    for number in range(1, len(images) + 1):
+        request_input.append({'type': 'text', 'content': image_label(number)})
+        request_input.append({'type': 'image', 'data_url': image_placeholder(number - 1)})
+    request_input.append(request_payload['input'][-1])
+    request_payload['input'] = request_input
+    return build_multi_image_body(
+        request_payload,
+        [(image_bytes, f'data:{mime_type};base64,') for image_bytes, mime_type in images],
+        telemetry=telemetry,
+    )
+
+
+def _generate_once(base_url, model_key, prompt, image_bytes, mime_type, timeout, context_length=0, telemetry=None):
+    body = _build_chat_body(model_key, prompt, image_bytes, mime_type, context_length=context_length, telemetry=telemetry)
+    return _post_chat(base_url, body, timeout, telemetry=telemetry)
+
+
+def _post_chat(base_url, body, timeout, telemetry=None):
+    headers = _headers()
+    headers['Content-Type'] = 'application/json'
+    with stage_timer(telemetry, 'request'):
+        response = _SESSION.post(f'{base_url}/api/v1/chat', headers=headers, data=body, timeout=timeout)
+    if response.status_code != 200:
+        raise _api_error(response)
+
+    with stage_timer(telemetry, 'parse'):
+        try:
+            response_payload = response.json()
+        except Exception as e:
+            raise ServerError(f'LM Studio returned invalid JSON: {e}')
+        text = _extract_message_text(response_payload)
+
+    if telemetry is not None:
+        telemetry.tokens = _token_stats(response_payload)
     if not text:
-        raise RuntimeError(f'LM Studio returned no text content. {_summarize_response_shape(response_payload)}')
+        raise ServerError(f'LM Studio returned no text content. {_summarize_response_shape(response_payload)}')
     return text
 
 
-def process_images_loop_lm(gen_params, model_key, resize_max=1280, image_format='auto', context_length=0, request_pause_seconds=0.0, **kwargs):
-    image_files = list_image_files(kwargs['input_dir'])
-    if not image_files:
-        raise ValueError('No images found in the input folder.')
+def _generate_stream(base_url, model_key, prompt, image_bytes, mime_type, timeout, collector, context_length=0, telemetry=None):
+    body = _build_chat_body(model_key, prompt, image_bytes, mime_type, context_length=context_length, stream=True, telemetry=telemetry)
+    headers = _headers()
+    headers['Accept'] = 'text/event-stream'
+    headers['Content-Type'] = 'application/json'
+    final_text = ''
 
-    total_images = len(image_files)
-    start_time = time.time()
-    timeout = int(gen_params.get('timeout', 600))
-    context_length = int(context_length or 0)
-    request_pause_seconds = float(request_pause_seconds or 0.0)
+    with stage_timer(telemetry, 'request'), _SESSION.post(f'{base_url}/api/v1/chat', headers=headers, data=body, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            raise _api_error(response)
 
-    for index, image_file in enumerate(image_files, start=1):
-        input_image_path = os.path.join(kwargs['input_dir'], image_file)
-        send_json_message('status', f'Processing image {index} of {total_images}...')
-
-        gen_type = kwargs['gen_type']
-        prompt_template = kwargs['prompt_templates'][gen_type]
-        prompt = build_user_prompt(
-            gen_type,
-            prompt_template,
-            kwargs['max_words'],
-            kwargs.get('trigger_words', ''),
-            kwargs.get('prompt_enrichment', ''),
-        )
+        for event_name, data in iter_sse_events(response):
+            try:
+                event = json.loads(data)
+            except ValueError:
+                continue
+            if not isinstance(event, dict):
+                continue
+            event_type = event.get('type') or event_name
+            if event_type == 'message.delta':
+                content = event.get('content')
+                if isinstance(content, str) and not collector.add(content):
+                    break
+            elif event_type == 'chat.end':
+                final_text = _extract_message_text(event.get('result'))
+                if telemetry is not None:
+                    telemetry.tokens = _token_stats(event.get('result'))
+            elif event_type == 'error':
+                error = event.get('error')
+                message = error.get('message') if isinstance(error, dict) else error
+                raise ServerError(f'LM Studio API error: {message or data}')
+
+    text = collector.finish().strip()
+    if final_text and not collector.stopped_reason:
+        text = final_text
+    if not text:
+        raise ServerError('LM Studio returned no text content.')
+    return text
 
-        base64_image, mime_type = encode_image(
-            input_image_path,
-            resize_max=resize_max,
-            image_format=image_format,
-            return_mime=True,
-        )
-        data_url = f'data:{mime_type};base64,{base64_image}'
 
-        raw_output = _generate_once(model_key, prompt, data_url, timeout, context_length=context_length)
+def _generate_batch(base_url, model_key, prompt, images, timeout, context_length=0, retry_policy=None):
+    """Caption several images with one request; falls back to one request per image if the answer cannot be split.
 
-        final_output = format_generation_output(
-            gen_type,
-            raw_output,
-            kwargs['max_words'],
-            kwargs['single_paragraph'],
-            kwargs.get('trigger_words', ''),
-        )
+    `images` holds (index, image_bytes, mime_type, telemetry). Overload and
+    connection errors are raised so the dispatcher can retry the whole group;
+    an image that fails on its own gets its exception in place of the output.
+    """
+    batch_telemetry = ImageTelemetry()
+    body = _build_batch_body(
+        model_key, prompt, [(image_bytes, mime_type) for _index, image_bytes, mime_type, _telemetry in images],
+        context_length=context_length, telemetry=batch_telemetry,
+    )
+    try:
+        outputs = split_batch_output(_post_chat(base_url, body, timeout, telemetry=batch_telemetry), len(images))
+        reason = 'the answer did not follow the batch format'
+    except Exception as e:
+        if is_retryable_error(e) and not isinstance(e, ServerError):
+            raise
+        outputs = None
+        reason = str(e)
+
+    if outputs is None:
+        send_json_message('status', f'Batch of images {images[0][0]}-{images[-1][0]} failed ({reason}). Retrying them one at a time...')
+        retry_policy = retry_policy or RetryPolicy()
+        return [
+            call_or_error(retry_policy, partial(
+                _generate_once, base_url, model_key, prompt, image_bytes, mime_type, timeout, context_length=context_length, telemetry=telemetry,
+            ))
+            for _index, image_bytes, mime_type, telemetry in images
+        ]
+
+    share_telemetry(batch_telemetry, [telemetry for *_rest, telemetry in images])
+    return outputs
+
+
+def process_images_loop_lm(gen_params, model_key, resize_max=1280, image_format='auto', context_length=0, request_pause_seconds=0.0, preprocess_workers=2, prefetch_images=4, image_cache=None, result_index=None, stream_output=False, stream_max_chars=0, stop_on_repetition=True, max_concurrency=1, adaptive_concurrency=True, decode_memory_mb=0, images_per_request=1, base_urls=(LM_HOST,), retry_policy=None, **kwargs):
+    timeout = int(gen_params.get('timeout', 600))
+    context_length = int(context_length or 0)
+    request_pause_seconds = float(request_pause_seconds or 0.0)
+    images_per_request = max(1, int(images_per_request or 1))
+    retry_policy = retry_policy or RetryPolicy()
+
+    run = CaptionRun('lm_studio', model_key, {
+        'resize_max': resize_max,
+        'image_format': image_format,
+        'max_concurrency': max_concurrency,
+        'images_per_request': images_per_request,
+        'stream_output': stream_output,
+    }, retry_policy, result_index=result_index, preprocess_workers=preprocess_workers, decode_memory_mb=decode_memory_mb, **kwargs)
+    prompt = run.prompt
+
+    request_params = {'context_length': context_length, 'resize_max': resize_max, 'image_format': image_format}
+    if images_per_request > 1:
+        request_params['images_per_request'] = images_per_request
+
+    pending_files, pending = tee(run.pending_images(model_key, request_params))
+
+    encoded_images = iter_encoded_images(
+        run.input_dir,
+        (image_file for _index, image_file, _key in pending_files),
+        resize_max=resize_max,
+        image_format=image_format,
+        workers=preprocess_workers,
+        prefetch=max(int(prefetch_images or 0), images_per_request),
+        cache=image_cache,
+        decode_memory_mb=decode_memory_mb,
+        return_errors=True,
+    )
 
-        write_generation_output(kwargs['output_dir'], image_file, gen_type, final_output)
-        send_json_message('progress', build_progress_payload(index, total_images, start_time))
-        send_json_message('image-complete', {'index': index})
-        if request_pause_seconds > 0 and index < total_images:
-            time.sleep(request_pause_seconds)
+    def generate_loaded(loaded, endpoint):
+        for index, *_rest in loaded:
+            send_json_message('status', f'Processing image {index} of {run.total}...', coalesce=True)
+        if len(loaded) > 1:
+            images = [(index, image_bytes, mime_type, telemetry) for index, _image_file, image_bytes, mime_type, telemetry in loaded]
+            return _generate_batch(endpoint.url, model_key, prompt, images, timeout, context_length=context_length, retry_policy=retry_policy)
+
+        index, image_file, image_bytes, mime_type, telemetry = loaded[0]
+        if stream_output:
+            collector = StreamCollector(index, image_file, max_chars=stream_max_chars, stop_on_repetition=stop_on_repetition)
+            return [_generate_stream(
+                endpoint.url, model_key, prompt, image_bytes, mime_type, timeout, collector,
+                context_length=context_length, telemetry=telemetry,
+            )]
+        return [_generate_once(
+            endpoint.url, model_key, prompt, image_bytes, mime_type, timeout, context_length=context_length, telemetry=telemetry,
+        )]
+
+    def generate(group, endpoint):
+        # An image that failed to load keeps its error in place of the output.
+        loaded = [
+            (index, image_file, image_bytes, mime_type, telemetry)
+            for (index, image_file, _result_key), (_file, image_bytes, mime_type, telemetry) in group
+            if not isinstance(image_bytes, Exception)
+        ]
+        outputs = iter(generate_loaded(loaded, endpoint) if loaded else ())
+        return [image_bytes if isinstance(image_bytes, Exception) else next(outputs) for _item, (_file, image_bytes, *_rest) in group]
+
+    def health_check(endpoint):
+        return _resolve_model_key(timeout=10, selected_model_key=model_key, base_url=endpoint.url) == model_key
+
+    finished = False
+    endpoints = [Endpoint(url, max_concurrency, adaptive=adaptive_concurrency) for url in base_urls]
+    try:
+        run_adaptive(
+            chunked(zip(pending, encoded_images), images_per_request),
+            generate,
+            run.on_result,
+            endpoints,
+            pause_seconds=request_pause_seconds,
+            retry_policy=retry_policy,
+            health_check=health_check,
+            on_status=lambda message: send_json_message('status', message),
+            on_failure=run.on_failure,
+        )
+        run.complete_cached()
+        finished = True
+    finally:
+        run.close(finished)
+    if len(endpoints) > 1:
+        per_endpoint = ', '.join(f'{endpoint.url}: {endpoint.completed}' for endpoint in endpoints)
+        send_json_message('status', f'Images per endpoint: {per_endpoint}')
 
 
 def run_lm_studio_generation(config, selected_model_key='', **kwargs):
@@ -238,14 +456,44 @@ def run_lm_studio_generation(config, selected_model_key='', **kwargs):
     image_format = config.get('generation_params', 'image_format', fallback='auto')
     context_length = config.getint('generation_params', 'context_length', fallback=16384)
     request_pause_seconds = config.getfloat('generation_params', 'request_pause_seconds', fallback=0.25)
-
-    model_key = _resolve_model_key(timeout=min(timeout, 30), selected_model_key=selected_model_key)
-    process_images_loop_lm(
-        {'timeout': timeout},
-        model_key=model_key,
-        resize_max=resize_max,
-        image_format=image_format,
-        context_length=context_length,
-        request_pause_seconds=request_pause_seconds,
-        **kwargs,
+    preprocess_workers = config.getint('generation_params', 'preprocess_workers', fallback=2)
+    prefetch_images = config.getint('generation_params', 'prefetch_images', fallback=4)
+    decode_memory_mb = config.getfloat('generation_params', 'decode_memory_mb', fallback=0)
+    stream_output = config.getboolean('generation_params', 'stream_output', fallback=False)
+    stream_max_chars = config.getint('generation_params', 'stream_max_chars', fallback=0)
+    stop_on_repetition = config.getboolean('generation_params', 'stop_on_repetition', fallback=True)
+    max_concurrency = config.getint('generation_params', 'max_concurrency', fallback=1)
+    adaptive_concurrency = config.getboolean('generation_params', 'adaptive_concurrency', fallback=True)
+    images_per_request = config.getint('generation_params', 'images_per_request', fallback=1)
+
+    model_key, base_urls = _resolve_endpoints(
+        _base_urls(config), timeout=min(timeout, 30), selected_model_key=selected_model_key,
     )
+    result_index = open_result_index(config)
+    image_cache = open_image_cache(config, file_hasher=result_index.file_hash if result_index else None)
+    try:
+        process_images_loop_lm(
+            {'timeout': timeout},
+            model_key=model_key,
+            resize_max=resize_max,
+            image_format=image_format,
+            context_length=context_length,
+            request_pause_seconds=request_pause_seconds,
+            preprocess_workers=preprocess_workers,
+            prefetch_images=prefetch_images,
+            decode_memory_mb=decode_memory_mb,
+            image_cache=image_cache,
+            result_index=result_index,
+            stream_output=stream_output,
+            stream_max_chars=stream_max_chars,
+            stop_on_repetition=stop_on_repetition,
+            max_concurrency=max_concurrency,
+            adaptive_concurrency=adaptive_concurrency,
+            images_per_request=images_per_request,
+            base_urls=base_urls,
+            retry_policy=retry_policy_from_config(config),
+            **kwargs,
+        )
+    finally:
+        if result_index is not None:
+            result_index.close()
@@ -1,3 +1,4 @@
+import math
 from dataclasses import dataclass
 
 
@@ -10,10 +11,60 @@ class ModelFile:
     sha256: str | None = None
 
 
+@dataclass(frozen=True)
+class VisionGrid:
+    """How a vision projector turns image pixels into prompt tokens.
+
+    The encoder cuts the image into patch_size pixel patches and merges each
+    merge_size x merge_size block into one token, so a token covers one tile
+    of patch_size * merge_size pixels; extra_tokens are the markers around
+    every image.
+    """
+    patch_size: int
+    merge_size: int = 1
+    token_budget: int = 256
+    extra_tokens: int = 0
+
+    @property
+    def tile(self):
+        return self.patch_size * self.merge_size
+
+    def image_tokens(self, width, height):
+        return math.ceil(width / self.tile) * math.ceil(height / self.tile) + self.extra_tokens
+
+    def fit(self, width, height, max_side=0):
+        """Size within max_side and the token budget at one aspect-preserving scale, each side rounded down to whole tiles.
+
+        Images are never enlarged; a side shorter than one tile keeps its length.
+        """
+        tile = self.tile
+        budget = max(1, self.token_budget - self.extra_tokens)
+        scale = min(1.0, max_side / max(width, height)) if max_side else 1.0
+        scale = min(scale, math.sqrt(budget * tile * tile / (width * height)))
+        cols = max(1, math.floor(width * scale / tile))
+        rows = max(1, math.floor(height * scale / tile))
+        # Only a side held at one tile can push a strip over the budget.
+        cols = max(1, min(cols, budget // rows))
+        rows = min(rows, budget // cols)
+        return min(cols * tile, max(1, round(width * scale))), min(rows * tile, max(1, round(height * scale)))
+
+    def cache_tag(self):
+        return f"grid{self.patch_size}x{self.merge_size}:{self.token_budget - self.extra_tokens}"
+
+
+# 16 px patches pooled 3x3; 1120 tokens is the largest Gemma 4 image budget, so only images
+# past the default resize_max are shrunk by it.
+GEMMA4_VISION_GRID = VisionGrid(patch_size=16, merge_size=3, token_budget=1120, extra_tokens=2)
+# Qwen-style vision tower: 16 px patches with a 2x2 spatial merge. 1024 tokens is about a
+# megapixel, so the budget also shrinks most images at the default resize_max.
+QWEN_VISION_GRID = VisionGrid(patch_size=16, merge_size=2, token_budget=1024, extra_tokens=2)
+
+
 @dataclass(frozen=True)
 class ModelBundle:
     model: ModelFile
     vision: ModelFile
+    vision_grid: VisionGrid | None = None
 
 
 E2B_VISION_MODEL = ModelFile(
@@ -50,6 +101,7 @@ MODEL_BUNDLES = {
             "aa866c1e514468f3d0f33971679d63c11b7c9c47acddd1cc5785fc467e52c21d",
         ),
         vision=E2B_VISION_MODEL,
+        vision_grid=GEMMA4_VISION_GRID,
     ),
     "8GB VRAM (E4B Q4_K_P)": ModelBundle(
         model=ModelFile(
@@ -60,6 +112,7 @@ MODEL_BUNDLES = {
             "05146429870f4ec4c16882f44bec29c51e4797463ad7080044a5c748cabb2486",
         ),
         vision=E4B_VISION_MODEL,
+        vision_grid=GEMMA4_VISION_GRID,
     ),
     "10GB+ VRAM (E4B Q8_K_P)": ModelBundle(
         model=ModelFile(
@@ -70,6 +123,7 @@ MODEL_BUNDLES = {
             "a4c4177f9fd7e3f56522675afb742f079a53f9226195b7db5e9888c872f053da",
         ),
         vision=E4B_VISION_MODEL,
+        vision_grid=GEMMA4_VISION_GRID,
     ),
     "8GB VRAM (NSFW Q4_K_M)": ModelBundle(
         model=ModelFile(
@@ -80,6 +134,7 @@ MODEL_BUNDLES = {
             "f255b79a9619019468e1ac972d2ab17a13b9482bc145f74e6910c85ada6cea46",
         ),
         vision=NSFW_VISION_MODEL,
+        vision_grid=QWEN_VISION_GRID,
     ),
     "12GB VRAM (NSFW Q8_0)": ModelBundle(
         model=ModelFile(
@@ -90,6 +145,7 @@ MODEL_BUNDLES = {
             "bf2992e296059a21755f919a495bc2b22ac67cc51603ed0b0b04bfed2448ed94",
         ),
         vision=NSFW_VISION_MODEL,
+        vision_grid=QWEN_VISION_GRID,
     ),
 }
 
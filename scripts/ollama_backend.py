@@ -1,27 +1,47 @@
 import os
 import sys
-import time
-
-import requests
+from functools import partial
+from itertools import tee
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 if SCRIPT_DIR not in sys.path:
     sys.path.insert(0, SCRIPT_DIR)
 
-from utils import (
-    build_user_prompt,
-    build_progress_payload,
-    encode_image,
-    format_generation_output,
-    list_image_files,
-    send_json_message,
-    write_generation_output,
+from batching import build_batch_prompt, chunked, split_batch_output
+from caption_run import CaptionRun
+from dispatch import (
+    Endpoint,
+    RetryPolicy,
+    ServerError,
+    api_error_class,
+    call_or_error,
+    create_session,
+    is_retryable_error,
+    retry_policy_from_config,
+    run_adaptive,
 )
+from events import send_json_message
+from image_cache import open_image_cache
+from request_body import build_multi_image_body, image_placeholder
+from result_cache import open_result_index
+from streaming import StreamCollector, iter_ndjson
+from telemetry import ImageTelemetry, share_telemetry, stage_timer, token_stats
+from utils import iter_encoded_images
+
 
+OLLAMA_HOST = 'http://127.0.0.1:11434'
+# Shared so connections stay open between images and, in worker mode, between jobs.
+_SESSION = create_session()
 
-def _base_url(config):
-    base_url = config.get('generation_params', 'base_url', fallback='http://127.0.0.1:11434')
-    return base_url.rstrip('/')
+
+def _base_urls(config):
+    value = config.get('generation_params', 'base_url', fallback=OLLAMA_HOST)
+    urls = []
+    for url in value.split(','):
+        url = url.strip().rstrip('/')
+        if url and url not in urls:
+            urls.append(url)
+    return urls or [OLLAMA_HOST]
 
 
 def _headers():
@@ -32,41 +52,68 @@ def _headers():
     return headers
 
 
-def _request_json(config, method, endpoint, **kwargs):
-    url = f'{_base_url(config)}{endpoint}'
+def _response_error_text(response):
+    message = response.text.strip()
+    try:
+        payload = response.json()
+        error = payload.get('error')
+        if isinstance(error, str):
+            message = error
+        elif payload.get('message'):
+            message = payload.get('message')
+    except Exception:
+        pass
+    return message
+
+
+def _api_error(response):
+    return api_error_class(response.status_code)(f'Ollama API error {response.status_code}: {_response_error_text(response)}')
+
+
+def _request_json(base_url, method, endpoint, **kwargs):
+    url = f'{base_url}{endpoint}'
     headers = _headers()
     if 'json' in kwargs:
         headers['Content-Type'] = 'application/json'
-    response = requests.request(method, url, headers=headers, **kwargs)
+    response = _SESSION.request(method, url, headers=headers, **kwargs)
     if response.status_code != 200:
-        message = response.text.strip()
-        try:
-            payload = response.json()
-            error = payload.get('error')
-            if isinstance(error, str):
-                message = error
-            elif payload.get('message'):
-                message = payload.get('message')
-        except Exception:
-            pass
-        raise RuntimeError(f'Ollama API error {response.status_code}: {message}')
+        raise _api_error(response)
     try:
         return response.json()
     except Exception as e:
         raise RuntimeError(f'Ollama returned invalid JSON: {e}')
 
 
-def _validate_model(config, model_key, timeout=30):
+def _validate_model(base_url, model_key, timeout=30):
     if not model_key:
         raise RuntimeError('No Ollama model was selected. Select an Ollama vision model first.')
 
-    payload = _request_json(config, 'POST', '/api/show', json={'model': model_key}, timeout=timeout)
+    payload = _request_json(base_url, 'POST', '/api/show', json={'model': model_key}, timeout=timeout)
     capabilities = payload.get('capabilities') or []
     if 'vision' not in capabilities:
         raise RuntimeError('Selected Ollama model does not support vision input.')
     return model_key
 
 
+def _validate_endpoints(base_urls, model_key, timeout=30):
+    """Validate the model on every endpoint and return the ones that can serve it."""
+    urls = []
+    first_error = None
+    for base_url in base_urls:
+        try:
+            _validate_model(base_url, model_key, timeout=timeout)
+        except Exception as e:
+            if len(base_urls) == 1:
+                raise
+            first_error = first_error or e
+            send_json_message('status', f'Skipping Ollama endpoint {base_url}: {e}')
+            continue
+        urls.append(base_url)
+    if not urls:
+        raise RuntimeError(f'No Ollama endpoint is usable. {first_error}')
+    return urls
+
+
 def _normalize_keep_alive(value):
     text = str(value).strip()
     try:
@@ -87,79 +134,232 @@ def _extract_response_text(payload):
     return ''
 
 
-def _generate_once(config, model_key, prompt, base64_image, timeout, context_length=0, keep_alive='-1'):
+def _build_generate_body(model_key, prompt, images, context_length=0, keep_alive='-1', stream=False, telemetry=None):
     payload = {
         'model': model_key,
         'prompt': prompt,
-        'images': [base64_image],
-        'stream': False,
+        'images': [image_placeholder(position) for position in range(len(images))],
+        'stream': stream,
         'keep_alive': keep_alive,
     }
     if context_length and int(context_length) > 0:
         payload['options'] = {'num_ctx': int(context_length)}
+    return build_multi_image_body(payload, [(image_bytes, '') for image_bytes in images], telemetry=telemetry)
+
+
+def _token_stats(payload):
+    if not isinstance(payload, dict) or 'eval_count' not in payload:
+        return {}
+    eval_duration = payload.get('eval_duration')
+    return token_stats(
+        prompt_tokens=payload.get('prompt_eval_count'),
+        completion_tokens=payload.get('eval_count'),
+        generation_seconds=eval_duration / 1e9 if eval_duration else None,
+    )
 
-    response_payload = _request_json(config, 'POST', '/api/generate', json=payload, timeout=timeout)
-    text = _extract_response_text(response_payload)
+
+def _generate_once(base_url, model_key, prompt, image_bytes, timeout, context_length=0, keep_alive='-1', telemetry=None):
+    body = _build_generate_body(
+        model_key, prompt, [image_bytes], context_length=context_length, keep_alive=keep_alive, telemetry=telemetry,
+    )
+    return _post_generate(base_url, body, timeout, telemetry=telemetry)
+
+
+def _post_generate(base_url, body, timeout, telemetry=None):
+    headers = _headers()
+    headers['Content-Type'] = 'application/json'
+    with stage_timer(telemetry, 'request'):
+        response = _SESSION.post(f'{base_url}/api/generate', headers=headers, data=body, timeout=timeout)
+    if response.status_code != 200:
+        raise _api_error(response)
+
+    with stage_timer(telemetry, 'parse'):
+        try:
+            response_payload = response.json()
+        except Exception as e:
+            raise ServerError(f'Ollama returned invalid JSON: {e}')
+        text = _extract_response_text(response_payload)
+
+    if telemetry is not None:
+        telemetry.tokens = _token_stats(response_payload)
+    if not text:
+        raise ServerError(f'Ollama returned no text content. Response keys={list(response_payload.keys())}')
+    return text
+
+
+def _generate_stream(base_url, model_key, prompt, image_bytes, timeout, collector, context_length=0, keep_alive='-1', telemetry=None):
+    body = _build_generate_body(
+        model_key, prompt, [image_bytes], context_length=context_length, keep_alive=keep_alive, stream=True, telemetry=telemetry,
+    )
+    headers = _headers()
+    headers['Content-Type'] = 'application/json'
+
+    with stage_timer(telemetry, 'request'), _SESSION.post(f'{base_url}/api/generate', headers=headers, data=body, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            raise _api_error(response)
+
+        for chunk in iter_ndjson(response):
+            if not isinstance(chunk, dict):
+                continue
+            if chunk.get('error'):
+                raise ServerError(f"Ollama API error: {chunk['error']}")
+            delta = chunk.get('response')
+            if isinstance(delta, str) and not collector.add(delta):
+                break
+            if chunk.get('done'):
+                if telemetry is not None:
+                    telemetry.tokens = _token_stats(chunk)
+                break
+
+    text = collector.finish().strip()
     if not text:
-        raise RuntimeError(f'Ollama returned no text content. Response keys={list(response_payload.keys())}')
+        raise ServerError('Ollama returned no text content.')
     return text
 
 
-def process_images_loop_ollama(config, model_key, resize_max=1280, image_format='auto', context_length=0, keep_alive='-1', request_pause_seconds=0.0, **kwargs):
-    image_files = list_image_files(kwargs['input_dir'])
-    if not image_files:
-        raise ValueError('No images found in the input folder.')
+def _generate_batch(base_url, model_key, prompt, images, timeout, retry_policy, context_length=0, keep_alive='-1'):
+    """Caption several images with one request; falls back to one request per image if the answer cannot be split.
 
-    total_images = len(image_files)
-    start_time = time.time()
+    `images` holds (index, image_bytes, telemetry). Overload and connection
+    errors are raised so the dispatcher can retry the whole group; an image
+    that fails on its own gets its exception in place of the output.
+    """
+    batch_telemetry = ImageTelemetry()
+    body = _build_generate_body(
+        model_key,
+        build_batch_prompt(prompt, len(images)),
+        [image_bytes for _index, image_bytes, _telemetry in images],
+        context_length=context_length,
+        keep_alive=keep_alive,
+        telemetry=batch_telemetry,
+    )
+    try:
+        outputs = split_batch_output(_post_generate(base_url, body, timeout, telemetry=batch_telemetry), len(images))
+        reason = 'the answer did not follow the batch format'
+    except Exception as e:
+        if is_retryable_error(e) and not isinstance(e, ServerError):
+            raise
+        outputs = None
+        reason = str(e)
+
+    if outputs is None:
+        send_json_message('status', f'Batch of images {images[0][0]}-{images[-1][0]} failed ({reason}). Retrying them one at a time...')
+        return [
+            call_or_error(retry_policy, partial(
+                _generate_once, base_url, model_key, prompt, image_bytes, timeout,
+                context_length=context_length, keep_alive=keep_alive, telemetry=telemetry,
+            ))
+            for _index, image_bytes, telemetry in images
+        ]
+
+    share_telemetry(batch_telemetry, [telemetry for _index, _image_bytes, telemetry in images])
+    return outputs
+
+
+def process_images_loop_ollama(config, model_key, resize_max=1280, image_format='auto', context_length=0, keep_alive='-1', request_pause_seconds=0.0, preprocess_workers=2, prefetch_images=4, image_cache=None, result_index=None, stream_output=False, stream_max_chars=0, stop_on_repetition=True, max_concurrency=1, adaptive_concurrency=True, decode_memory_mb=0, images_per_request=1, base_urls=None, retry_policy=None, **kwargs):
     timeout = config.getint('generation_params', 'timeout', fallback=600)
+    base_urls = base_urls or _base_urls(config)
     context_length = int(context_length or 0)
     request_pause_seconds = float(request_pause_seconds or 0.0)
+    images_per_request = max(1, int(images_per_request or 1))
+    retry_policy = retry_policy or RetryPolicy()
+
+    run = CaptionRun('ollama', model_key, {
+        'resize_max': resize_max,
+        'image_format': image_format,
+        'max_concurrency': max_concurrency,
+        'images_per_request': images_per_request,
+        'stream_output': stream_output,
+    }, retry_policy, result_index=result_index, preprocess_workers=preprocess_workers, decode_memory_mb=decode_memory_mb, **kwargs)
+    prompt = run.prompt
+
+    request_params = {'context_length': context_length, 'resize_max': resize_max, 'image_format': image_format}
+    if images_per_request > 1:
+        request_params['images_per_request'] = images_per_request
+
+    pending_files, pending = tee(run.pending_images(model_key, request_params))
+
+    encoded_images = iter_encoded_images(
+        run.input_dir,
+        (image_file for _index, image_file, _key in pending_files),
+        resize_max=resize_max,
+        image_format=image_format,
+        workers=preprocess_workers,
+        prefetch=max(int(prefetch_images or 0), images_per_request),
+        cache=image_cache,
+        decode_memory_mb=decode_memory_mb,
+        return_errors=True,
+    )
 
-    for index, image_file in enumerate(image_files, start=1):
-        input_image_path = os.path.join(kwargs['input_dir'], image_file)
-        send_json_message('status', f'Processing image {index} of {total_images}...')
-
-        gen_type = kwargs['gen_type']
-        prompt_template = kwargs['prompt_templates'][gen_type]
-        prompt = build_user_prompt(
-            gen_type,
-            prompt_template,
-            kwargs['max_words'],
-            kwargs.get('trigger_words', ''),
-            kwargs.get('prompt_enrichment', ''),
-        )
-
-        base64_image = encode_image(
-            input_image_path,
-            resize_max=resize_max,
-            image_format=image_format,
-            return_mime=False,
-        )
-
-        raw_output = _generate_once(
-            config,
+    def generate_loaded(loaded, endpoint):
+        for index, *_rest in loaded:
+            send_json_message('status', f'Processing image {index} of {run.total}...', coalesce=True)
+        if len(loaded) > 1:
+            images = [(index, image_bytes, telemetry) for index, _image_file, image_bytes, telemetry in loaded]
+            return _generate_batch(
+                endpoint.url, model_key, prompt, images, timeout, retry_policy, context_length=context_length, keep_alive=keep_alive,
+            )
+
+        index, image_file, image_bytes, telemetry = loaded[0]
+        if stream_output:
+            collector = StreamCollector(index, image_file, max_chars=stream_max_chars, stop_on_repetition=stop_on_repetition)
+            return [_generate_stream(
+                endpoint.url,
+                model_key,
+                prompt,
+                image_bytes,
+                timeout,
+                collector,
+                context_length=context_length,
+                keep_alive=keep_alive,
+                telemetry=telemetry,
+            )]
+        return [_generate_once(
+            endpoint.url,
             model_key,
             prompt,
-            base64_image,
+            image_bytes,
             timeout,
             context_length=context_length,
             keep_alive=keep_alive,
+            telemetry=telemetry,
+        )]
+
+    def generate(group, endpoint):
+        # An image that failed to load keeps its error in place of the output.
+        loaded = [
+            (index, image_file, image_bytes, telemetry)
+            for (index, image_file, _result_key), (_file, image_bytes, _mime_type, telemetry) in group
+            if not isinstance(image_bytes, Exception)
+        ]
+        outputs = iter(generate_loaded(loaded, endpoint) if loaded else ())
+        return [image_bytes if isinstance(image_bytes, Exception) else next(outputs) for _item, (_file, image_bytes, *_rest) in group]
+
+    def health_check(endpoint):
+        _validate_model(endpoint.url, model_key, timeout=10)
+        return True
+
+    finished = False
+    endpoints = [Endpoint(url, max_concurrency, adaptive=adaptive_concurrency) for url in base_urls]
+    try:
+        run_adaptive(
+            chunked(zip(pending, encoded_images), images_per_request),
+            generate,
+            run.on_result,
+            endpoints,
+            pause_seconds=request_pause_seconds,
+            retry_policy=retry_policy,
+            health_check=health_check,
+            on_status=lambda message: send_json_message('status', message),
+            on_failure=run.on_failure,
         )
-
-        final_output = format_generation_output(
-            gen_type,
-            raw_output,
-            kwargs['max_words'],
-            kwargs['single_paragraph'],
-            kwargs.get('trigger_words', ''),
-        )
-
-        write_generation_output(kwargs['output_dir'], image_file, gen_type, final_output)
-        send_json_message('progress', build_progress_payload(index, total_images, start_time))
-        send_json_message('image-complete', {'index': index})
-        if request_pause_seconds > 0 and index < total_images:
-            time.sleep(request_pause_seconds)
+        run.complete_cached()
+        finished = True
+    finally:
+        run.close(finished)
+    if len(endpoints) > 1:
+        per_endpoint = ', '.join(f'{endpoint.url}: {endpoint.completed}' for endpoint in endpoints)
+        send_json_message('status', f'Images per endpoint: {per_endpoint}')
 
 
 def run_ollama_generation(config, selected_model_key='', **kwargs):
@@ -171,15 +371,46 @@ def run_ollama_generation(config, selected_model_key='', **kwargs):
     context_length = config.getint('generation_params', 'context_length', fallback=24576)
     keep_alive = _normalize_keep_alive(config.get('generation_params', 'keep_alive', fallback='-1'))
     request_pause_seconds = config.getfloat('generation_params', 'request_pause_seconds', fallback=0.25)
-
-    model_key = _validate_model(config, selected_model_key, timeout=min(timeout, 30))
-    process_images_loop_ollama(
-        config,
-        model_key=model_key,
-        resize_max=resize_max,
-        image_format=image_format,
-        context_length=context_length,
-        keep_alive=keep_alive,
-        request_pause_seconds=request_pause_seconds,
-        **kwargs,
-    )
+    preprocess_workers = config.getint('generation_params', 'preprocess_workers', fallback=2)
+    prefetch_images = config.getint('generation_params', 'prefetch_images', fallback=4)
+    decode_memory_mb = config.getfloat('generation_params', 'decode_memory_mb', fallback=0)
+    stream_output = config.getboolean('generation_params', 'stream_output', fallback=False)
+    stream_max_chars = config.getint('generation_params', 'stream_max_chars', fallback=0)
+    stop_on_repetition = config.getboolean('generation_params', 'stop_on_repetition', fallback=True)
+    max_concurrency = config.getint('generation_params', 'max_concurrency', fallback=1)
+    adaptive_concurrency = config.getboolean('generation_params', 'adaptive_concurrency', fallback=True)
+    images_per_request = config.getint('generation_params', 'images_per_request', fallback=1)
+
+    if not selected_model_key:
+        raise RuntimeError('No Ollama model was selected. Select an Ollama vision model first.')
+    base_urls = _validate_endpoints(_base_urls(config), selected_model_key, timeout=min(timeout, 30))
+    model_key = selected_model_key
+    result_index = open_result_index(config)
+    image_cache = open_image_cache(config, file_hasher=result_index.file_hash if result_index else None)
+    try:
+        process_images_loop_ollama(
+            config,
+            model_key=model_key,
+            resize_max=resize_max,
+            image_format=image_format,
+            context_length=context_length,
+            keep_alive=keep_alive,
+            request_pause_seconds=request_pause_seconds,
+            preprocess_workers=preprocess_workers,
+            prefetch_images=prefetch_images,
+            decode_memory_mb=decode_memory_mb,
+            image_cache=image_cache,
+            result_index=result_index,
+            stream_output=stream_output,
+            stream_max_chars=stream_max_chars,
+            stop_on_repetition=stop_on_repetition,
+            max_concurrency=max_concurrency,
+            adaptive_concurrency=adaptive_concurrency,
+            images_per_request=images_per_request,
+            base_urls=base_urls,
+            retry_policy=retry_policy_from_config(config),
+            **kwargs,
+        )
+    finally:
+        if result_index is not None:
+            result_index.close()
@@ -0,0 +1,131 @@
+import json
+import os
+import queue
+import threading
+import uuid
+
+from dataset import OUTPUT_MODES
+from telemetry import stage_timer
+from utils import write_generation_output
+
+METADATA_FILE = 'metadata.jsonl'
+_STOP = object()
+
+
+def _read_lines(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return [line for line in f.read().splitlines() if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def _merge_records(lines):
+    records = {}
+    for line in lines:
+        try:
+            file_name = json.loads(line).get('file_name')
+        except (ValueError, AttributeError):
+            continue
+        if file_name:
+            records[file_name] = line
+    return list(records.values())
+
+
+class OutputWriter:
+    """Writes generation outputs on a background thread, off the inference loop.
+
+    'files' writes one text file per image, 'metadata' appends one line per
+    image to metadata.jsonl in the Hugging Face image dataset format, 'both'
+    does both. metadata.jsonl goes in the output folder; file_name is the
+    image's path relative to the input folder, which is where the app puts
+    its copy of the image in the output folder, and with beside_source the
+    two folders are the same. Lines are appended to
+    metadata.jsonl.partial, which starts from the current metadata.jsonl and
+    whatever an interrupted run left in the partial file; close(publish=True)
+    merges them by file_name, the newest line winning, into metadata.jsonl.
+    Each write is timed as the 'write' stage of the telemetry passed with it.
+    A write error stops the writer and is raised by the next write() or by
+    close().
+    """
+
+    def __init__(self, output_dir, input_dir, gen_type, mode='files', max_pending=256):
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output_mode '{mode}'. Use one of: {', '.join(OUTPUT_MODES)}.")
+        self.output_dir = output_dir
+        self.input_dir = input_dir
+        self.gen_type = gen_type
+        self.mode = mode
+        self.error = None
+        self._queue = queue.Queue(maxsize=max(1, int(max_pending)))
+        self._metadata = None
+        self._metadata_path = os.path.join(output_dir, METADATA_FILE)
+        self._partial_path = f'{self._metadata_path}.partial'
+        if mode != 'files':
+            os.makedirs(output_dir, exist_ok=True)
+            seed = _read_lines(self._metadata_path) + _read_lines(self._partial_path)
+            self._metadata = open(self._partial_path, 'w', encoding='utf-8')
+            self._metadata.writelines(line + '\n' for line in seed)
+            self._metadata.flush()
+        self._thread = threading.Thread(target=self._run, name='output-writer', daemon=True)
+        self._thread.start()
+
+    def _file_name(self, image_file):
+        return os.path.normpath(image_file).replace(os.sep, '/')
+
+    def _write(self, image_file, final_output, duplicates, telemetry):
+        with stage_timer(telemetry, 'write'):
+            self._write_outputs(image_file, final_output, duplicates)
+
+    def _write_outputs(self, image_file, final_output, duplicates):
+        if self.mode != 'metadata':
+            write_generation_output(self.output_dir, image_file, self.gen_type, final_output, duplicates)
+        if self._metadata is not None:
+            for target_file in (image_file, *duplicates):
+                record = {'file_name': self._file_name(target_file), 'text': final_output}
+                self._metadata.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._metadata.flush()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if self.error is None:
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    self.error = e
+
+    def _publish(self):
+        temp_path = f'{self._metadata_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.writelines(line + '\n' for line in _merge_records(_read_lines(self._partial_path)))
+            os.replace(temp_path, self._metadata_path)
+            os.remove(self._partial_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def write(self, image_file, final_output, duplicates=(), telemetry=None):
+        if self.error is not None:
+            raise RuntimeError(f'Failed to write output: {self.error}') from self.error
+        self._queue.put((image_file, final_output, tuple(duplicates), telemetry))
+
+    def close(self, publish=True):
+        """Wait for every queued output, then publish metadata.jsonl unless publish is False or a write failed."""
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._metadata is not None:
+            self._metadata.close()
+            if publish and self.error is None:
+                try:
+                    self._publish()
+                except OSError as e:
+                    self.error = e
+        if self.error is not None:
+            raise RuntimeError(f'Failed to write output: {self.error}') from self.error
@@ -0,0 +1,67 @@
+import binascii
+import json
+
+from telemetry import stage_timer
+
+# Multiple of 3 so every chunk encodes to whole base64 quanta without padding.
+_CHUNK_BYTES = 3 * 64 * 1024
+
+
+def image_placeholder(position):
+    """String that stands in for image `position` while the rest of the payload is serialized."""
+    return f'\x00caption-creator-image-{position}\x00'
+
+
+IMAGE_PLACEHOLDER = image_placeholder(0)
+
+
+def base64_length(byte_count):
+    return 4 * ((byte_count + 2) // 3)
+
+
+def build_json_body(payload, image_bytes, prefix='', telemetry=None):
+    """Serialize `payload` to a JSON request body with one image base64-encoded in place of IMAGE_PLACEHOLDER."""
+    return build_multi_image_body(payload, [(image_bytes, prefix)], telemetry=telemetry)
+
+
+def build_multi_image_body(payload, images, telemetry=None):
+    """Serialize `payload` to a JSON request body with images base64-encoded in place.
+
+    `images` is a list of (image_bytes, prefix); image i replaces
+    image_placeholder(i), which must appear exactly once in the payload, with
+    prefix plus its base64. The base64 text is written chunk by chunk into one
+    preallocated buffer, so neither a base64 string nor a data URL copy of an
+    image is ever built.
+    """
+    serialized = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    pieces = []
+    position = 0
+    for i, (image_bytes, prefix) in enumerate(images):
+        marker = json.dumps(image_placeholder(i)).encode('ascii')
+        start = serialized.find(marker, position)
+        if start < 0:
+            raise ValueError(f'Request payload has no placeholder for image {i + 1}.')
+        source = memoryview(image_bytes).cast('B')
+        pieces.append((serialized[position:start], prefix.encode('ascii'), source))
+        position = start + len(marker)
+    tail = serialized[position:]
+
+    size = len(tail) + sum(len(text) + len(prefix) + base64_length(len(source)) + 2 for text, prefix, source in pieces)
+    body = bytearray(size)
+    offset = 0
+
+    def put(data):
+        nonlocal offset
+        body[offset:offset + len(data)] = data
+        offset += len(data)
+
+    with stage_timer(telemetry, 'base64'):
+        for text, prefix, source in pieces:
+            put(text)
+            put(b'"')
+            put(prefix)
+            for chunk_start in range(0, len(source), _CHUNK_BYTES):
+                put(binascii.b2a_base64(source[chunk_start:chunk_start + _CHUNK_BYTES], newline=False))
+            put(b'"')
+        put(tail)
+    return body
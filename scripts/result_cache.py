@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from image_cache import FILE_HASHES_TABLE, memoized_file_hash
+from events import send_json_message
+
+
+def make_result_key(image_hash, model_identity, prompt, params):
+    material = json.dumps([image_hash, model_identity, prompt, params], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResultIndex:
+    """SQLite index of raw model outputs keyed by image content, model, prompt and params.
+
+    File hashes are memoized by (path, size, mtime), so unchanged files are
+    recognized with a stat call instead of being read again.
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(FILE_HASHES_TABLE)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, raw_output TEXT NOT NULL, created REAL NOT NULL)'
+        )
+        self._conn.commit()
+
+    def file_hash(self, file_path):
+        return memoized_file_hash(self._conn, self._lock, file_path)
+
+    def lookup(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT raw_output FROM results WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def store(self, key, raw_output):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results (key, raw_output, created) VALUES (?, ?, ?)',
+                (key, raw_output, time.time()),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def model_file_identity(file_path, sha256=None):
+    """The catalog digest of a model file, or its name, size and mtime, so a file swapped in under the same name is a new model."""
+    if sha256:
+        return sha256
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return os.path.basename(file_path)
+    return f'{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def open_result_index(config):
+    """Return the ResultIndex described by the [cache] section, or None when disabled."""
+    if not config.has_section('cache') or not config.getboolean('cache', 'result_cache', fallback=False):
+        return None
+    cache_dir = config.get('cache', 'cache_dir', fallback='').strip()
+    if not cache_dir:
+        return None
+    try:
+        return ResultIndex(os.path.join(cache_dir, 'results.sqlite3'))
+    except (OSError, sqlite3.Error):
+        return None
+
+
+def iter_pending_images(result_index, input_dir, image_files, model_identity, prompt, params, on_cached):
+    """Yield (index, image_file, result_key) for every image that still needs inference.
+
+    Images are looked up lazily as image_files is consumed; cached results are
+    handed to on_cached(index, image_file, raw_output) instead of being
+    yielded, and their count is reported once every image was looked up.
+    Keys are None when no index is configured.
+    """
+    cached = 0
+    for index, image_file in enumerate(image_files, start=1):
+        if result_index is None:
+            yield index, image_file, None
+            continue
+        image_hash = result_index.file_hash(os.path.join(input_dir, image_file))
+        key = make_result_key(image_hash, model_identity, prompt, params)
+        raw_output = result_index.lookup(key)
+        if raw_output is None:
+            yield index, image_file, key
+        else:
+            cached += 1
+            on_cached(index, image_file, raw_output)
+    if cached:
+        send_json_message(
+            'status',
+            f'{cached} images reused cached results. Set result_cache = false under [cache] to generate them again.',
+        )
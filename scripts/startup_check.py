@@ -0,0 +1,117 @@
+"""Cold-start cost of the captioning entry point, per backend.
+
+Every measurement starts a fresh interpreter with -X importtime, imports
+caption_generator_portable and loads one backend through its registry, the
+same work a one-shot job does before its first request. Reports the wall
+time and the import time per top-level package, and exits with status 1
+when any backend's median wall time is over the budget (1500 ms unless
+--budget-ms says otherwise), so it can gate changes to imports.
+
+    python scripts/startup_check.py
+    python scripts/startup_check.py --budget-ms 0
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+
+from caption_generator_portable import BACKEND_MODULES
+
+ENTRY_ONLY = 'entry'
+# Cold start of a one-shot job, interpreter included, on a typical desktop.
+DEFAULT_BUDGET_MS = 1500
+
+
+def _startup_code(section):
+    code = f'import sys; sys.path.insert(0, {SCRIPT_DIR!r}); import caption_generator_portable as entry'
+    if section != ENTRY_ONLY:
+        code += f'; entry.load_backend({section!r})'
+    return code
+
+
+def parse_import_times(text):
+    """Sum the self time of every imported module by top-level package, in milliseconds."""
+    packages = {}
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        package = parts[2].strip().split('.')[0]
+        packages[package] = packages.get(package, 0.0) + int(parts[0]) / 1000.0
+    return packages
+
+
+def measure_startup(section, runs=3):
+    walls = []
+    packages = {}
+    for _run in range(max(1, runs)):
+        started = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', _startup_code(section)],
+            capture_output=True,
+            text=True,
+        )
+        walls.append((time.perf_counter() - started) * 1000.0)
+        if process.returncode != 0:
+            raise RuntimeError(f'Loading {section} failed:\n{process.stderr[-2000:]}')
+        packages = parse_import_times(process.stderr)
+
+    return {
+        'backend': section,
+        'first_ms': round(walls[0], 1),
+        'median_ms': round(statistics.median(walls), 1),
+        'import_ms': round(sum(packages.values()), 1),
+        'packages': {name: round(ms, 1) for name, ms in sorted(packages.items(), key=lambda item: -item[1])},
+    }
+
+
+def print_report(results, budget_ms, top):
+    header = f"{'backend':<10} {'first':>9} {'median':>9} {'imports':>9}  slowest imports"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        slowest = ', '.join(f'{name} {ms:.0f} ms' for name, ms in list(result['packages'].items())[:top])
+        over = '  OVER BUDGET' if budget_ms and result['median_ms'] > budget_ms else ''
+        print(
+            f"{result['backend']:<10} {result['first_ms']:>6.0f} ms {result['median_ms']:>6.0f} ms "
+            f"{result['import_ms']:>6.0f} ms  {slowest}{over}"
+        )
+    if budget_ms:
+        print(f'Budget: {budget_ms:.0f} ms median wall time per backend.')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Measure cold-start import cost of the captioning entry point.')
+    parser.add_argument('--backend', choices=(ENTRY_ONLY,) + tuple(BACKEND_MODULES) + ('all',), default='all')
+    parser.add_argument('--runs', type=int, default=3, help='fresh interpreters started per backend')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS, help='fail when a median wall time exceeds this (0 = report only)')
+    parser.add_argument('--top', type=int, default=5, help='slowest packages listed per backend')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sections = (ENTRY_ONLY,) + tuple(BACKEND_MODULES) if args.backend == 'all' else (args.backend,)
+    results = [measure_startup(section, runs=args.runs) for section in sections]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results, args.budget_ms, args.top)
+
+    if args.budget_ms and any(result['median_ms'] > args.budget_ms for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
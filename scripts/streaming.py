@@ -0,0 +1,133 @@
+import json
+import time
+
+from events import send_json_message
+
+PARTIAL_INTERVAL_SECONDS = 0.5
+REPETITION_WINDOW = 600
+REPETITION_MAX_PERIOD = 200
+REPETITION_MIN_SPAN = 300
+
+
+def iter_sse_events(response):
+    """Yield (event_name, data) pairs from a text/event-stream response."""
+    event_name = ''
+    data_lines = []
+    for raw_line in response.iter_lines(decode_unicode=False):
+        line = raw_line.decode('utf-8', errors='replace') if isinstance(raw_line, bytes) else raw_line
+        if not line:
+            if data_lines:
+                yield event_name, '\n'.join(data_lines)
+            event_name = ''
+            data_lines = []
+            continue
+        if line.startswith(':'):
+            continue
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'event':
+            event_name = value
+        elif field == 'data':
+            data_lines.append(value)
+    if data_lines:
+        yield event_name, '\n'.join(data_lines)
+
+
+def iter_ndjson(response):
+    """Yield decoded objects from a newline-delimited JSON response."""
+    for raw_line in response.iter_lines(decode_unicode=False):
+        if not raw_line:
+            continue
+        try:
+            yield json.loads(raw_line)
+        except ValueError:
+            continue
+
+
+def find_repetition_cut(text):
+    """Return the length to truncate a looping generation to, or None while it looks healthy.
+
+    A generation is looping when its tail is one short unit repeated over and
+    over; the cut keeps the text before the loop plus a single copy of the unit.
+    """
+    tail = text[-REPETITION_WINDOW:]
+    if len(tail) < REPETITION_MIN_SPAN:
+        return None
+    for period in range(1, REPETITION_MAX_PERIOD + 1):
+        repeats = max(3, -(-REPETITION_MIN_SPAN // period))
+        span = period * repeats
+        if span > len(tail):
+            break
+        unit = tail[-period:]
+        if not unit.strip():
+            continue
+        if tail.endswith(unit * repeats):
+            start = len(text) - span
+            while start >= period and text[start - period:start] == unit:
+                start -= period
+            return start + period
+    return None
+
+
+class StreamCollector:
+    """Accumulates streamed text, emits throttled `partial` messages and stops runaways."""
+
+    def __init__(self, index, image_file, max_chars=0, stop_on_repetition=True):
+        self.index = index
+        self.image_file = image_file
+        self.max_chars = int(max_chars or 0)
+        self.stop_on_repetition = stop_on_repetition
+        self.parts = []
+        self.length = 0
+        self.stopped_reason = ''
+        self._last_emit = 0.0
+        self._emitted_length = 0
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def add(self, delta):
+        """Add a chunk of streamed text; returns False when generation should be cancelled."""
+        if not delta:
+            return True
+        self.parts.append(delta)
+        self.length += len(delta)
+
+        if self.max_chars and self.length > self.max_chars:
+            self._stop(self.max_chars, 'length limit')
+            return False
+
+        now = time.monotonic()
+        if now - self._last_emit < PARTIAL_INTERVAL_SECONDS:
+            return True
+        self._last_emit = now
+
+        text = self.text
+        self.parts = [text]
+        if self.stop_on_repetition:
+            cut = find_repetition_cut(text)
+            if cut is not None:
+                self._stop(cut, 'repetition')
+                return False
+        self._emit(text)
+        return True
+
+    def _stop(self, cut, reason):
+        text = self.text[:cut]
+        self.parts = [text]
+        self.length = len(text)
+        self.stopped_reason = reason
+        send_json_message('status', f'Stopped runaway generation for {self.image_file} ({reason}).')
+
+    def _emit(self, text):
+        if len(text) == self._emitted_length:
+            return
+        self._emitted_length = len(text)
+        send_json_message('partial', {'index': self.index, 'text': text})
+
+    def finish(self):
+        text = self.text
+        self._emit(text)
+        return text
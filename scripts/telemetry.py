@@ -0,0 +1,152 @@
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+
+RUN_SUMMARY_FILE = '.caption_creator_run_summary.json'
+STAGES = ('read', 'decode', 'resize', 'encode', 'base64', 'request', 'parse', 'write')
+
+
+class ImageTelemetry:
+    """Seconds spent per pipeline stage and token statistics for one image."""
+
+    def __init__(self):
+        self.stages = {}
+        self.tokens = {}
+        self.batch_size = 1
+        self.image_tokens = None
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def as_dict(self):
+        data = {'stages': {name: round(self.stages[name], 6) for name in STAGES if name in self.stages}}
+        if self.tokens:
+            data['tokens'] = dict(self.tokens)
+        if self.batch_size > 1:
+            data['batch_size'] = self.batch_size
+        if self.image_tokens is not None:
+            data['image_tokens'] = self.image_tokens
+        return data
+
+
+def share_telemetry(batch, telemetries):
+    """Spread the stage times and token counts of one multi-image request evenly over its images."""
+    count = len(telemetries)
+    for telemetry in telemetries:
+        for name, seconds in batch.stages.items():
+            telemetry.stages[name] = telemetry.stages.get(name, 0.0) + seconds / count
+        telemetry.tokens = {
+            key: value if key.endswith('per_second') else round(value / count)
+            for key, value in batch.tokens.items()
+        }
+        telemetry.batch_size = count
+
+
+def stage_timer(telemetry, name):
+    return telemetry.stage(name) if telemetry is not None else nullcontext()
+
+
+def token_stats(prompt_tokens=None, completion_tokens=None, tokens_per_second=None, generation_seconds=None, prompt_tokens_per_second=None, cached_prompt_tokens=None):
+    """Normalize the token counters a server reports, dropping the ones it did not send.
+
+    prompt_tokens includes cached_prompt_tokens, the part of the prompt the
+    server reused from its KV cache instead of evaluating again.
+    """
+    if tokens_per_second is None and completion_tokens and generation_seconds:
+        tokens_per_second = completion_tokens / generation_seconds
+    stats = {
+        'prompt_tokens': prompt_tokens,
+        'cached_prompt_tokens': cached_prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'tokens_per_second': round(float(tokens_per_second), 2) if tokens_per_second is not None else None,
+        'prompt_tokens_per_second': round(float(prompt_tokens_per_second), 2) if prompt_tokens_per_second is not None else None,
+    }
+    return {key: value for key, value in stats.items() if value is not None}
+
+
+class RunSummary:
+    """Collects per-image telemetry and writes a machine-readable summary into the output folder."""
+
+    def __init__(self, backend, model, total_images, settings=None):
+        self.backend = backend
+        self.model = model
+        self.total_images = total_images
+        self.settings = settings or {}
+        self.duplicate_images = 0
+        self.failed_images = 0
+        self.started = time.time()
+        self.images = []
+
+    def add(self, index, image_file, telemetry=None, cached=False):
+        # The telemetry is read in as_dict(), after the output writer has timed its 'write' stage.
+        self.images.append(({'index': index, 'file': image_file, 'cached': cached}, telemetry))
+
+    def as_dict(self):
+        finished = time.time()
+        elapsed = finished - self.started
+        images = [entry if telemetry is None else {**entry, **telemetry.as_dict()} for entry, telemetry in self.images]
+        stage_totals = {}
+        for entry in images:
+            for name, seconds in entry.get('stages', {}).items():
+                stage_totals[name] = stage_totals.get(name, 0.0) + seconds
+        generated = [entry for entry in images if not entry['cached']]
+
+        token_rates = [entry['tokens']['tokens_per_second'] for entry in generated if 'tokens_per_second' in entry.get('tokens', {})]
+        tokens = {
+            'prompt_tokens': sum(entry.get('tokens', {}).get('prompt_tokens', 0) for entry in generated),
+            'completion_tokens': sum(entry.get('tokens', {}).get('completion_tokens', 0) for entry in generated),
+        }
+        cached_counts = [entry['tokens']['cached_prompt_tokens'] for entry in generated if 'cached_prompt_tokens' in entry.get('tokens', {})]
+        if cached_counts:
+            tokens['cached_prompt_tokens'] = sum(cached_counts)
+        image_token_counts = [entry['image_tokens'] for entry in generated if 'image_tokens' in entry]
+        if image_token_counts:
+            tokens['expected_image_tokens'] = sum(image_token_counts)
+        if token_rates:
+            tokens['mean_tokens_per_second'] = round(sum(token_rates) / len(token_rates), 2)
+
+        return {
+            'backend': self.backend,
+            'model': self.model,
+            'settings': self.settings,
+            'started': self.started,
+            'finished': finished,
+            'elapsed': elapsed,
+            'total_images': self.total_images,
+            'completed_images': len(images),
+            'cached_images': len(images) - len(generated),
+            'duplicate_images': self.duplicate_images,
+            'failed_images': self.failed_images,
+            'images_per_second': len(images) / elapsed if elapsed > 0 else 0.0,
+            'stages': {
+                name: {
+                    'total': round(stage_totals[name], 6),
+                    'mean': round(stage_totals[name] / len(generated), 6) if generated else 0.0,
+                }
+                for name in STAGES if name in stage_totals
+            },
+            'tokens': tokens,
+            'images': images,
+        }
+
+    def write(self, output_dir):
+        path = os.path.join(output_dir, RUN_SUMMARY_FILE)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.as_dict(), f, indent=2)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+        return path
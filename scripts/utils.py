@@ -1,27 +1,19 @@
 import base64
 import io
-import json
 import os
-import re
+import struct
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from PIL import Image, ImageOps
 
-IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+from telemetry import ImageTelemetry, stage_timer
 
-
-def natural_file_name_key(file_name):
-    return [
-        int(part) if part.isdigit() else part.lower()
-        for part in re.split(r'(\d+)', file_name)
-    ]
-
-
-def list_image_files(input_dir):
-    return sorted(
-        [f for f in os.listdir(input_dir) if f.lower().endswith(IMAGE_EXTENSIONS)],
-        key=natural_file_name_key,
-    )
+# Decode at least this many times the target size before the final resample.
+REDUCING_GAP = 2
 
 
 def parse_generation_params(config):
@@ -56,32 +48,188 @@ def _choose_image_output_format(image_path, image_format, img):
     return 'JPEG', 'image/jpeg'
 
 
-def encode_image(image_path, resize_max=1536, image_format='jpeg', return_mime=False):
+def _decoded_bytes(size, mode):
+    width, height = size
+    if mode in ('1', 'L', 'P'):
+        bytes_per_pixel = 1
+    elif mode.startswith('I;16'):
+        bytes_per_pixel = 2
+    else:
+        bytes_per_pixel = 4
+    return width * height * bytes_per_pixel
+
+
+def _open_reduced(source, resize_max, max_decode_bytes=0):
+    """Decode an image at the smallest scale that still leaves room for a quality resample.
+
+    JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale (draft mode); other
+    formats are box-reduced right after decoding, before orientation and the
+    final LANCZOS pass. Images that would still need more than
+    max_decode_bytes once decoded are rejected before any pixels are loaded.
+    """
+    img = Image.open(io.BytesIO(source))
+    target = resize_max * REDUCING_GAP
+    longest = max(img.size)
+    if longest > target:
+        scale = target / longest
+        img.draft(None, (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+
+    if max_decode_bytes > 0:
+        needed = _decoded_bytes(img.size, img.mode)
+        if needed > max_decode_bytes:
+            raise RuntimeError(
+                f'{img.width}x{img.height} image needs about {needed // (1024 * 1024)} MB to decode, '
+                f'over the decode_memory_mb budget of {max_decode_bytes // (1024 * 1024)} MB'
+            )
+
+    img.load()
+    factor = max(img.size) // target
+    if factor >= 2 and img.mode not in ('1', 'P'):
+        img = img.reduce(int(factor))
+    return img
+
+
+def _encode_image_bytes(image_path, resize_max, image_format, telemetry=None, max_decode_bytes=0, vision_grid=None):
+    with stage_timer(telemetry, 'read'):
+        with open(image_path, 'rb') as f:
+            source = f.read()
+
+    with stage_timer(telemetry, 'decode'):
+        img = _open_reduced(source, resize_max, max_decode_bytes)
+        img = ImageOps.exif_transpose(img)
+
+    with stage_timer(telemetry, 'resize'):
+        if vision_grid is not None:
+            size = vision_grid.fit(img.width, img.height, resize_max)
+            if size != img.size:
+                img = img.resize(size, Image.Resampling.LANCZOS)
+        elif max(img.width, img.height) > resize_max:
+            img.thumbnail((resize_max, resize_max), Image.Resampling.LANCZOS)
+
+    output_format, mime_type = _choose_image_output_format(image_path, image_format, img)
+    buffer = io.BytesIO()
+
+    with stage_timer(telemetry, 'encode'):
+        if output_format == 'PNG':
+            if img.mode not in ('RGB', 'RGBA', 'P', 'L'):
+                img = img.convert('RGBA')
+            img.save(buffer, format='PNG', optimize=True)
+        else:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.save(buffer, format='JPEG', quality=95, optimize=True)
+
+    # A view of the encoder's buffer avoids copying the payload out of it.
+    return buffer.getbuffer(), mime_type, img.size
+
+
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _payload_size(image_bytes, mime_type):
+    """(width, height) read straight from a PNG or JPEG header, or None."""
+    if mime_type == 'image/png':
+        return struct.unpack_from('>II', image_bytes, 16) if len(image_bytes) >= 24 else None
+    position = 2
+    while position + 9 <= len(image_bytes):
+        if image_bytes[position] != 0xFF:
+            return None
+        marker = image_bytes[position + 1]
+        if marker == 0xFF:
+            position += 1
+        elif marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', image_bytes, position + 5)
+            return width, height
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            position += 2
+        else:
+            position += 2 + struct.unpack_from('>H', image_bytes, position + 2)[0]
+    return None
+
+
+class ImageLoadError(RuntimeError):
+    """An image could not be read, decoded or re-encoded. Retrying does not help."""
+
+
+def load_image_payload(image_path, resize_max=1536, image_format='jpeg', cache=None, telemetry=None, max_decode_bytes=0, vision_grid=None):
+    """Return (image_bytes, mime_type) ready to send, resized and re-encoded or from the cache.
+
+    With a vision_grid the image is sized to whole tiles of the model's patch
+    grid within its token budget, and telemetry records the image tokens the
+    projector is expected to produce.
+    """
     try:
-        with Image.open(image_path) as img:
-            img = ImageOps.exif_transpose(img)
-            resize_max = int(resize_max or 1536)
-            if max(img.width, img.height) > resize_max:
-                img.thumbnail((resize_max, resize_max), Image.Resampling.LANCZOS)
-
-            output_format, mime_type = _choose_image_output_format(image_path, image_format, img)
-            buffer = io.BytesIO()
-
-            if output_format == 'PNG':
-                if img.mode not in ('RGB', 'RGBA', 'P', 'L'):
-                    img = img.convert('RGBA')
-                img.save(buffer, format='PNG', optimize=True)
-            else:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img.save(buffer, format='JPEG', quality=95, optimize=True)
-
-        encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        if return_mime:
-            return encoded, mime_type
-        return encoded
+        resize_max = int(resize_max or 1536)
+        cached = None
+        if cache is not None:
+            with stage_timer(telemetry, 'read'):
+                cache_key = cache.make_key(image_path, resize_max, image_format, variant=vision_grid.cache_tag() if vision_grid else '')
+                cached = cache.get(cache_key)
+
+        if cached is not None:
+            image_bytes, mime_type = cached
+            size = _payload_size(image_bytes, mime_type) if vision_grid is not None else None
+        else:
+            image_bytes, mime_type, size = _encode_image_bytes(image_path, resize_max, image_format, telemetry, max_decode_bytes, vision_grid)
+            if cache is not None:
+                cache.put(cache_key, image_bytes, mime_type)
+
+        if vision_grid is not None and telemetry is not None and size is not None:
+            telemetry.image_tokens = vision_grid.image_tokens(*size)
+        return image_bytes, mime_type
     except Exception as e:
-        raise RuntimeError(f'Failed to process image {image_path}: {e}')
+        raise ImageLoadError(f'Failed to process image {image_path}: {e}')
+
+
+def encode_image(image_path, resize_max=1536, image_format='jpeg', return_mime=False, cache=None, telemetry=None, max_decode_bytes=0, vision_grid=None):
+    image_bytes, mime_type = load_image_payload(image_path, resize_max, image_format, cache, telemetry, max_decode_bytes, vision_grid)
+    with stage_timer(telemetry, 'base64'):
+        encoded = base64.b64encode(image_bytes).decode('utf-8')
+    if return_mime:
+        return encoded, mime_type
+    return encoded
+
+
+def iter_encoded_images(input_dir, image_files, resize_max=1536, image_format='jpeg', workers=2, prefetch=4, cache=None, decode_memory_mb=0, vision_grid=None, return_errors=False):
+    """Yield (image_file, image_bytes, mime_type, telemetry) in order, encoding ahead in background threads.
+
+    At most `prefetch` images are decoded or held in memory at once, so the
+    next payloads are ready when the backend finishes the current request.
+    decode_memory_mb caps the decoded size of any single image (0 = no cap).
+    With return_errors, an image that fails to load is yielded with its
+    ImageLoadError in place of image_bytes instead of ending the iteration.
+    """
+    workers = max(1, _safe_int(workers, 2))
+    prefetch = max(workers, _safe_int(prefetch, 4))
+    max_decode_bytes = max(0, int(float(decode_memory_mb or 0) * 1024 * 1024))
+    remaining = iter(image_files)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='encode')
+
+    def submit(image_file):
+        image_path = os.path.join(input_dir, image_file)
+        telemetry = ImageTelemetry()
+        future = executor.submit(load_image_payload, image_path, resize_max, image_format, cache, telemetry, max_decode_bytes, vision_grid)
+        pending.append((image_file, future, telemetry))
+
+    try:
+        for image_file in islice(remaining, prefetch):
+            submit(image_file)
+
+        while pending:
+            image_file, future, telemetry = pending.popleft()
+            try:
+                image_bytes, mime_type = future.result()
+            except ImageLoadError as e:
+                if not return_errors:
+                    raise
+                image_bytes, mime_type = e, None
+            next_file = next(remaining, None)
+            if next_file is not None:
+                submit(next_file)
+            yield image_file, image_bytes, mime_type, telemetry
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def _safe_int(value, fallback):
@@ -148,19 +296,74 @@ def get_output_extension(gen_type):
     }.get(gen_type, '.txt')
 
 
-def write_generation_output(output_dir, image_file, gen_type, final_output):
-    output_file_name = os.path.splitext(image_file)[0] + get_output_extension(gen_type)
-    output_path = os.path.join(output_dir, output_file_name)
-    with open(output_path, 'w', encoding='utf-8') as out_file:
-        out_file.write(final_output)
-    return output_path
+def write_generation_output(output_dir, image_file, gen_type, final_output, duplicates=()):
+    """Write the output for image_file, and the same output for each of its duplicates.
 
-
-def build_progress_payload(index, total_images, start_time):
+    Each file is written under a temporary name and renamed into place, so a
+    reader never sees a partly written output.
+    """
+    output_paths = []
+    for target_file in (image_file, *duplicates):
+        output_file_name = os.path.splitext(target_file)[0] + get_output_extension(gen_type)
+        output_path = os.path.join(output_dir, output_file_name)
+        if os.path.dirname(target_file):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        temp_path = f'{output_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as out_file:
+                out_file.write(final_output)
+            os.replace(temp_path, output_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        output_paths.append(output_path)
+    return output_paths[0]
+
+
+class ThroughputEstimate:
+    """Exponentially weighted seconds per image, so the ETA follows the recent pace.
+
+    Each completion moves the estimate `alpha` of the way towards its own
+    time, about the last 1 / alpha images; completions closer together than
+    MIN_SAMPLE_SECONDS count as one sample, so images finishing together at
+    concurrency above one do not pull the estimate towards zero.
+    """
+
+    MIN_SAMPLE_SECONDS = 0.05
+
+    def __init__(self, start_time, alpha=0.1):
+        self.alpha = alpha
+        self.seconds_per_image = None
+        self._completed = 0
+        self._last_time = start_time
+
+    def update(self, completed, now=None):
+        now = time.time() if now is None else now
+        done = completed - self._completed
+        elapsed = now - self._last_time
+        if done <= 0 or (elapsed < self.MIN_SAMPLE_SECONDS and self.seconds_per_image is not None):
+            return self.seconds_per_image
+        sample = elapsed / done
+        if self.seconds_per_image is None:
+            self.seconds_per_image = sample
+        else:
+            weight = 1 - (1 - self.alpha) ** done
+            self.seconds_per_image += weight * (sample - self.seconds_per_image)
+        self._completed = completed
+        self._last_time = now
+        return self.seconds_per_image
+
+
+def build_progress_payload(index, total_images, start_time, telemetry=None, throughput=None):
     elapsed = time.time() - start_time
     time_per_img = elapsed / index
+    if throughput is not None:
+        time_per_img = throughput.update(index) or time_per_img
     eta = (total_images - index) * time_per_img
-    return {
+    payload = {
         'current': index,
         'total': total_images,
         'percentage': (index / total_images) * 100,
@@ -168,6 +371,9 @@ def build_progress_payload(index, total_images, start_time):
         'eta': eta,
         'time_per_img': time_per_img,
     }
+    if telemetry is not None:
+        payload.update(telemetry.as_dict())
+    return payload
 
 
 def caption_needs_retry(clean_text, max_words):
@@ -176,12 +382,3 @@ def caption_needs_retry(clean_text, max_words):
 
 def tags_need_retry(tag_line, max_tags):
     return False, ''
-
-
-def send_json_message(msg_type, message_or_data):
-    payload = {'type': msg_type}
-    if msg_type in ['status', 'error']:
-        payload['message'] = message_or_data
-    else:
-        payload['data'] = message_or_data
-    print(json.dumps(payload), flush=True)
@@ -3,12 +3,13 @@ const { spawn } = require('child_process');
 const fs = require('fs-extra');
 const url = require('url');
 const { ipcMain } = require('electron');
-const { getEffectiveOutputRoot } = require('./config');
+const { getEffectiveOutputRoot, readConfigValue } = require('./config');
 
 const LM_STUDIO_MODEL_KEY = 'Custom (LM Studio)';
 const OLLAMA_MODEL_KEY = 'Custom (Ollama)';
 const IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg'];
 const INPUT_MANIFEST_FILE = '.caption_creator_input_manifest.json';
+const FAILED_IMAGES_FILE = '.caption_creator_failed_images.jsonl';
 
 /**
  * @typedef {Object} GenerationOptions
@@ -19,6 +20,7 @@ const INPUT_MANIFEST_FILE = '.caption_creator_input_manifest.json';
  * @property {boolean} disable_thinking
  * @property {boolean} single_paragraph
  * @property {string|number} max_words
+ * @property {string} [retry_failed_from]
  */
 
 function createJobId() {
@@ -84,6 +86,11 @@ async function killLlamaCppProcesses() {
     });
 }
 
+function isLlamaServerKeptWarm(ctx) {
+    const value = parseFloat(readConfigValue(ctx.paths.configPath, 'llama_cpp', 'server_idle_timeout', '0'));
+    return Number.isFinite(value) && value > 0;
+}
+
 function sanitizeJobId(jobId) {
     return String(jobId || '').replace(/[^a-zA-Z0-9_-]/g, '_');
 }
@@ -131,6 +138,26 @@ async function writeInputManifest(inputDir, entries) {
     })), { spaces: 2 });
 }
 
+async function readFailedImageNames(runOutputPath) {
+    let content;
+    try {
+        content = await fs.readFile(path.join(runOutputPath, FAILED_IMAGES_FILE), 'utf8');
+    } catch {
+        return [];
+    }
+
+    const names = new Set();
+    for (const line of content.split('\n')) {
+        try {
+            const fileName = path.basename(JSON.parse(line)?.file || '');
+            if (isSupportedImageFile(fileName) && await fs.pathExists(path.join(runOutputPath, fileName))) {
+                names.add(fileName);
+            }
+        } catch {}
+    }
+    return [...names].sort(naturalFileNameSort);
+}
+
 async function createRunOutputPath(ctx, mode) {
     const now = new Date();
     const dateStr = `${now.getMonth() + 1}-${now.getDate()}-${now.getFullYear()}`;
@@ -225,6 +252,7 @@ function buildCaptionArgs(ctx, inputDir, outputDir, options) {
         options.ollama_model_key || '',
         options.custom_prompt || '',
         (options.disable_thinking === true).toString(),
+        options.retry_failed_from || '',
     ];
 }
 
@@ -232,6 +260,16 @@ function sendToRenderer(ctx, eventName, payload) {
     ctx.state.mainWindow?.webContents.send(eventName, payload);
 }
 
+function onStdoutLines(backendProcess, handleLine) {
+    // The backend writes messages in batches, so one line can span two chunks.
+    let pending = '';
+    backendProcess.stdout.on('data', (data) => {
+        const lines = (pending + data.toString()).split('\n');
+        pending = lines.pop();
+        lines.filter(line => line.trim()).forEach(handleLine);
+    });
+}
+
 function attachPreparedBackendHandlers(ctx, backendProcess, runJobId) {
     let backendHadDetailedError = false;
     let detailedErrorMessage = '';
@@ -241,26 +279,25 @@ function attachPreparedBackendHandlers(ctx, backendProcess, runJobId) {
         progress: 'progress-update',
         error: 'generation-error',
         'image-complete': 'image-complete',
+        partial: 'partial-output',
     };
 
-    backendProcess.stdout.on('data', (data) => {
-        data.toString().trim().split('\n').forEach(line => {
-            try {
-                const json = JSON.parse(line);
-                const eventName = eventTypeMap[json.type];
-                if (eventName) {
-                    if (json.type === 'error') {
-                        backendHadDetailedError = true;
-                        detailedErrorMessage = detailedErrorMessage || json.message || json.data || '';
-                        return;
-                    }
-                    const eventPayload = json.type === 'status'
-                        ? { jobId: runJobId, message: json.message || json.data || '' }
-                        : { jobId: runJobId, ...(json.data || {}) };
-                    sendToRenderer(ctx, eventName, eventPayload);
+    onStdoutLines(backendProcess, line => {
+        try {
+            const json = JSON.parse(line);
+            const eventName = eventTypeMap[json.type];
+            if (eventName) {
+                if (json.type === 'error') {
+                    backendHadDetailedError = true;
+                    detailedErrorMessage = detailedErrorMessage || json.message || json.data || '';
+                    return;
                 }
-            } catch {}
-        });
+                const eventPayload = json.type === 'status'
+                    ? { jobId: runJobId, message: json.message || json.data || '' }
+                    : { jobId: runJobId, ...(json.data || {}) };
+                sendToRenderer(ctx, eventName, eventPayload);
+            }
+        } catch {}
     });
 
     backendProcess.stderr.on('data', (data) => {
@@ -280,10 +317,12 @@ function attachPreparedBackendHandlers(ctx, backendProcess, runJobId) {
             if (ctx.state.currentBackendJobId === runJobId) {
                 ctx.state.currentBackendJobId = null;
             }
-            try {
-                await killLlamaCppProcesses();
-            } catch (e) {
-                console.error("Error killing llama.cpp processes:", e);
+            if (!isLlamaServerKeptWarm(ctx)) {
+                try {
+                    await killLlamaCppProcesses();
+                } catch (e) {
+                    console.error("Error killing llama.cpp processes:", e);
+                }
             }
             sendToRenderer(ctx, 'generation-complete', { jobId: runJobId });
         } else if (!wasStoppedByUser) {
@@ -314,22 +353,21 @@ function attachLegacyBackendHandlers(ctx, backendProcess) {
         progress: 'progress-update',
         error: 'generation-error',
         'image-complete': 'image-complete',
+        partial: 'partial-output',
     };
 
-    backendProcess.stdout.on('data', (data) => {
-        data.toString().trim().split('\n').forEach(line => {
-            try {
-                const json = JSON.parse(line);
-                const eventName = eventTypeMap[json.type];
-                if (eventName) {
-                    if (json.type === 'error') {
-                        backendHadDetailedError = true;
-                        detailedErrorMessage = detailedErrorMessage || json.message || json.data || '';
-                    }
-                    sendToRenderer(ctx, eventName, json.message || json.data);
+    onStdoutLines(backendProcess, line => {
+        try {
+            const json = JSON.parse(line);
+            const eventName = eventTypeMap[json.type];
+            if (eventName) {
+                if (json.type === 'error') {
+                    backendHadDetailedError = true;
+                    detailedErrorMessage = detailedErrorMessage || json.message || json.data || '';
                 }
-            } catch {}
-        });
+                sendToRenderer(ctx, eventName, json.message || json.data);
+            }
+        } catch {}
     });
 
     backendProcess.stderr.on('data', (data) => {
@@ -401,6 +439,39 @@ function registerGenerationIpc(ctx) {
         return { success: true };
     });
 
+    ipcMain.handle('get-failed-images', async (_event, jobId) => {
+        const runOutputPath = jobId && ctx.state.jobOutputPaths.get(jobId);
+        const failedImages = runOutputPath ? await readFailedImageNames(runOutputPath) : [];
+        return { count: failedImages.length };
+    });
+
+    // Queues the images a finished run could not caption, under the names they have in its output
+    // folder, so the backend can match them against the run's failed-image list.
+    ipcMain.handle('prepare-failed-images-job', async (_event, sourceJobId) => {
+        const runOutputPath = sourceJobId && ctx.state.jobOutputPaths.get(sourceJobId);
+        const failedImages = runOutputPath ? await readFailedImageNames(runOutputPath) : [];
+        if (failedImages.length === 0) {
+            throw new Error('This generation has no failed images to retry.');
+        }
+
+        const jobId = createJobId();
+        const snapshotInputDir = getPreparedJobInputDir(ctx, jobId);
+        await fs.ensureDir(snapshotInputDir);
+        await fs.emptyDir(snapshotInputDir);
+
+        for (const fileName of failedImages) {
+            await fs.copy(path.join(runOutputPath, fileName), path.join(snapshotInputDir, fileName));
+        }
+        await writeInputManifest(snapshotInputDir, failedImages.map(fileName => ({ stagedName: fileName, originalName: fileName })));
+
+        return {
+            jobId,
+            count: failedImages.length,
+            filenames: failedImages.join('\n'),
+            retry_failed_from: path.join(runOutputPath, FAILED_IMAGES_FILE),
+        };
+    });
+
     ipcMain.handle('start-prepared-generation', async (_event, payload = {}) => {
         const { jobId, options } = payload;
         if (!jobId || !options) {
@@ -45,8 +45,17 @@ function getLmStudioHeaders(extraHeaders = {}) {
     return headers;
 }
 
-function requestLmStudioJson(method, endpoint, body = null, timeoutMs = 30000) {
-    return requestJson(`${LM_STUDIO_HOST}${endpoint}`, method, body, timeoutMs, getLmStudioHeaders, 'LM Studio');
+function firstBaseUrl(value, fallback) {
+    const first = String(value || '').split(',').map((url) => url.trim()).find(Boolean);
+    return (first || fallback).replace(/\/+$/, '');
+}
+
+function getLmStudioBaseUrl(ctx) {
+    return firstBaseUrl(readConfigValue(ctx.paths.configPath, 'lm_studio', 'base_url', LM_STUDIO_HOST), LM_STUDIO_HOST);
+}
+
+function requestLmStudioJson(ctx, method, endpoint, body = null, timeoutMs = 30000) {
+    return requestJson(`${getLmStudioBaseUrl(ctx)}${endpoint}`, method, body, timeoutMs, getLmStudioHeaders, 'LM Studio');
 }
 
 function readLmStudioContextLength(ctx) {
@@ -55,7 +64,7 @@ function readLmStudioContextLength(ctx) {
 }
 
 function getOllamaBaseUrl(ctx) {
-    return (readConfigValue(ctx.paths.configPath, 'ollama', 'base_url', OLLAMA_DEFAULT_HOST) || OLLAMA_DEFAULT_HOST).replace(/\/+$/, '');
+    return firstBaseUrl(readConfigValue(ctx.paths.configPath, 'ollama', 'base_url', OLLAMA_DEFAULT_HOST), OLLAMA_DEFAULT_HOST);
 }
 
 function getOllamaHeaders(extraHeaders = {}) {
@@ -178,6 +187,15 @@ function normalizeLmStudioModel(model) {
     };
 }
 
+async function removeModelFile(filePath) {
+    // The downloader keeps the verified SHA-256 of each model file beside it.
+    for (const target of [filePath, `${filePath}.sha256`]) {
+        if (await fs.pathExists(target)) {
+            await fs.remove(target);
+        }
+    }
+}
+
 function registerModelIpc(ctx) {
     ipcMain.handle('get-model-availability', async () => {
         try {
@@ -208,9 +226,7 @@ function registerModelIpc(ctx) {
 
         try {
             const mainModelPath = path.join(ctx.paths.modelsDir, modelFiles.modelFile);
-            if (await fs.pathExists(mainModelPath)) {
-                await fs.remove(mainModelPath);
-            }
+            await removeModelFile(mainModelPath);
 
             const remainingVisionFiles = new Set();
             const filesInDir = await fs.readdir(ctx.paths.modelsDir);
@@ -226,9 +242,7 @@ function registerModelIpc(ctx) {
 
             if (!remainingVisionFiles.has(modelFiles.visionFile.toLowerCase())) {
                 const visionModelPath = path.join(ctx.paths.modelsDir, modelFiles.visionFile);
-                if (await fs.pathExists(visionModelPath)) {
-                    await fs.remove(visionModelPath);
-                }
+                await removeModelFile(visionModelPath);
             }
 
             return { success: true };
@@ -240,7 +254,7 @@ function registerModelIpc(ctx) {
 
     ipcMain.handle('check-lm-studio-connection', async () => {
         try {
-            await requestLmStudioJson('GET', '/api/v1/models', null, 2500);
+            await requestLmStudioJson(ctx, 'GET', '/api/v1/models', null, 2500);
             return { success: true };
         } catch (e) {
             return { success: false, error: e.message };
@@ -249,7 +263,7 @@ function registerModelIpc(ctx) {
 
     ipcMain.handle('get-lm-studio-models', async () => {
         try {
-            const payload = await requestLmStudioJson('GET', '/api/v1/models', null, 5000);
+            const payload = await requestLmStudioJson(ctx, 'GET', '/api/v1/models', null, 5000);
             const models = Array.isArray(payload.models) ? payload.models : [];
             const visionModels = models
                 .filter(model => model.type === 'llm' && model.capabilities?.vision)
@@ -276,7 +290,7 @@ function registerModelIpc(ctx) {
         }
 
         try {
-            const payload = await requestLmStudioJson('POST', '/api/v1/models/load', body, 120000);
+            const payload = await requestLmStudioJson(ctx, 'POST', '/api/v1/models/load', body, 120000);
             return { success: true, data: payload };
         } catch (e) {
             return { success: false, error: e.message };
@@ -291,7 +305,7 @@ function registerModelIpc(ctx) {
 
         if (instanceIds.length === 0 && modelKey) {
             try {
-                const payload = await requestLmStudioJson('GET', '/api/v1/models', null, 5000);
+                const payload = await requestLmStudioJson(ctx, 'GET', '/api/v1/models', null, 5000);
                 const models = Array.isArray(payload.models) ? payload.models : [];
                 const model = models.find(item => (item.key || item.id) === modelKey);
                 instanceIds = (model?.loaded_instances || [])
@@ -309,7 +323,7 @@ function registerModelIpc(ctx) {
         try {
             const unloaded = [];
             for (const instanceId of instanceIds) {
-                const payload = await requestLmStudioJson('POST', '/api/v1/models/unload', {
+                const payload = await requestLmStudioJson(ctx, 'POST', '/api/v1/models/unload', {
                     instance_id: instanceId,
                 }, 30000);
                 unloaded.push(payload.instance_id || instanceId);
@@ -1,15 +1,17 @@
 const { contextBridge, ipcRenderer, webUtils } = require('electron');
-
-contextBridge.exposeInMainWorld('electronAPI', {
+
+contextBridge.exposeInMainWorld('electronAPI', {
     // Renderer to Main
     startGeneration: (options) => ipcRenderer.invoke('start-generation', options),
     beginPythonProcess: (options) => ipcRenderer.send('begin-python-process', options),
     prepareGenerationJob: (options) => ipcRenderer.invoke('prepare-generation-job', options),
     startPreparedGeneration: (payload) => ipcRenderer.invoke('start-prepared-generation', payload),
     discardPreparedGeneration: (jobId) => ipcRenderer.invoke('discard-prepared-generation', jobId),
+    getFailedImages: (jobId) => ipcRenderer.invoke('get-failed-images', jobId),
+    prepareFailedImagesJob: (jobId) => ipcRenderer.invoke('prepare-failed-images-job', jobId),
     stopGeneration: () => ipcRenderer.send('stop-generation'),
-    openFileDialog: () => ipcRenderer.invoke('open-file-dialog'),
-    handleDroppedFile: (filePath) => ipcRenderer.invoke('handle-dropped-file', filePath),
+    openFileDialog: () => ipcRenderer.invoke('open-file-dialog'),
+    handleDroppedFile: (filePath) => ipcRenderer.invoke('handle-dropped-file', filePath),
     handlePastedImage: (arrayBuffer) => ipcRenderer.invoke('handle-pasted-image', arrayBuffer),
     openBatchDialog: () => ipcRenderer.invoke('open-batch-dialog'),
     handleDroppedBatch: (filePaths) => ipcRenderer.invoke('handle-dropped-batch', filePaths),
@@ -41,23 +43,24 @@ contextBridge.exposeInMainWorld('electronAPI', {
     openMainLink: () => ipcRenderer.send('open-main-link'),
     openOnlineLink: () => ipcRenderer.send('open-online-link'),
     getPathForFile: (file) => webUtils.getPathForFile(file),
-
-    // Window controls
-    minimizeWindow: () => ipcRenderer.send('window-minimize'),
-    maximizeWindow: () => ipcRenderer.send('window-maximize'),
-    closeWindow: () => ipcRenderer.send('window-close'),
-
-    // Main to Renderer
-    onStatusUpdate: (callback) => ipcRenderer.on('status-update', (_event, value) => callback(value)),
-    onProgressUpdate: (callback) => ipcRenderer.on('progress-update', (_event, value) => callback(value)),
-    onImageComplete: (callback) => ipcRenderer.on('image-complete', (_event, value) => callback(value)),
+
+    // Window controls
+    minimizeWindow: () => ipcRenderer.send('window-minimize'),
+    maximizeWindow: () => ipcRenderer.send('window-maximize'),
+    closeWindow: () => ipcRenderer.send('window-close'),
+
+    // Main to Renderer
+    onStatusUpdate: (callback) => ipcRenderer.on('status-update', (_event, value) => callback(value)),
+    onProgressUpdate: (callback) => ipcRenderer.on('progress-update', (_event, value) => callback(value)),
+    onImageComplete: (callback) => ipcRenderer.on('image-complete', (_event, value) => callback(value)),
+    onPartialOutput: (callback) => ipcRenderer.on('partial-output', (_event, value) => callback(value)),
     onGenerationComplete: (callback) => ipcRenderer.on('generation-complete', (_event, value) => callback(value)),
-    onGenerationError: (callback) => ipcRenderer.on('generation-error', (_event, value) => callback(value)),
+    onGenerationError: (callback) => ipcRenderer.on('generation-error', (_event, value) => callback(value)),
     onGenerationStopped: (callback) => ipcRenderer.on('generation-stopped', (_event, value) => callback(value)),
-
-    // Download events
-    onDownloadStatus: (callback) => ipcRenderer.on('download-status', (_event, value) => callback(value)),
-    onDownloadProgress: (callback) => ipcRenderer.on('download-progress', (_event, value) => callback(value)),
-    onDownloadComplete: (callback) => ipcRenderer.on('download-complete', (_event, value) => callback(value)),
-    onDownloadError: (callback) => ipcRenderer.on('download-error', (_event, value) => callback(value)),
+
+    // Download events
+    onDownloadStatus: (callback) => ipcRenderer.on('download-status', (_event, value) => callback(value)),
+    onDownloadProgress: (callback) => ipcRenderer.on('download-progress', (_event, value) => callback(value)),
+    onDownloadComplete: (callback) => ipcRenderer.on('download-complete', (_event, value) => callback(value)),
+    onDownloadError: (callback) => ipcRenderer.on('download-error', (_event, value) => callback(value)),
 });
@@ -354,12 +354,14 @@ function renderQueueModal() {
             failed: 'Failed',
         }[job.status] || job.status;
 
+        const canRetryFailed = isFinishedQueueStatus(job.status) && job.failedImages > 0;
         const action = document.createElement('button');
         action.type = 'button';
-        action.className = 'gr-button-secondary queue-remove-button';
+        action.className = 'gr-button-secondary queue-action-button';
         action.dataset.jobId = job.id;
-        action.textContent = 'Remove';
-        action.hidden = job.status !== 'pending';
+        action.dataset.action = canRetryFailed ? 'retry-failed' : 'remove';
+        action.textContent = canRetryFailed ? `Retry ${job.failedImages} Failed` : 'Remove';
+        action.hidden = job.status !== 'pending' && !canRetryFailed;
 
         row.appendChild(details);
         row.appendChild(status);
@@ -382,6 +384,37 @@ async function removePendingQueueJob(jobId) {
     renderQueueModal();
 }
 
+async function retryFailedQueueJob(jobId) {
+    const sourceJob = getQueueJob(appState, jobId);
+    if (!sourceJob || !(sourceJob.failedImages > 0)) return;
+
+    try {
+        const preparedJob = await window.electronAPI.prepareFailedImagesJob(jobId);
+        const options = {
+            ...sourceJob.options,
+            // The failed-image list names images by their file names in the earlier run's output.
+            preserve_original_names: true,
+            retry_failed_from: preparedJob.retry_failed_from,
+        };
+        const job = {
+            id: preparedJob.jobId,
+            options,
+            label: `${getQueueJobLabel(options)}; retry ${preparedJob.count} failed`,
+            status: 'pending',
+            error: '',
+            outputFiles: [],
+        };
+
+        sourceJob.failedImages = 0;
+        appState.generationQueue.push(job);
+        DOMElements.statusOutput.value = `Queued: ${job.label}`;
+        renderQueueModal();
+        processNextQueuedJob();
+    } catch (error) {
+        DOMElements.statusOutput.value = `ERROR: \n${error.message || error}`;
+    }
+}
+
 async function clearFinishedQueueJobs() {
     const finishedJobs = appState.generationQueue.filter(job => isFinishedQueueStatus(job.status));
     await Promise.all(finishedJobs.map(job => window.electronAPI.discardPreparedGeneration(job.id)));
@@ -419,6 +452,11 @@ async function finishActiveQueueJob(job, status, errorMessage = '') {
     job.status = status;
     job.error = errorMessage;
     await cleanupPreparedJob(job.id);
+    try {
+        job.failedImages = (await window.electronAPI.getFailedImages(job.id)).count;
+    } catch (error) {
+        console.error('Failed to read the failed-image list:', error);
+    }
     startExternalHeartbeatForJob(job);
     appState.activeQueueJobId = null;
     setRunningState(false);
@@ -1156,9 +1194,13 @@ window.addEventListener('DOMContentLoaded', async () => {
     DOMElements.queueButtons.forEach(btn => btn.addEventListener('click', openQueueModal));
     DOMElements.queueClearFinishedButton.addEventListener('click', clearFinishedQueueJobs);
     DOMElements.queueList.addEventListener('click', async (event) => {
-        const removeButton = event.target.closest('.queue-remove-button');
-        if (!removeButton) return;
-        await removePendingQueueJob(removeButton.dataset.jobId);
+        const actionButton = event.target.closest('.queue-action-button');
+        if (!actionButton) return;
+        if (actionButton.dataset.action === 'retry-failed') {
+            await retryFailedQueueJob(actionButton.dataset.jobId);
+        } else {
+            await removePendingQueueJob(actionButton.dataset.jobId);
+        }
     });
     DOMElements.outputFolderButton.addEventListener('click', handleOutputFolderButtonClick);
     DOMElements.customPromptInput.addEventListener('input', scheduleCustomPromptSave);
@@ -1426,15 +1468,27 @@ window.electronAPI.onImageComplete(payload => {
     const { jobId, data } = normalizeJobPayload(payload, appState);
     if (jobId && appState.activeQueueJobId && jobId !== appState.activeQueueJobId) return;
 
-    const imageToUnblur = DOMElements.batchGalleryOutput.querySelector(`img:nth-child(${data.index})`);
-    if (imageToUnblur) {
-        imageToUnblur.classList.remove('blurred');
-        if (data.index === 1) {
-            imageToUnblur.click();
+    // Completions that arrive together are sent as one range, index to end.
+    for (let index = data.index; index <= (data.end ?? data.index); index++) {
+        const imageToUnblur = DOMElements.batchGalleryOutput.querySelector(`img:nth-child(${index})`);
+        if (imageToUnblur) {
+            imageToUnblur.classList.remove('blurred');
+            if (index === 1) {
+                imageToUnblur.click();
+            }
         }
     }
 });
 
+window.electronAPI.onPartialOutput(payload => {
+    const { jobId, data } = normalizeJobPayload(payload, appState);
+    if (jobId && appState.activeQueueJobId && jobId !== appState.activeQueueJobId) return;
+
+    const job = getQueueJob(appState, jobId);
+    if (job?.options.mode !== 'Single Image') return;
+    DOMElements.singleTextOutput.value = data.text || '';
+});
+
 window.electronAPI.onGenerationComplete(async (payload) => {
     const { jobId } = normalizeJobPayload(payload, appState);
     const job = getQueueJob(appState, jobId);
@@ -18,6 +18,7 @@ export const ILLUSTRIOUS_DELIMITER = '|||NEGATIVE|||';
  * @property {string} label
  * @property {string} error
  * @property {string[]} outputFiles
+ * @property {number} [failedImages]
  */
 
 export const appState = {